@@ -0,0 +1,186 @@
+﻿''' Benchmarks of the game model, headless : cave loading, simulation steps, explosion chains, renderer bookkeeping,
+    loading and steps of generated large caves, and the replay fixtures (see replay.py), any of which not ending as recorded failing the run.
+    Writes the results as JSON, and compares them to a baseline written by a previous run, reporting the regressions.
+    bench_baseline.json holds reference results, taken with the default options : timings depend on the machine, so
+    rewrite it on the one used for comparisons (python bench.py --output bench_baseline.json) before changing the code,
+    then check the changes with python bench.py --baseline bench_baseline.json. '''
+
+from typing import Optional, Callable, Dict, List
+import argparse, json, os, platform, random, sys, time
+from engine import Cave, CaveListener, Tile, Headless
+from levels import LevelPack, compile_maps
+from replay import ScriptedPlayer, fixture_of, verify
+
+SEED = 1234
+TIMING = { 'ms': False, 'steps/s': True } # by unit, whether higher is better
+LARGE_STEPS = 60 # per large cave
+
+def large_map(size: int) -> Dict:
+    ''' A square cave of soil strewn with boulders (5%) and fireflies (0.1%), entered from its top left corner. '''
+    rand = random.Random(size)
+    rows = [ 'W' + ''.join(rand.choices('rf. ', weights = [50, 1, 849, 100], k = size - 2)) + 'W' for _ in range(size - 2) ]
+    rows[0] = 'WE' + rows[0][2:]
+    return { 'name': f'large {size}', 'goal': 10, 'map': [ 'W' * size, *rows, 'W' * size ] }
+
+def best_time(function: Callable[[], None], repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start_time = time.perf_counter() ; function()
+        best = min(best, time.perf_counter() - start_time)
+    return best
+
+class SyncListener(CaveListener):
+    ''' Follows the changes of a cave as the windowed renderer does, collecting them until synchronized once per frame. '''
+
+    def __init__(self) -> None:
+        self.changes = {} ; self.sprites = {} ; self.events = 0
+
+    def on_added(self, tile: Tile, _back: bool) -> None: self.changes[tile] = True
+    def on_removed(self, tile: Tile, _back: bool) -> None: self.changes[tile] = False
+    def on_changed(self, tile: Tile) -> None:
+        if tile in self.sprites and tile not in self.changes: self.changes[tile] = True
+
+    def on_loaded(self, cave: Cave) -> None:
+        self.sprites = { tile: (tile.skin, tile.x, tile.y) for tile in [ *cave.tiles(None, True), *cave.tiles() ] }
+        self.changes.clear()
+
+    def sync(self) -> None:
+        for (tile, present) in self.changes.items():
+            if present: self.sprites[tile] = (tile.skin, tile.x, tile.y)
+            else: self.sprites.pop(tile, None)
+        self.events += len(self.changes) ; self.changes.clear()
+
+class Benchmark:
+    ''' Runs the benchmarks and collects their results, by name. '''
+
+    def __init__(self, levels: List[int], steps: int, repeat: int, sizes: List[int]) -> None:
+        self.levels = levels ; self.steps = steps ; self.repeat = repeat ; self.sizes = sizes
+        self.results = {} ; self.mismatches = [] # replays not ending as recorded
+
+    def report(self, name: str, value: float, unit: str) -> None:
+        self.results[name] = { 'value': round(value, 3), 'unit': unit }
+        print(f'{name:<24} {value:>12.3f} {unit}', file = sys.stderr)
+
+    def bench_load(self, level: int) -> None:
+        game = Headless(1, level, SEED)
+        self.report(f'load/{level:02}', best_time(lambda: game.cave.next_level(level), self.repeat) * 1000, 'ms')
+
+    def bench_restart(self, level: int) -> None:
+        best = float('inf')
+        for _ in range(self.repeat):
+            game = Headless(1, level, SEED) ; player = ScriptedPlayer(game, level)
+            for _ in range(self.steps): player.step()
+            best = min(best, best_time(lambda: game.cave.restart_level(), 1))
+        self.report(f'restart/{level:02}', best * 1000, 'ms')
+
+    def bench_steps(self, level: int, scripted: bool) -> None:
+        def run() -> None:
+            game = Headless(1, level, SEED) ; player = ScriptedPlayer(game, level)
+            for _ in range(self.steps): player.step() if scripted else game.step()
+        duration = best_time(run, self.repeat)
+        self.report(f'{"scripted" if scripted else "idle"}/{level:02}', self.steps / duration, 'steps/s')
+
+    def bench_sync(self, level: int) -> None:
+        listener = SyncListener()
+        def run() -> None:
+            game = Headless(1, level, SEED) ; player = ScriptedPlayer(game, level)
+            game.cave.listeners.append(listener) ; listener.on_loaded(game.cave)
+            for _ in range(self.steps): player.step() ; listener.sync()
+        duration = best_time(run, self.repeat)
+        self.report(f'sync/{level:02}', self.steps / duration, 'steps/s')
+        self.report(f'sync-events/{level:02}', listener.events / (self.steps * self.repeat), 'events/step')
+
+    def bench_explode(self) -> None:
+        # rows of wood crates across a cave, each one blowing up the next
+        from custom_tiles import WoodCrate
+        from tiles import Explosion
+        game = Headless(1, 1, SEED) ; cave = game.cave
+        def setup() -> None:
+            cave.restart_level()
+            for y in range(1, cave.height - 1, 3):
+                for x in range(1, cave.width - 1): cave.set(x, y, WoodCrate(cave, x, y))
+        def run() -> None:
+            for y in range(1, cave.height - 1, 3): cave.explode(1, y, Explosion)
+        (best, count) = (float('inf'), 0)
+        for _ in range(self.repeat):
+            setup() ; count = cave.count(WoodCrate)
+            best = min(best, best_time(run, 1))
+        self.report('explode', best * 1000, 'ms')
+        self.report('explode-crates', count, 'crates')
+
+    def bench_large(self, size: int) -> None:
+        # loading, then a few steps where insects keep hundreds of chunks active
+        pack = Cave.pack ; Cave.pack = LevelPack(compile_maps([large_map(size)]))
+        try:
+            game = Headless(1, 1, SEED)
+            self.report(f'large-load/{size}', best_time(lambda: game.cave.next_level(1), self.repeat) * 1000, 'ms')
+            best = float('inf')
+            for _ in range(self.repeat):
+                game.cave.next_level(1) ; player = ScriptedPlayer(game, size)
+                def run() -> None:
+                    for _ in range(LARGE_STEPS): player.step()
+                best = min(best, best_time(run, 1))
+            self.report(f'large-steps/{size}', LARGE_STEPS / best, 'steps/s')
+        finally: Cave.pack = pack
+
+    def bench_replay(self, level: int) -> None:
+        file_name = fixture_of(level)
+        if not os.path.exists(file_name): return
+        results = [ verify(file_name) for _ in range(self.repeat) ]
+        if not all(result['valid'] for result in results): self.mismatches.append(file_name)
+        self.report(f'replay/{level:02}', results[0]['steps'] / min(result['seconds'] for result in results), 'steps/s')
+
+    def run(self) -> None:
+        for level in self.levels: self.bench_load(level)
+        for level in self.levels: self.bench_restart(level)
+        for level in self.levels: self.bench_steps(level, False)
+        for level in self.levels: self.bench_steps(level, True)
+        for level in self.levels: self.bench_sync(level)
+        for level in self.levels: self.bench_replay(level)
+        self.bench_explode()
+        for size in self.sizes: self.bench_large(size)
+
+    def to_json(self) -> Dict:
+        return {
+            'python': platform.python_version(), 'platform': platform.platform(),
+            'seed': SEED, 'steps': self.steps, 'repeat': self.repeat, 'sizes': self.sizes, 'results': self.results, 'mismatches': self.mismatches }
+
+def compare(results: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    ''' Lists the timings worse than the baseline by more than the given tolerance (as a ratio). '''
+    regressions = []
+    for (name, result) in results.items():
+        reference = baseline['results'].get(name)
+        if reference is None or result['unit'] not in TIMING or reference['value'] == 0: continue
+        ratio = result['value'] / reference['value']
+        if not TIMING[result['unit']]: ratio = 1 / ratio if ratio > 0 else float('inf')
+        if ratio < 1 - tolerance:
+            regressions.append(f'{name} : {result["value"]} {result["unit"]} vs {reference["value"]} ({(ratio - 1) * 100:+.0f}%)')
+    return regressions
+
+def main(args: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description = 'Boulder Dash headless benchmarks')
+    parser.add_argument('--levels', type = lambda text: [ int(level) for level in text.split(',') ],
+        default = list(range(1, len(Cave.level_pack()) + 1)), help = 'comma separated levels (default : all)')
+    parser.add_argument('--steps', type = int, default = 600, help = 'simulated steps per level')
+    parser.add_argument('--large', type = lambda text: [ int(size) for size in text.split(',') if size ], default = [250, 1000],
+        help = 'comma separated sizes of the generated square caves (default : 250,1000, none if empty)')
+    parser.add_argument('--repeat', type = int, default = 3, help = 'runs per benchmark, the best one being kept')
+    parser.add_argument('--output', metavar = 'FILE', help = 'write the results as JSON (default : standard output)')
+    parser.add_argument('--baseline', metavar = 'FILE', help = 'compare the results with those of a previous run, e.g. bench_baseline.json')
+    parser.add_argument('--tolerance', type = float, default = 0.25, help = 'accepted slowdown ratio (default : 0.25)')
+    args = parser.parse_args(args)
+    benchmark = Benchmark(args.levels, args.steps, args.repeat, args.large)
+    benchmark.run()
+    output = json.dumps(benchmark.to_json(), indent = 2)
+    if args.output is None: print(output)
+    else:
+        with open(args.output, 'w') as file: file.write(output + '\n')
+    for file_name in benchmark.mismatches: print(f'MISMATCH {file_name} : replay not ending as recorded', file = sys.stderr)
+    regressions = []
+    if args.baseline is not None:
+        with open(args.baseline) as file: regressions = compare(benchmark.results, json.load(file), args.tolerance)
+    for regression in regressions: print(f'REGRESSION {regression}', file = sys.stderr)
+    return 1 if len(regressions) > 0 or len(benchmark.mismatches) > 0 else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
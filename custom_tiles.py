@@ -2,11 +2,12 @@
 
 from typing import Optional, Tuple
 import math
-from game import Interface, Sound, Player, Cave, Tile
+from engine import Interface, Sound, Player, Cave, Tile, Rule
 from tiles import ICollectable, IActivable, IRounded, IFragile, Explosion, Diamond, Weighted, Massive, Pushable, Boulder, Miner, Insect, MetalWall, Exit
 
 class BackTile(Tile):
     ''' A static background tile. Lies on the floor, below normal plates. '''
+    __slots__ = ()
     def can_break(self) -> bool:  return False
     def on_loaded(self) -> None:
         self.cave.replace(self, None)
@@ -15,30 +16,35 @@ class BackTile(Tile):
 
 class SmallDiamond(Tile, ICollectable):
     ''' A small and light diamond. Not subject to gravity. Worth lower value. '''
+    __slots__ = ()
     def can_be_occupied(self, by: Tile, _ix: int, _iy: int) -> bool: return isinstance(by, Miner)
     def collect(self) -> int:
-        Diamond.sound.play()
+        Diamond.sound.play(at = (self.x, self.y))
         if (self.x+self.y) % 2 == 0: self.cave.collected += 1
         return 1
 
 class Energizer(Diamond):
     ''' A special diamond that frightens insects for some time. A frightened insect can be killed. '''
+    __slots__ = ()
     TIME_OUT = 5
     def collect(self) -> int:
-        Player.sound.play()
+        Player.sound.play(at = (self.x, self.y))
         for insect in self.cave.tiles(Insect):
+            self.cave.touch(insect)
             insect.frightened = Energizer.TIME_OUT
             (ix,iy) = insect.dir ; insect.dir = (-ix,-iy)
         return super().collect()
 
 class Balloon(Weighted, IRounded):
     ''' A balloon tile lighter than air. Falls upwards. '''
+    __slots__ = ()
     def __init__(self, cave: Cave, x: int, y: int) -> None:
         super().__init__(cave, x, y)
         self.gravity = +1
 
 class CrackedBoulder(Boulder, IFragile):
     ''' A fragile boulder. Breaks when falling or being hit. '''
+    __slots__ = ('crack_time', 'crack_type')
     WAIT_CRACK = .125 # sec
     def __init__(self, cave: Cave, x: int, y: int, crack_type = None) -> None:
         super().__init__(cave, x, y)
@@ -67,15 +73,18 @@ class CrackedBoulder(Boulder, IFragile):
 
 class Mineral(CrackedBoulder):
     ''' A cracked fragile boulder. Turns into a diamond when it breaks. '''
+    __slots__ = ()
     sound_fall = Diamond.sound_fall
     def __init__(self, cave: Cave, x: int, y: int) -> None: super().__init__(cave, x, y, Diamond)
     def mutate(self) -> Tile: return CrackedBoulder(self.cave, self.x, self.y)
 
 class Girl(Miner):
     ''' A female miner with a different skin... '''
+    __slots__ = ()
 
 class Portal(Tile):
     ''' A gate tile that allows teleporting. Works in pairs. Objects can fall or be pushed through portals. Unbreakable. '''
+    __slots__ = ('link',)
     sound = Sound(":resources:sounds/phaseJump1.wav")
     next_link = None
     def __init__(self, cave: Cave, x: int, y: int) -> None:
@@ -90,11 +99,13 @@ class Portal(Tile):
             Portal.next_link = None
 
     def can_break(self) -> bool:  return False
-    def pos(self, _observer: Optional['Tile'], ix: int, iy: int) -> Tuple[int,int]:
+    def pos(self, observer: Optional['Tile'], ix: int, iy: int) -> Tuple[int,int]:
+        if self.link is None: return super().pos(observer, ix, iy) # without pair, leads nowhere
         return self.link.offset(ix, iy)
 
 class Crate(Pushable):
     ''' A pushable tile. Not subject to gravity. Turns into diamond when all crate targets have crates on them. '''
+    __slots__ = ('solved',)
     def __init__(self, cave: Cave, x: int, y: int) -> None:
         super().__init__(cave, x, y, 2)
         self.solved = False
@@ -103,18 +114,10 @@ class Crate(Pushable):
         self.set_skin(1 if placed else 0)
         super().on_moved(into)
 
-    @staticmethod
-    def on_global_update(cave: Cave) -> bool:
-        targets = [*cave.tiles(CrateTarget, True)]
-        if len(targets) > 0 and all(isinstance(target.neighbor(0, 0), Crate) for target in targets):
-            for crate in (target.neighbor(0, 0) for target in targets):
-                crate.solved = True
-                cave.replace(crate, Diamond)
-            Diamond.sound_explosion.play()
-
 
 class WoodCrate(Crate):
     ''' A fragile wodden crate. Explodes when hit. '''
+    __slots__ = ()
     def can_be_occupied(self, by: Tile, _ix: int, _iy: int) -> bool:
         return isinstance(by, Massive) and by.moving
     def on_destroy(self) -> None:
@@ -122,20 +125,47 @@ class WoodCrate(Crate):
 
 class MetalCrate(Crate):
     ''' A metal crate. Unbreakable. '''
+    __slots__ = ()
     def can_break(self) -> bool:  return False
 
 class CrateTarget(BackTile):
     ''' A background tile representing a target position for a crate. Crates must be placed on those tiles. '''
+    __slots__ = ()
     def is_placed(self) -> bool: return isinstance(self.neighbor(0, 0), Crate)
 
+class CrateRule(Rule):
+    ''' Turns all crates into diamonds when every crate target has a crate on it. '''
+    kinds = (Crate, CrateTarget)
+    def __init__(self, cave: Cave) -> None:
+        super().__init__(cave)
+        self.occupied = 0 # crate targets with a crate on them
+    def is_pair(self, tile: Tile, back: bool) -> bool:
+        other = self.cave.at(tile.x, tile.y, not back)
+        return isinstance(tile, CrateTarget if back else Crate) and isinstance(other, Crate if back else CrateTarget)
+    def on_added(self, tile: Tile, back: bool) -> None:
+        if self.is_pair(tile, back): self.occupied += 1
+    def on_removed(self, tile: Tile, back: bool) -> None:
+        if self.is_pair(tile, back): self.occupied -= 1
+    def update(self) -> None:
+        count = self.cave.count(CrateTarget, True)
+        if count > 0 and self.occupied == count:
+            for target in self.cave.tiles(CrateTarget, True):
+                crate = target.neighbor(0, 0)
+                self.cave.touch(crate) ; crate.solved = True
+                self.cave.replace(crate, Diamond)
+            Diamond.sound_explosion.play()
+
 class Door(MetalWall):
     ''' A generic abstract door. Can be passed through when opened. '''
+    __slots__ = ('opened',)
     def __init__(self, cave: Cave, x: int, y: int, n: int = 2) -> None:
         super().__init__(cave, x, y, n)
         self.opened = False
     def can_break(self) -> bool:  return False
     def toggle(self) -> None :
+        self.cave.touch(self)
         self.opened = not self.opened
+        self.cave.relink([self.y * self.cave.width + self.x]) # moves now lead through, or no longer
         self.next_skin()
     def pos(self, observer: Optional['Tile'], ix: int, iy: int) -> Tuple[int,int]:
         if self.opened: return self.offset(ix, iy)
@@ -143,25 +173,28 @@ class Door(MetalWall):
 
 class ActivableDoor(Door, IActivable):
     ''' A door that can be opened when activated. '''
+    __slots__ = ()
     def try_activate(self, _by: Tile, _ix:int, _iy:int) -> bool :
         self.toggle()
         return True
 
 class LockedDoor(Door):
     ''' A locked door that unlocks only when the corresponding key is collected. '''
+    __slots__ = ('id',)
     def __init__(self, cave: Cave, x: int, y: int) -> None:
         super().__init__(cave, x, y, 0)
-        self.id = len([*self.cave.tiles(LockedDoor)])
+        self.id = self.cave.count(LockedDoor)
         self.add_skin(type(self), self.id % 3)
     def unlock(self, by: Tile) -> None :
-        Exit.sound.play()
+        Exit.sound.play(at = (self.x, self.y))
         self.cave.replace(self, ActivableDoor)
 
 class Key(Tile, ICollectable):
     ''' A collectable tile representing a key. Unlocks corresponding locked doors. '''
+    __slots__ = ('id',)
     def __init__(self, cave: Cave, x: int, y: int) -> None:
         super().__init__(cave, x, y, 0)
-        self.id = len([*self.cave.tiles(Key)])
+        self.id = self.cave.count(Key)
         self.add_skin(type(self), self.id % 3)
     def can_be_occupied(self, by: Tile, _ix: int, _iy: int) -> bool: return isinstance(by, Miner)
     def collect(self) -> int :
@@ -171,13 +204,15 @@ class Key(Tile, ICollectable):
 
 class ITriggerable(Interface):
     ''' Interface. Something that can be triggered remotely. '''
+    __slots__ = ()
     def trigger(self, by: Tile) -> None: pass
 
 class TriggeredDoor(Door, ITriggerable):
     ''' A closed door that can only be opened by a remote lever. '''
+    __slots__ = ('id',)
     def __init__(self, cave: Cave, x: int, y: int) -> None:
         super().__init__(cave, x, y, 0)
-        self.id = len([*self.cave.tiles(TriggeredDoor)])
+        self.id = self.cave.count(TriggeredDoor)
         self.add_skin(type(self), self.id % 3)
         self.add_skin(Door, 1)
     def trigger(self, by: Tile) -> None :
@@ -185,21 +220,24 @@ class TriggeredDoor(Door, ITriggerable):
 
 class Lever(Tile, IActivable, IFragile):
     ''' An abstract lever tile that can be toggled by miners or falling objects. '''
+    __slots__ = ('id', 'on')
     def __init__(self, cave: Cave, x: int, y: int) -> None:
         super().__init__(cave, x, y, 0)
-        self.id = len([*self.cave.tiles(Lever)])
+        self.id = self.cave.count(Lever)
         self.add_skin(type(self), self.id % 3)
         self.add_skin(type(self), self.id % 3, True)
         self.on = False
     def try_activate(self, by: Tile, _ix:int, _iy:int) -> bool : self.toggle(by) ; return True
     def crack(self, by: Tile) -> None: self.toggle(by)
     def toggle(self, _by: Tile) -> None:
+        self.cave.touch(self)
         self.on = not self.on
         self.next_skin()
-        IFragile.sound.play()
+        IFragile.sound.play(at = (self.x, self.y))
 
 class LeverAuto(Lever):
     ''' A lever tile that can trigger its paired triggered door. '''
+    __slots__ = ()
     def toggle(self, by: Tile) -> None:
         super().toggle(by)
         for door in self.cave.tiles(TriggeredDoor):
@@ -207,16 +245,17 @@ class LeverAuto(Lever):
 
 class Letter(BackTile):
     ''' A background tile in the shape of a letter that spells out a message. '''
+    __slots__ = ('char',)
     def __init__(self, cave: Cave, x: int, y: int) -> None:
         super().__init__(cave, x, y, 0)
-        count = len([*self.cave.tiles(Letter)])
+        count = self.cave.count(Letter)
         msg = self.cave.map['message']
         self.char = msg[ count % len(msg) ].upper()
         super().add_skin(type(self), ord(self.char) - ord('A'))
 
 # Registrations
 def register(registry):
-    registry.global_updates.append(Crate.on_global_update)
+    registry.global_rules.append(CrateRule)
     registry.registered_tiles = {
         **registry.registered_tiles,
        'k': CrackedBoulder, 'n': Mineral,'c': WoodCrate, 'h': MetalCrate, '+': CrateTarget,
@@ -0,0 +1,906 @@
+﻿''' Game model of Boulder Dash : cave, tiles and players. Free of any graphics or audio dependency. '''
+
+from typing import Optional, Union, Tuple, List, Iterable, FrozenSet, Callable
+from array import array
+import time, math, heapq, itertools, operator, random, threading, zlib
+from levels import LevelPack
+
+class Sound:
+    ''' An audio media in the game. Played at moderate volume, from where it happens in the cave if located.
+        Requests are coalesced until flushed, once per frame : a sound is played at most once per frame, as loud as asked.
+        Silent until an audio backend is installed (e.g. by the windowed game), hence no-op when headless. '''
+    VOLUME = 0.5
+    backend = None # factory of playable medias from file names
+    locate = None # maps cave positions to (volume factor, pan), e.g. from the camera
+    sounds = [] # all the sounds created, to preload
+    pending = {} # sound -> (volume, pan, speed) requested since the last flush
+    lock = threading.Lock()
+
+    def __init__(self, file: str) -> None:
+        self.file = file ; self.media = None
+        Sound.sounds.append(self)
+
+    def load(self) -> None:
+        with Sound.lock:
+            if self.media is None and Sound.backend is not None:
+                self.media = Sound.backend(self.file)
+
+    def play(self, volume = VOLUME, pan: float = 0.0, loop: bool = False, speed: float = 1.0, at: Optional[Tuple[int,int]] = None):
+        if Sound.backend is None: return None
+        if loop: # e.g. music, played right away and controlled by the caller
+            if self.media is None: self.load()
+            return self.media.play(volume, pan, loop, speed)
+        if at is not None and Sound.locate is not None:
+            (factor, pan) = Sound.locate(*at) ; volume *= factor
+            if volume <= 0: return None # too far out of view
+        request = Sound.pending.get(self)
+        if request is None or volume > request[0]: Sound.pending[self] = (volume, pan, speed)
+        return None
+
+    @staticmethod
+    def flush() -> None:
+        (pending, Sound.pending) = (Sound.pending, {})
+        for (sound, (volume, pan, speed)) in pending.items():
+            if sound.media is None: sound.load()
+            sound.media.play(volume, pan, False, speed)
+
+    @staticmethod
+    def preload() -> threading.Thread:
+        ''' Loads all the sounds created so far, in a background thread, so as not to stall the game when first played. '''
+        def run() -> None:
+            for sound in list(Sound.sounds): sound.load()
+        thread = threading.Thread(target = run, name = 'sounds', daemon = True) ; thread.start()
+        return thread
+
+class Interface:
+    ''' Pure abstract. To distinguish from standard classes. '''
+    __slots__ = ()
+
+class Tile:
+    ''' A tile in the game's cave. Manages skins, positioning, basic movement, timings, and update.
+        Skins are kept as (kind, index, flip_h, flip_v) descriptions, textures being left to the renderer.
+        Tiles have no __dict__ : subclasses declare the fields they add in __slots__. '''
+    __slots__ = ('cave', 'back', 'x', 'y', 'dir', 'skins', 'nb_skins', 'skin', 'wait', 'speed', 'moved', 'moving', 'priority')
+    fields = __slots__ # of the type, including inherited ones
+    values = operator.attrgetter(*__slots__)
+
+    DEFAULT_SPEED = 10 # squares per second
+    PRIORITY_HIGH = 0
+    PRIORITY_MEDIUM = 1
+    PRIORITY_LOW = 2
+
+    registered_tiles = {}
+    global_rules = [] # types of the rules applying to whole caves
+    kinds = [None] # all tile types, indexed by their code in cave grids (0 being the empty tile)
+    kinds_codes = {}
+
+    acting = False # whether the tile type does anything when updated
+    per_frame = False # whether the tile type needs to be updated every frame, even while waiting
+    redirecting = False # whether the tiles of the type change the moves into them, e.g. portals (see pos)
+    plain = False # whether the tiles of the type are plain static cells, only created once needed (not inherited)
+    awakens = 0 # in large caves, radius (in chunks) of the region kept simulated around the tiles of the type
+
+    def __init_subclass__(cls, **kwargs) -> None:
+        super().__init_subclass__(**kwargs)
+        cls.code = len(Tile.kinds) ; Tile.kinds.append(cls)
+        Tile.kinds_codes.clear()
+        cls.per_frame = cls.on_update is not Tile.on_update
+        cls.acting = cls.per_frame or cls.tick is not Tile.tick
+        cls.redirecting = cls.pos is not Tile.pos
+        cls.plain = cls.__dict__.get('plain', False) and not cls.acting and not cls.redirecting and cls.on_loaded is Tile.on_loaded
+        cls.fields = tuple(field for klass in reversed(cls.__mro__) for field in klass.__dict__.get('__slots__', ()))
+        cls.values = operator.attrgetter(*cls.fields)
+
+    @staticmethod
+    def codes_of(kind: type) -> FrozenSet[int]:
+        codes = Tile.kinds_codes.get(kind)
+        if codes is None:
+            codes = Tile.kinds_codes[kind] = frozenset(k.code for k in Tile.kinds[1:] if issubclass(k, kind))
+        return codes
+
+    def __init__(self, cave: 'Cave', x: int, y: int, n: int = 1) -> None:
+        self.cave = cave ; self.back = False ; self.x = x ; self.y = y ; self.dir = (0, 0)
+        self.skins = [] ; self.nb_skins = 0 ; self.skin = None
+        if n > 0: self.add_skins(type(self), range(n))
+        self.wait = 0 ; self.speed = Tile.DEFAULT_SPEED
+        self.moved = self.moving = False ; self.priority = Tile.PRIORITY_MEDIUM
+
+    def add_skins(self, kind: Union[str, type], rng: Iterable[int], flip_h: bool = False, flip_v: bool = False) -> None:
+        self.skins += [(kind, i, flip_h, flip_v) for i in rng]
+        self.nb_skins = len(self.skins)
+        if self.skin is None and self.nb_skins > 0: self.set_skin(0)
+    def add_skin(self, kind: Union[str, type], num: int, flip_h: bool = False, flip_v: bool = False) -> None:
+        self.add_skins(kind, [num], flip_h, flip_v)
+    def set_skin(self, i: int) -> None:
+        if i == self.skin: return
+        if self.skin is not None: self.cave.touch(self)
+        self.skin = i
+        for listener in self.cave.listeners: listener.on_changed(self)
+    def next_skin(self) -> None: self.set_skin( (self.skin+1) % self.nb_skins )
+
+    def get_state(self) -> dict:
+        ''' The values of the fields of the tile, by name. '''
+        try: return dict(zip(self.fields, self.values(self)))
+        except AttributeError: # not all set yet
+            return { field: getattr(self, field) for field in self.fields if hasattr(self, field) }
+    def set_state(self, state: dict) -> None:
+        for field in self.fields:
+            if field in state: setattr(self, field, state[field])
+            elif hasattr(self, field): delattr(self, field)
+
+    def focus(self, speed = 1) -> None:
+        self.cave.game.center_on(self.x + 0.5, self.y + 0.5, speed)
+
+    def pos(self, _observer: Optional['Tile'], _ix: int, _iy: int) -> Tuple[int,int]:
+        # where a move into the tile leads, the tile itself by default : a type changing it must have the cave relink
+        # the cell when the result changes, as the moves by one step are looked up in the neighbor table of the cave
+        return (self.x ,self.y)
+    def offset(self, ix: int, iy: int) -> Tuple[int,int]:
+        cave = self.cave ; slot = Cave.SLOTS.get((ix, iy))
+        if slot is not None and cave.links is not None and 0 <= self.x < cave.width and 0 <= self.y < cave.height:
+            i = cave.links[slot * cave.size + self.y * cave.width + self.x] # one step, as in the neighbor table
+            if i >= 0: (y, x) = divmod(i, cave.width) ; return (x, y)
+        return cave.resolve(self, self.x, self.y, ix, iy)
+    def neighbor(self, ix: int, iy: int) -> Optional['Tile'] :
+        cave = self.cave ; (x, y) = self.offset(ix, iy) # already wrapped
+        return cave.front.get(y * cave.width + x) if 0 <= x < cave.width and 0 <= y < cave.height else None
+
+    def is_kind_of(self, cond: Optional[Union[int, type]]):
+        return cond is None or (isinstance(cond, type) and isinstance(self, cond)) or self.priority == cond
+
+    def can_move(self, ix: int, iy: int)  -> bool:
+        return self.cave.can_move(self, ix, iy)
+
+    def try_move(self, ix: int, iy: int) -> bool:
+        self.dir = (ix, iy)
+        if self.cave.try_move(self, ix, iy):
+            self.moved = True
+            return self.try_wait()
+        return False
+
+    def try_wait(self) -> bool:
+        self.wait = 1 / self.speed
+        return True
+
+    def on_update(self, delta_time: float = 1/60) -> None:
+        if self.wait > 0:  self.wait -= delta_time
+        else: self.moved = False ; self.tick() ; self.moving = self.moved
+
+    def tick(self): pass
+    def is_idle(self) -> bool: return False
+    def is_steady(self) -> bool: return self.is_idle() # idle but for random draws, e.g. animations (see Scheduler.drowsy)
+    def can_be_occupied(self, _by: 'Tile', _ix: int, _iy: int) -> bool: return False
+    def on_moved(self, _into: Optional['Tile']) -> None: pass
+    def can_break(self) -> bool:  return True
+    def on_destroy(self) -> None: pass
+    def on_loaded(self) -> None: pass
+
+class Unknown(Tile):
+    ''' Typically used to represent a tile not yet implemented. '''
+    __slots__ = ()
+    def __init__(self, cave: 'Cave', x: int, y: int) -> None: super().__init__(cave, x, y)
+
+class Player:
+    ''' A player in the Boulder Dash game. Handles score and lifes. Directions are set by whoever controls it. '''
+    SCORE_FOR_LIFE = 100
+    sound = Sound(":resources:sounds/laser1.wav")
+
+    def __init__(self, game: 'Game', num: int = 0) -> None:
+        self.game = game ; self.num = num; self._score = 0 ; self.life = 3
+        self.directions = []
+
+    def list_directions(self) -> List[Tuple[int,int]]:
+        return self.directions
+
+    @property
+    def score(self) -> int: return self._score
+    @score.setter
+    def score(self, value : int) -> None:
+        n = self._score // Player.SCORE_FOR_LIFE
+        self._score = value
+        if self._score // Player.SCORE_FOR_LIFE > n and self.life < 9:
+            self.life += 1
+            Player.sound.play()
+
+    def kill(self) -> None:
+        self.life -= 1
+        if any(p.life > 0 for p in self.game.players):
+            self.game.cave.set_status(Cave.FAILED)
+        else:
+            self.game.cave.set_status(Cave.GAME_OVER)
+            self.game.over()
+
+class Geometry:
+    ''' Defines how the space wraps around. By default, it doesn't. '''
+    def wrap(self, x: int, y: int, _w:int, _h: int) -> Tuple[int,int] : return (x, y)
+
+class Torus(Geometry):
+    ''' On a torus, opposite sides are identified. '''
+    def wrap(self, x: int, y: int, w:int, h: int) -> Tuple[int,int] : return (x%w, y%h)
+
+class Grid:
+    ''' A layer of tiles, stored as a flat array of type codes plus a sparse table of the tile objects,
+        and indexed by tile type to find the tiles of a kind without scanning the whole layer.
+        Plain static cells may have a code but no object yet : it is created by the factory once needed, unless only the
+        behaviour of the tile matters, which a tile shared by all the cells of the type (a flyweight) stands for. '''
+
+    def __init__(self, width: int, height: int, factory: Optional[Callable[[type, int], 'Tile']] = None) -> None:
+        self.width = width ; self.height = height ; self.factory = factory
+        self.codes = array('B', bytes(width * height)) # up to 255 tile types
+        self.objects = {}
+        self.index = [ {} for _ in Tile.kinds ] # by type code, the tiles of that exact type by position
+        self.lazy = [ 0 for _ in Tile.kinds ] # by type code, the number of cells of that type without object yet
+        self.flyweights = [ None for _ in Tile.kinds ] # by type code, created once needed
+        self.journal = {} # position -> tile there when first set since the journal was last flushed
+
+    def materialize(self, i: int) -> 'Tile':
+        code = self.codes[i] ; tile = self.factory(Tile.kinds[code], i)
+        self.objects[i] = self.index[code][i] = tile ; self.lazy[code] -= 1
+        return tile
+
+    def get(self, i: int) -> Optional['Tile']:
+        tile = self.objects.get(i)
+        return self.materialize(i) if tile is None and self.codes[i] else tile
+
+    def flyweight(self, code: int) -> 'Tile':
+        tile = self.flyweights[code]
+        if tile is None: tile = self.flyweights[code] = self.factory(Tile.kinds[code], -1) # out of the grid
+        return tile
+
+    def materialize_all(self, codes: Iterable[int]) -> None:
+        for code in codes:
+            if self.lazy[code] == 0: continue
+            buffer = self.codes.tobytes() ; i = buffer.find(code)
+            while i >= 0:
+                if i not in self.objects: self.materialize(i)
+                i = buffer.find(code, i + 1)
+
+    def count(self, kind: Optional[type]) -> int:
+        if kind is None: return self.codes.count(0)
+        return sum(len(self.index[code]) + self.lazy[code] for code in Tile.codes_of(kind))
+
+    def find(self, kind: Optional[type]) -> List[int]:
+        if kind is not None:
+            self.materialize_all(Tile.codes_of(kind))
+            return sorted(i for code in Tile.codes_of(kind) for i in self.index[code])
+        buffer = self.codes.tobytes() ; indices = [] ; i = buffer.find(0)
+        while i >= 0: indices.append(i) ; i = buffer.find(0, i + 1)
+        return indices
+
+    def tiles(self, kind: type) -> List['Tile']:
+        codes = Tile.codes_of(kind) ; self.materialize_all(codes)
+        if len(codes) == 1:
+            tiles = self.index[next(iter(codes))] ; return [ tiles[i] for i in sorted(tiles) ]
+        return [ tile for (_, tile) in sorted((i, tile) for code in codes for (i, tile) in self.index[code].items()) ]
+
+class CaveListener:
+    ''' Pure abstract. Gets notified of the changes in a cave, e.g. to render it. '''
+    def on_added(self, _tile: Tile, _back: bool) -> None: pass
+    def on_removed(self, _tile: Tile, _back: bool) -> None: pass
+    def on_changed(self, _tile: Tile) -> None: pass
+    def on_step(self, _cave: 'Cave') -> None: pass
+
+class Rule:
+    ''' A global rule of a cave, e.g. transforming all the tiles of a kind at once. Follows the tiles it watches through
+        their placement, removal and state changes, and keeps counters up to date, so as to be checked in constant time.
+        Its state only changes when notified (so that the cave journals it), its update acting on the tiles only. '''
+    kinds = () # watched tile types
+
+    def __init__(self, cave: 'Cave') -> None: self.cave = cave
+    def on_added(self, _tile: Tile, _back: bool) -> None: pass
+    def on_removed(self, _tile: Tile, _back: bool) -> None: pass
+    def on_changed(self, _tile: Tile) -> None: pass
+    def update(self) -> None: pass
+
+class Chunks:
+    ''' The division of a large cave into square chunks, of which only the active ones are simulated : those around
+        the tiles in motion, and those in the regions kept awake by some tiles (e.g. miners). Tiles elsewhere are dormant,
+        frozen in time until their chunk gets active again. Activity only depends on the tiles, not on the history. '''
+
+    SIZE = 16 # tiles
+
+    def __init__(self, cave: 'Cave') -> None:
+        self.cave = cave
+        self.width = -(-cave.width // Chunks.SIZE) ; self.height = -(-cave.height // Chunks.SIZE)
+        self.active = set()
+        self.woken = set() # active chunks whose dormant tiles were woken up, none dormant there since
+
+    def at(self, x: int, y: int) -> int: return (y // Chunks.SIZE) * self.width + x // Chunks.SIZE
+
+    def of(self, i: int) -> int:
+        (y, x) = divmod(i, self.cave.width)
+        return self.at(x, y)
+
+    def is_active(self, i: int) -> bool: return self.of(i) in self.active
+
+    def cells(self, chunk: int) -> Iterable[int]:
+        (cy, cx) = divmod(chunk, self.width) ; (x, y) = (cx * Chunks.SIZE, cy * Chunks.SIZE) ; cave = self.cave
+        for ny in range(y, min(y + Chunks.SIZE, cave.height)):
+            yield from range(ny * cave.width + x, ny * cave.width + min(x + Chunks.SIZE, cave.width))
+
+    def activate(self, x: int, y: int, radius: int) -> None:
+        (cx, cy) = (x // Chunks.SIZE, y // Chunks.SIZE) ; geometry = self.cave.geometry
+        if not self.cave.wraps: # a rectangle of chunks, clipped to the cave
+            for ny in range(max(cy - radius, 0), min(cy + radius + 1, self.height)):
+                row = ny * self.width ; self.active.update(range(row + max(cx - radius, 0), row + min(cx + radius + 1, self.width)))
+            return
+        for ny in range(cy - radius, cy + radius + 1):
+            for nx in range(cx - radius, cx + radius + 1):
+                (wx, wy) = geometry.wrap(nx, ny, self.width, self.height) # chunks wrap around as the cave does
+                if 0 <= wx < self.width and 0 <= wy < self.height: self.active.add(wy * self.width + wx)
+
+    def update(self, scheduler: 'Scheduler') -> None:
+        self.active = set() ; centers = set() # chunks of the moving tiles already handled
+        for tiles in [ *scheduler.awake, scheduler.parked ]:
+            for tile in tiles:
+                if tile.awakens > 0: self.activate(tile.x, tile.y, tile.awakens)
+                elif tile.moving: # with the chunks it may move into
+                    chunk = self.at(tile.x, tile.y)
+                    if chunk not in centers: centers.add(chunk) ; self.activate(tile.x, tile.y, 1)
+
+class Scheduler:
+    ''' Updates the tiles of a cave, by priority then in grid order. Only tiles with something to do are visited :
+        static tiles are never scheduled, waiting tiles are parked on a timer wheel until their wait expires,
+        and idle tiles sleep until a tile around them is set. In large caves, awake tiles in inactive chunks are dormant,
+        set aside until their chunk gets active again. '''
+
+    WHEEL_SIZE = 64 # frames
+    SLEEPING = True # let idle tiles sleep (otherwise, they are updated every frame)
+    PHASES = ['tiles/high', 'tiles/medium', 'tiles/low'] # by priority, for profiling
+
+    def __init__(self, cave: 'Cave') -> None:
+        self.cave = cave ; self.frame = 0 ; self.delta_time = 1/60
+        self.awake = [set(), set(), set()] # by priority
+        self.sleeping = set()
+        self.dormant = set()
+        self.parked = {} # tile -> (due frame, parked frame, wait)
+        self.wheel = [[] for _ in range(Scheduler.WHEEL_SIZE)]
+        self.delays = {} # (wait, delta_time) -> frames to wait
+        self.journal = None # tile -> its place when first moved since the journal was taken, if tracked
+        self.drowsy = False # let steady tiles sleep too : faster, but their random draws skipped, e.g. for searches
+        self.heap = None ; self.priority = None ; self.cursor = -1 ; self.seq = itertools.count()
+
+    def index(self, tile: Tile) -> int: return tile.y * self.cave.width + tile.x
+
+    def place(self, tile: Tile) -> Tuple:
+        # the awake set holding a tile (whatever its priority now, e.g. once reverted), and whether it sleeps, is dormant or parked
+        awake = next((priority for (priority, tiles) in enumerate(self.awake) if tile in tiles), None)
+        return (awake, tile in self.sleeping, tile in self.dormant, self.parked.get(tile))
+
+    def put(self, tile: Tile, place: Tuple) -> None:
+        (awake, sleeping, dormant, parking) = place
+        for (priority, tiles) in enumerate(self.awake):
+            if priority == awake: tiles.add(tile)
+            else: tiles.discard(tile)
+        if sleeping: self.sleeping.add(tile)
+        else: self.sleeping.discard(tile)
+        if dormant:
+            self.dormant.add(tile)
+            if self.cave.chunks is not None: self.cave.chunks.woken.discard(self.cave.chunks.at(tile.x, tile.y))
+        else: self.dormant.discard(tile)
+        if parking is not None: self.parked[tile] = parking
+        else: self.parked.pop(tile, None)
+
+    def touch(self, tile: Tile) -> None:
+        if tile not in self.journal: self.journal[tile] = self.place(tile)
+
+    def schedule(self, tile: Tile, i: int) -> None:
+        if self.journal is not None: self.touch(tile)
+        self.sleeping.discard(tile) ; self.dormant.discard(tile)
+        self.unpark(tile)
+        self.awake[tile.priority].add(tile)
+        if self.heap is not None and tile.priority == self.priority and i > self.cursor and (self.cave.chunks is None or self.cave.chunks.is_active(i)):
+            heapq.heappush(self.heap, (i, next(self.seq), tile))
+
+    def park(self, tile: Tile) -> None:
+        key = (tile.wait, self.delta_time) ; frames = self.delays.get(key)
+        if frames is None:
+            # count frames as Tile.on_update would decrement the wait, rounding errors included
+            (wait, frames) = key[0], 0
+            while wait > 0: wait -= self.delta_time ; frames += 1
+            self.delays[key] = frames
+        due = self.frame + frames + 1
+        if self.journal is not None: self.touch(tile)
+        self.awake[tile.priority].discard(tile)
+        self.parked[tile] = (due, self.frame, tile.wait)
+        self.wheel[due % Scheduler.WHEEL_SIZE].append((due, tile))
+
+    def unpark(self, tile: Tile) -> None:
+        parking = self.parked.get(tile)
+        if parking is None: return
+        if self.journal is not None: self.touch(tile)
+        del self.parked[tile] ; self.cave.touch(tile)
+        (_, frame, wait) = parking
+        elapsed = self.frame - frame - (1 if self.priority is None or self.priority <= tile.priority else 0)
+        for _ in range(elapsed): wait -= self.delta_time
+        tile.wait = wait
+
+    def on_set(self, x: int, y: int, i: int, current: Optional[Tile], tile: Optional[Tile]) -> None:
+        if current is not None and current.acting:
+            if self.journal is not None: self.touch(current)
+            self.sleeping.discard(current) ; self.dormant.discard(current) ; self.unpark(current)
+        if tile is not None and tile.acting: self.schedule(tile, i)
+        if self.sleeping:
+            cave = self.cave
+            for ny in (y - 1, y, y + 1):
+                for nx in (x - 1, x, x + 1):
+                    neighbor = cave.peek(nx, ny)
+                    if neighbor in self.sleeping: self.schedule(neighbor, self.index(neighbor))
+
+    def settle(self, tile: Tile) -> None:
+        if self.cave.at(tile.x, tile.y) is not tile:
+            if self.journal is not None: self.touch(tile)
+            self.awake[tile.priority].discard(tile)
+        elif tile.per_frame: pass
+        elif tile.wait > 0: self.park(tile)
+        elif Scheduler.SLEEPING and (tile.is_idle() or self.drowsy and tile.is_steady()):
+            if self.journal is not None: self.touch(tile)
+            self.awake[tile.priority].discard(tile) ; self.sleeping.add(tile)
+
+    def save(self) -> Tuple:
+        return (self.frame, [ set(awake) for awake in self.awake ], set(self.sleeping), set(self.dormant), dict(self.parked),
+            [ list(slot) for slot in self.wheel ])
+
+    def restore(self, state: Tuple) -> None:
+        if self.journal is not None:
+            for tile in set().union(*self.awake, self.sleeping, self.dormant, self.parked, *state[1], state[2], state[3], state[4]):
+                self.touch(tile)
+        if self.cave.chunks is not None: self.cave.chunks.woken = set()
+        (self.frame, awake, sleeping, dormant, parked, wheel) = state
+        self.awake = [ set(tiles) for tiles in awake ] ; self.sleeping = set(sleeping) ; self.dormant = set(dormant)
+        self.parked = dict(parked)
+        self.wheel = [ list(slot) for slot in wheel ]
+
+    def rebuild_wheel(self) -> None:
+        self.wheel = [[] for _ in range(Scheduler.WHEEL_SIZE)]
+        for (tile, (due, _, _)) in self.parked.items(): self.wheel[due % Scheduler.WHEEL_SIZE].append((due, tile))
+
+    def update_chunks(self, chunks: 'Chunks') -> None:
+        # awake tiles in inactive chunks become dormant, dormant tiles in active chunks wake up
+        chunks.update(self)
+        for awake in self.awake:
+            frozen = [ tile for tile in awake if chunks.at(tile.x, tile.y) not in chunks.active ]
+            if self.journal is not None:
+                for tile in frozen: self.touch(tile)
+            awake.difference_update(frozen) ; self.dormant.update(frozen)
+        # only the chunks just activated may hold dormant tiles
+        fresh = chunks.active - chunks.woken if self.dormant else () ; chunks.woken = chunks.active
+        if len(self.dormant) < len(fresh) * Chunks.SIZE ** 2:
+            woken = [ tile for tile in self.dormant if chunks.at(tile.x, tile.y) in fresh ]
+        else: # fewer cells to look at
+            objects = self.cave.front.objects
+            woken = [ tile for chunk in fresh for tile in map(objects.get, chunks.cells(chunk)) if tile in self.dormant ]
+        if self.journal is not None:
+            for tile in woken: self.touch(tile)
+        for tile in woken: self.dormant.discard(tile) ; self.awake[tile.priority].add(tile)
+
+    def update(self, delta_time: float) -> None:
+        self.frame += 1 ; self.delta_time = delta_time
+        slot = self.wheel[self.frame % Scheduler.WHEEL_SIZE]
+        if slot:
+            self.wheel[self.frame % Scheduler.WHEEL_SIZE] = [entry for entry in slot if entry[0] > self.frame]
+            for (due, tile) in slot:
+                parking = self.parked.get(tile)
+                if due == self.frame and parking is not None and parking[0] == due:
+                    self.unpark(tile) ; self.awake[tile.priority].add(tile)
+        objects = self.cave.front.objects ; profiler = self.cave.profiler ; touched = self.cave.touched
+        chunks = self.cave.chunks
+        if chunks is not None: self.update_chunks(chunks)
+        for priority in [Tile.PRIORITY_HIGH, Tile.PRIORITY_MEDIUM, Tile.PRIORITY_LOW]:
+            if profiler is not None: start_time = time.perf_counter()
+            elif not self.awake[priority]: continue # nothing to update, nor to time
+            self.heap = [(self.index(tile), next(self.seq), tile) for tile in self.awake[priority]]
+            heapq.heapify(self.heap)
+            self.priority = priority ; self.cursor = -1
+            while self.heap:
+                (i, _, tile) = heapq.heappop(self.heap)
+                if i == self.cursor: continue
+                if objects.get(i) is not tile:
+                    if self.cave.at(tile.x, tile.y) is not tile:
+                        if self.journal is not None: self.touch(tile)
+                        self.awake[priority].discard(tile)
+                    continue
+                self.cursor = i
+                if tile not in touched: self.cave.touch(tile)
+                if profiler is not None: profiler.tick(type(tile))
+                tile.on_update(delta_time)
+                self.settle(tile)
+            if profiler is not None: profiler.add(Scheduler.PHASES[priority], time.perf_counter() - start_time)
+        self.heap = None ; self.priority = None
+
+class Cave:
+    ''' The grid of tiles in which the game is played. Manages map loading and tiles updates. '''
+
+    WIDTH_MAX = 40
+    WIDTH_MIN = 20
+    HEIGHT_MAX = 22
+    HEIGHT_MIN = 12
+    LARGE = WIDTH_MAX * HEIGHT_MAX # tiles, beyond which a cave is only simulated in its active chunks
+
+    STARTING = 0
+    IN_PROGRESS = 1
+    PAUSED = 2
+    SUCCEEDED = 3
+    NOT_LOADED = -1
+    FAILED = -2
+    GAME_OVER = -3
+
+    WAIT_STATUS = 0.75 # seconds
+    DEFAULT_MAXTIME = 120 # seconds
+    STEP = 1/60 # seconds, fixed simulation time step
+    STEPS = ((0,-1), (-1,0), (+1,0), (0,+1)) # moves by one cell, by slot in the neighbor table
+    SLOTS = { step: slot for (slot, step) in enumerate(STEPS) }
+    MAX_STEPS = 5 # per update, beyond which the simulation slows down rather than catching up
+
+    def __init__(self, game: 'Game', level: int = 1, seed: Optional[int] = None) -> None:
+        self.game = game ; self.listeners = [] ; self.profiler = None
+        self.seed = seed if seed is not None else random.randrange(2**32)
+        self.random = random.Random(self.seed) ; self.lag = 0
+        self.to_collect = 0 ; self.collected = 0
+        self.status = Cave.NOT_LOADED ; self.wait = 0
+        self.front = self.back = Grid(0, 0) ; self.scheduler = Scheduler(self) ; self.chunks = None
+        self.rules = [] ; self.watchers = [ [] for _ in Tile.kinds ]
+        self.miner_type = None ; self.geometry = None ; self.wraps = False
+        self.height = self.width = self.size = 0 ; self.map = None
+        self.links = None ; self.redirects = set() # neighbor table, and the cells of the tiles redirecting moves
+        self.snapshot = None ; self.touched = {} # tile -> its state when first changed since the journal was last flushed
+        self.since_snapshot = ({}, {}, {}) ; self.since_delta = None # flushed journals : front and back positions, tile states
+        self.rule_states = None # rule -> its state when first notified since the last delta, if tracked
+        self.time_remaining = 0
+        self.next_level(level)
+
+    pack = None # levels of the game, loaded on first use
+    GEOMETRIES = { 'Geometry': Geometry, 'Torus': Torus }
+
+    @staticmethod
+    def level_pack() -> LevelPack:
+        pack = Cave.pack
+        if pack is None: pack = Cave.pack = LevelPack.default()
+        if pack.types is None:
+            register_tiles()
+            types = { ' ': None, '_': None, **Tile.registered_tiles }
+            pack.types = [ types[key] if key in types else Unknown for key in pack.palette ]
+            pack.named_types = { tile_type.__name__: tile_type for tile_type in Tile.registered_tiles.values() }
+        return pack
+
+    def load(self) -> None:
+        pack = Cave.level_pack() ; level = pack[self.level - 1]
+        self.random.seed(self.seed) ; self.lag = 0
+        self.to_collect = 0 ; self.collected = 0
+        if self.status != Cave.GAME_OVER: self.status = Cave.STARTING
+        self.wait = 0
+        self.map = level.meta
+        self.miner_type = pack.named_types[self.map['miner'] if 'miner' in self.map else 'Miner']
+        self.height = level.height
+        self.width = level.width
+        self.size = self.width * self.height
+        self.links = None ; self.redirects = set()
+        self.to_collect = self.map['goal']
+        self.geometry = Cave.GEOMETRIES[self.map['geometry']]() if 'geometry' in self.map else Geometry()
+        self.wraps = type(self.geometry).wrap is not Geometry.wrap
+        self.time_remaining = self.map['time'] if 'time' in self.map else Cave.DEFAULT_MAXTIME
+        self.front = Grid(self.width, self.height, self.create)
+        self.back = Grid(self.width, self.height, self.create)
+        self.scheduler = Scheduler(self)
+        self.chunks = Chunks(self) if self.width * self.height > Cave.LARGE else None
+        self.rules = [ rule(self) for rule in Tile.global_rules ]
+        self.watchers = [ [] for _ in Tile.kinds ] # by type code, the rules to notify
+        for rule in self.rules:
+            for code in set().union(*(Tile.codes_of(kind) for kind in rule.kinds)): self.watchers[code].append(rule)
+        (cells, types) = (bytes(level.cells), pack.types)
+        # plain static cells only get their code, the other tiles are created and set in order, top row first
+        lazy = [ tile_type.code if tile_type is not None and tile_type.plain and not self.watchers[tile_type.code] else 0 for tile_type in types ]
+        eager = [ 1 if tile_type is not None and code == 0 else 0 for (tile_type, code) in zip(types, lazy) ]
+        codes = cells.translate(bytes(lazy + [0] * (256 - len(lazy)))) ; marks = cells.translate(bytes(eager + [0] * (256 - len(eager))))
+        self.front.codes = array('B', codes)
+        for code in set(lazy) - {0}: self.front.lazy[code] = codes.count(code)
+        for y in reversed(range(self.height)):
+            (row, end) = (y * self.width, (y + 1) * self.width) ; i = marks.find(1, row, end)
+            while i >= 0:
+                (x, tile_type) = (i - row, types[cells[i]]) ; self.set(x, y, tile_type(self, x, y))
+                i = marks.find(1, i + 1, end)
+        self.build_links()
+        for (_, tile) in sorted(self.front.objects.items()): tile.on_loaded() # plain tiles do nothing when loaded
+        self.take_snapshot()
+        self.game.on_loaded()
+
+    def take_snapshot(self) -> None:
+        # copy-on-write : only the positions set and the tiles changed from now on are journaled
+        self.front.journal = {} ; self.back.journal = {} ; self.touched = {}
+        self.since_snapshot = ({}, {}, {})
+        if self.since_delta is not None: self.since_delta = ({}, {}, {})
+        self.snapshot = (self.level, self.wait, self.to_collect, self.collected, self.time_remaining, self.random.getstate(),
+            self.scheduler.save(), [ dict(rule.__dict__) for rule in self.rules ])
+
+    def restore_snapshot(self) -> None:
+        (_, self.wait, self.to_collect, self.collected, self.time_remaining, state, scheduler, rules) = self.snapshot
+        if self.status != Cave.GAME_OVER: self.status = Cave.STARTING
+        self.random.setstate(state) ; self.lag = 0
+        self.flush_journal()
+        self.revert(*self.since_snapshot)
+        self.flush_journal(False) ; self.since_snapshot = ({}, {}, {})
+        self.scheduler.restore(scheduler)
+        for (rule, state) in zip(self.rules, rules): self.touch_rule(rule) ; rule.__dict__.update(state)
+
+    def flush_journal(self, since_snapshot: bool = True) -> None:
+        # merges the journal into the changes since the snapshot (and since the last delta if tracked), keeping the oldest entries
+        journal = (self.front.journal, self.back.journal, self.touched)
+        for merged in (self.since_snapshot if since_snapshot else None, self.since_delta):
+            if merged is None: continue
+            for (entries, new_entries) in zip(merged, journal):
+                if len(entries) == 0: entries.update(new_entries)
+                else:
+                    for (key, value) in new_entries.items(): entries.setdefault(key, value)
+        self.front.journal = {} ; self.back.journal = {} ; self.touched = {}
+
+    def take_delta(self) -> Tuple[dict, dict, dict, dict, dict]:
+        # the previous tiles at the positions set, the previous states of the tiles changed, the previous places of the
+        # tiles moved in the scheduler and the previous states of the rules notified, since the last call
+        if self.since_delta is None: self.since_delta = ({}, {}, {})
+        self.flush_journal()
+        (delta, self.since_delta) = (self.since_delta, ({}, {}, {}))
+        (places, self.scheduler.journal) = (self.scheduler.journal or {}, {})
+        (rules, self.rule_states) = (self.rule_states or {}, {})
+        return (*delta, places, rules)
+
+    def stop_deltas(self) -> None: self.since_delta = self.scheduler.journal = self.rule_states = None
+
+    def revert(self, front: dict, back: dict, states: dict) -> None:
+        # sets back tiles and tile states, as journaled, and notifies the listeners of the differences
+        (removed, added) = ([], [])
+        relinked = [ tile.y * self.width + tile.x for tile in states if tile.redirecting and not tile.back ]
+        for (grid, positions, is_back) in [(self.front, front, False), (self.back, back, True)]:
+            for (i, tile) in positions.items():
+                current = grid.objects.get(i)
+                if current is tile: continue
+                if not is_back and (current is not None and current.redirecting or tile is not None and tile.redirecting): relinked.append(i)
+                if i not in grid.journal: grid.journal[i] = current
+                if current is not None: del grid.index[current.code][i] ; self.touch(current) ; removed.append((current, is_back))
+                if tile is None: del grid.objects[i] ; grid.codes[i] = 0
+                else: grid.objects[i] = tile ; grid.codes[i] = tile.code ; grid.index[tile.code][i] = tile ; added.append((tile, is_back))
+        for (tile, state) in states.items():
+            self.touch(tile) ; tile.set_state(state)
+        if relinked: self.relink(relinked)
+        for listener in self.listeners:
+            for (tile, is_back) in removed: listener.on_removed(tile, is_back)
+            for (tile, is_back) in added: listener.on_added(tile, is_back)
+            for tile in states: listener.on_changed(tile)
+
+    def next_level(self, level : Optional[int] = None) -> None:
+        self.level = self.level + 1 if level is None else level
+        nb_levels = len(Cave.level_pack())
+        if self.level < 1 : self.level += nb_levels
+        elif self.level > nb_levels : self.level -= nb_levels
+        self.load()
+
+    def restart_level(self) -> None:
+        if self.snapshot is not None and self.snapshot[0] == self.level: self.restore_snapshot()
+        else: self.next_level(self.level)
+
+    def is_complete(self) -> bool:
+        return self.collected >= self.to_collect
+
+    def pause(self) -> None:
+        if self.status == Cave.IN_PROGRESS: self.status = Cave.PAUSED
+        elif self.status == Cave.PAUSED: self.status = Cave.IN_PROGRESS
+
+    def set_status(self, status) -> None:
+        self.status = status
+        self.wait = Cave.WAIT_STATUS
+
+    def wrap(self, x:int, y:int) -> Tuple[int,int]:
+        return self.geometry.wrap(x, y, self.width, self.height)
+
+    def within_bounds(self, x: int ,y: int) -> bool:
+        return 0 <= x < self.width and 0 <= y < self.height
+
+    def cell(self, x: int, y: int) -> int:
+        # index in the grids of a position, -1 if out of them
+        if self.wraps: (x, y) = self.geometry.wrap(x, y, self.width, self.height)
+        return y * self.width + x if 0 <= x < self.width and 0 <= y < self.height else -1
+
+    def resolve(self, observer: Optional['Tile'], x: int, y: int, ix: int, iy: int) -> Tuple[int,int]:
+        ''' The position reached by a move from a position, through the tiles redirecting moves, without the table. '''
+        (x, y) = self.wrap(x + ix, y + iy) ; tile = self.peek(x, y)
+        return (x, y) if tile is None or not tile.redirecting else tile.pos(observer, ix, iy)
+
+    def build_links(self) -> None:
+        ''' Fills the neighbor table : by slot of move (see STEPS) then cell, the cell reached, wrapped and through the
+            tiles redirecting moves, or -1 if out of the grids (looked up the slow way). '''
+        (width, size) = (self.width, self.size) ; self.links = array('i')
+        cells = array('i', range(-width, size + width)) # sliced for each move, in bulk
+        for (ix, iy) in Cave.STEPS:
+            shift = iy * width + ix ; block = cells[width + shift:width + shift + size]
+            # the moves across the sides, wrapped or not
+            side = range(width - 1, size, width) if ix > 0 else range(0, size, width) if ix < 0 else range(size - width, size) if iy > 0 else range(width)
+            for i in side: block[i] = self.cell(i % width + ix, i // width + iy)
+            self.links += block
+        self.redirects = { i for (i, tile) in self.front.objects.items() if tile.redirecting }
+        self.relink(())
+
+    def relink(self, cells: Iterable[int]) -> None:
+        ''' Updates the neighbor table once the tiles at some cells changed the moves into them : the moves into these
+            cells, and those into any tile redirecting moves, as they may lead there. '''
+        links = self.links
+        if links is None: return # not loaded yet
+        (width, front) = (self.width, self.front) ; cells = list(cells)
+        for i in cells:
+            tile = front.objects.get(i)
+            if tile is not None and tile.redirecting: self.redirects.add(i)
+            else: self.redirects.discard(i)
+        entries = set()
+        for (slot, (ix, iy)) in enumerate(Cave.STEPS):
+            for i in itertools.chain(cells, self.redirects):
+                origin = self.cell(i % width - ix, i // width - iy)
+                if origin >= 0: entries.add(slot * self.size + origin)
+        for entry in entries: links[entry] = -1 # the slow way, until updated
+        for entry in entries:
+            (slot, origin) = divmod(entry, self.size) ; (ix, iy) = Cave.STEPS[slot]
+            try: (x, y) = self.resolve(None, origin % width, origin // width, ix, iy)
+            except RecursionError: continue # leading back into itself, e.g. from a portal into its pair next to it : left to the slow way
+            links[entry] = y * width + x if self.within_bounds(x, y) else -1
+
+    def create(self, tile_type: type, i: int) -> 'Tile':
+        return tile_type(self, i % self.width, i // self.width)
+
+    def at(self, x: int , y: int, back: bool = False) -> Optional['Tile']:
+        if self.wraps: (x,y) = self.geometry.wrap(x, y, self.width, self.height)
+        if 0 <= x < self.width and 0 <= y < self.height:
+            grid = self.back if back else self.front ; i = y * self.width + x
+            tile = grid.objects.get(i)
+            return grid.materialize(i) if tile is None and grid.codes[i] else tile
+        return None
+
+    def peek(self, x: int , y: int, back: bool = False) -> Optional['Tile']:
+        ''' The tile at a position, for its behaviour only : may be a flyweight, whose position is meaningless. '''
+        if self.wraps: (x,y) = self.geometry.wrap(x, y, self.width, self.height)
+        if 0 <= x < self.width and 0 <= y < self.height:
+            grid = self.back if back else self.front ; i = y * self.width + x
+            tile = grid.objects.get(i)
+            return grid.flyweight(grid.codes[i]) if tile is None and grid.codes[i] else tile
+        return None
+
+    def set(self, x: int , y: int, tile: Optional['Tile'], back: bool = False) -> Optional['Tile']:
+        if self.wraps: (x,y) = self.geometry.wrap(x, y, self.width, self.height)
+        if not (0 <= x < self.width and 0 <= y < self.height): return None
+        grid = self.back if back else self.front ; i = y * self.width + x
+        current = grid.objects.get(i)
+        if current is None and grid.codes[i]: current = grid.materialize(i)
+        if i not in grid.journal: grid.journal[i] = current
+        if current is not None: del grid.index[current.code][i] ; self.touch(current)
+        if tile is None:
+            if current is not None: del grid.objects[i] ; grid.codes[i] = 0
+        else: grid.objects[i] = tile ; grid.codes[i] = tile.code ; grid.index[tile.code][i] = tile
+        if not back:
+            self.scheduler.on_set(x, y, i, current, tile)
+            if current is not None and current.redirecting or tile is not None and tile.redirecting: self.relink([i])
+        if current is not None:
+            for rule in self.watchers[current.code]: self.touch_rule(rule) ; rule.on_removed(current, back)
+        if tile is not None:
+            for rule in self.watchers[tile.code]: self.touch_rule(rule) ; rule.on_added(tile, back)
+        for listener in self.listeners:
+            if current is not None: listener.on_removed(current, back)
+            if tile is not None: listener.on_added(tile, back)
+        return current
+
+    def count(self, kind: Optional[type], back: bool = False) -> int:
+        return (self.back if back else self.front).count(kind)
+
+    def find(self, kind: Optional[type], back: bool = False) -> List[Tuple[int,int]]:
+        return [ (i % self.width, i // self.width) for i in (self.back if back else self.front).find(kind) ]
+
+    def touch(self, tile: 'Tile') -> None:
+        if tile not in self.touched: self.touched[tile] = tile.get_state()
+
+    def touch_rule(self, rule: Rule) -> None:
+        if self.rule_states is not None and rule not in self.rule_states: self.rule_states[rule] = dict(rule.__dict__)
+
+    def notify(self, tile: 'Tile') -> None:
+        for rule in self.watchers[tile.code]: self.touch_rule(rule) ; rule.on_changed(tile)
+
+    def wake(self, tile: 'Tile') -> None:
+        self.touch(tile)
+        if tile in self.scheduler.sleeping: self.scheduler.schedule(tile, self.scheduler.index(tile))
+
+    def replace(self, tile : 'Tile', by : Union['Tile', type, None]) -> None:
+        if self.at(tile.x, tile.y) is tile: # still there ?
+            self.set(tile.x, tile.y, by(self, tile.x, tile.y) if isinstance(by, type) else by)
+            tile.on_destroy()
+
+    def replace_all(self, cond: Optional[Union[int,type]], by: Union['Tile', type, None]) -> None:
+        for tile in self.tiles(cond): self.replace(tile, by)
+
+    def can_move(self, actor: 'Tile', ix: int , iy: int) -> bool:
+        (x, y) = actor.offset(ix, iy)
+        if not self.within_bounds(x, y): return False
+        current = self.peek(x,y)
+        return current is None or current.can_be_occupied(actor, ix, iy)
+
+    def try_move(self, actor: 'Tile', ix: int , iy: int) -> bool:
+        if not actor.can_move(ix, iy): return False
+        current = self.at(actor.x, actor.y)
+        if (ix, iy) == (0, 0) and current is actor: return True
+        if current is actor: self.set(actor.x, actor.y, None)
+        (actor.x, actor.y) = actor.offset(ix, iy)
+        previous = self.set(actor.x, actor.y, actor)
+        actor.on_moved(previous)
+        if previous is not None and self.at(actor.x, actor.y) != previous: previous.on_destroy()
+        return True
+
+    def tiles(self, cond: Optional[Union[int,type]] = None, back: bool = False) -> List['Tile']:
+        grid = self.back if back else self.front
+        if isinstance(cond, type): return grid.tiles(cond)
+        grid.materialize_all(range(1, len(Tile.kinds)))
+        return [ tile for (_, tile) in sorted(grid.objects.items()) if tile.is_kind_of(cond) ]
+
+    def on_update(self, delta_time, max_steps: int = MAX_STEPS) -> None:
+        self.lag += delta_time ; steps = 0
+        while self.lag >= Cave.STEP and steps < max_steps:
+            self.lag -= Cave.STEP ; steps += 1
+            self.step()
+        if steps == max_steps: self.lag = min(self.lag, Cave.STEP)
+
+    def step(self) -> None:
+        if self.status == Cave.PAUSED: return
+        for listener in self.listeners: listener.on_step(self)
+        if self.status == Cave.IN_PROGRESS:
+            self.time_remaining -= Cave.STEP
+            if self.time_remaining <= 0:
+                self.time_remaining = 0 ; self.set_status(Cave.FAILED)
+        if self.wait > 0:
+            self.wait -= Cave.STEP
+            if self.wait <= 0:
+                if self.status == Cave.SUCCEEDED: self.next_level()
+                elif self.status == Cave.FAILED: self.restart_level()
+        self.scheduler.update(Cave.STEP)
+        if self.profiler is None:
+            for rule in self.rules: rule.update()
+        else:
+            for rule in self.rules:
+                start_time = time.perf_counter() ; rule.update()
+                self.profiler.add('rules/' + type(rule).__name__, time.perf_counter() - start_time)
+
+    def checksum(self) -> int:
+        value = zlib.crc32(self.front.codes) ; value = zlib.crc32(self.back.codes, value)
+        state = (self.level, self.status, self.collected, self.to_collect, self.scheduler.frame, *(p.score for p in self.game.players))
+        return zlib.crc32(repr(state).encode(), value)
+
+    def explode(self, cx: int, cy: int, tile_type: type) -> None:
+        tile_type.sound_explosion.play(at = (cx, cy))
+        for x in range(cx - 1, cx + 2):
+            for y in range(cy - 1, cy + 2):
+                (x,y) = self.wrap(x,y)
+                if self.within_bounds(x, y):
+                    tile = self.at(x, y)
+                    if tile is None or (not isinstance(tile, tile_type) and tile.can_break()):
+                        self.set(x, y, tile_type(self, x, y))
+                        if not tile is None: tile.on_destroy()
+                    back = self.at(x, y, True)
+                    if back is not None and back.can_break():
+                        self.set(x, y, None, True)
+                        back.on_destroy()
+
+class Headless:
+    ''' A game without window nor audio, hosting a cave. Steps as fast as possible, e.g. for validation, bots or benchmarks. '''
+
+    def __init__(self, nb_players: int = 1, level: int = 1, seed: Optional[int] = None) -> None:
+        register_tiles()
+        self.players = [ Player(self, i) for i in range(nb_players) ]
+        self.cave = Cave(self, level, seed)
+
+    def center_on(self, x, y, speed = 1) -> None: pass
+    def on_loaded(self) -> None: pass
+    def over(self) -> None: pass
+
+    def step(self) -> None:
+        self.cave.step()
+
+    def run(self, nb_ticks: int) -> None:
+        for _ in range(nb_ticks): self.cave.step()
+
+def register_tiles() -> None:
+    ''' Registers the standard and custom tiles, once. '''
+    if len(Tile.registered_tiles) > 0: return
+    import tiles, custom_tiles
+    tiles.register(Tile)
+    custom_tiles.register(Tile)
@@ -0,0 +1,96 @@
+﻿''' Vectorized environment for agents, in the manner of Gym : several independent caves, headless, stepped in lockstep
+    by one call taking a batch of actions and returning a batch of NumPy observations, rewards and end flags.
+    Requires NumPy, unlike the game itself. '''
+
+from typing import Optional, List, Dict, Tuple, Sequence, Union
+import numpy as np
+from engine import Cave, Headless, Tile
+
+# actions, as the control keys of the players : none, then up, left, down and right (moving into a tile uses it)
+ACTIONS = [[], [(0,+1)], [(-1,0)], [(0,-1)], [(+1,0)]]
+DIRECTIONS = { (0,0): 0, (0,+1): 1, (-1,0): 2, (0,-1): 3, (+1,0): 4 } # codes of the dir channel
+CHANNELS = ('code', 'dir', 'frightened', 'moving')
+OUTSIDE = -1 # code of the cells beyond a cave smaller than the observations
+ENDED = { Cave.SUCCEEDED, Cave.FAILED, Cave.GAME_OVER }
+
+class CavesEnv:
+    ''' Steps N caves together, each one played by a single player. Observations are int16 tensors of shape
+        (N, channels, height, width), rows bottom first as in the grid : the type codes of the tiles (see Tile.kinds),
+        then for tiles with behaviour, the code of their direction, the ticks they remain frightened, and whether they
+        are moving. The reward is the gain in score plus the diamonds collected. Caves that end are started again. '''
+
+    def __init__(self, levels: Union[int, Sequence[int]], num_envs: Optional[int] = None, seed: int = 0,
+            ticks: int = 1, max_ticks: Optional[int] = None) -> None:
+        levels = [levels] if isinstance(levels, int) else list(levels)
+        self.num_envs = num_envs if num_envs is not None else len(levels)
+        self.levels = [ levels[k % len(levels)] for k in range(self.num_envs) ]
+        self.seed = seed ; self.ticks = ticks ; self.max_ticks = max_ticks
+        self.games = [ None ] * self.num_envs ; self.episodes = [0] * self.num_envs
+        self.elapsed = np.zeros(self.num_envs, dtype = np.int64)
+        self.scores = np.zeros(self.num_envs, dtype = np.int64) ; self.collected = np.zeros(self.num_envs, dtype = np.int64)
+        for k in range(self.num_envs): self.start(k) # to size the observations
+        self.height = max(game.cave.height for game in self.games) ; self.width = max(game.cave.width for game in self.games)
+        self.observations = np.full((self.num_envs, len(CHANNELS), self.height, self.width), OUTSIDE, dtype = np.int16)
+
+    @property
+    def observation_shape(self) -> Tuple[int, int, int]: return (len(CHANNELS), self.height, self.width)
+    @property
+    def nb_actions(self) -> int: return len(ACTIONS)
+
+    def start(self, k: int) -> None:
+        # a new episode in a cave, with its own seed
+        game = self.games[k] = Headless(1, self.levels[k], self.seed + self.episodes[k] * self.num_envs + k)
+        self.episodes[k] += 1 ; self.elapsed[k] = 0
+        self.scores[k] = game.players[0].score ; self.collected[k] = game.cave.collected
+
+    def reset(self, seed: Optional[int] = None) -> Tuple[np.ndarray, Dict]:
+        if seed is not None: self.seed = seed ; self.episodes = [0] * self.num_envs
+        for k in range(self.num_envs): self.start(k)
+        for k in range(self.num_envs): self.observe(k)
+        return (self.observations.copy(), self.infos())
+
+    def step(self, actions: Sequence[int]) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, Dict]:
+        ''' Plays one action per cave. Returns the observations, rewards, terminated and truncated flags, and infos
+            (statuses before any restart). For caves that ended, the observations are those of the next episode. '''
+        rewards = np.zeros(self.num_envs, dtype = np.float32)
+        terminated = np.zeros(self.num_envs, dtype = bool) ; truncated = np.zeros(self.num_envs, dtype = bool)
+        statuses = np.zeros(self.num_envs, dtype = np.int8)
+        for (k, (game, action)) in enumerate(zip(self.games, actions)):
+            cave = game.cave ; player = game.players[0]
+            player.directions = ACTIONS[action]
+            for _ in range(self.ticks):
+                cave.step()
+                if cave.status in ENDED: break
+            self.elapsed[k] += self.ticks
+            (score, collected) = (player.score, cave.collected)
+            rewards[k] = (score - self.scores[k]) + (collected - self.collected[k])
+            (self.scores[k], self.collected[k]) = (score, collected)
+            statuses[k] = cave.status ; terminated[k] = cave.status in ENDED
+            truncated[k] = not terminated[k] and self.max_ticks is not None and self.elapsed[k] >= self.max_ticks
+            if terminated[k] or truncated[k]: self.start(k)
+            self.observe(k)
+        infos = self.infos() ; infos['status'] = statuses
+        return (self.observations.copy(), rewards, terminated, truncated, infos)
+
+    def observe(self, k: int) -> None:
+        cave = self.games[k].cave ; (width, height) = (cave.width, cave.height) ; observation = self.observations[k]
+        observation[0, :height, :width] = np.frombuffer(cave.front.codes, dtype = np.uint8).reshape(height, width)
+        observation[1:, :height, :width] = 0
+        # the other channels, from the tiles with behaviour only (static ones keep their defaults)
+        cells = [ (i, tile) for (i, tile) in cave.front.objects.items() if tile.acting ]
+        if not cells: return
+        tiles = [ tile for (_, tile) in cells ]
+        (ys, xs) = np.divmod(np.fromiter((i for (i, _) in cells), np.intp, len(cells)), width)
+        observation[1, ys, xs] = np.fromiter((DIRECTIONS.get(tile.dir, 0) for tile in tiles), np.int16, len(tiles))
+        observation[2, ys, xs] = np.fromiter((round(getattr(tile, 'frightened', 0) / Cave.STEP) for tile in tiles), np.int16, len(tiles))
+        observation[3, ys, xs] = np.fromiter((tile.moving for tile in tiles), np.int16, len(tiles))
+
+    def infos(self) -> Dict:
+        return { 'level': np.array(self.levels), 'elapsed': self.elapsed.copy(),
+            'score': self.scores.copy(), 'collected': self.collected.copy() }
+
+    def kinds(self) -> List[str]:
+        ''' The names of the tile types, by code. '''
+        return [ kind.__name__ if kind is not None else '_' for kind in Tile.kinds ]
+
+    def close(self) -> None: self.games = []
@@ -1,136 +1,133 @@
 ﻿''' Clone of the Boulder Dash game, with some tweaks... '''
 
-from typing import Optional, Union, Tuple, List, Iterable
+from typing import Optional, Union, Tuple, List
 from collections import namedtuple
-import time, math
-import pyglet, arcade
-from maps import CAVE_MAPS
-
-class Sound:
-    ''' An audio media in the game. Played at moderate volume and at most once per frame (for a given sound). '''
-    VOLUME = 0.5
-    MAX_RATE = 1/60 # sec
-
-    def __init__(self, file: str) -> None:
-        self.file = file ; self.media = None ; self.last_played = -math.inf
-        #self.load() # force audio preloading (is it necessary ?)
-
-    def load(self) -> None:
-        if self.media is None:
-            #print('Loading sound ' + self.file, end = '', flush = True)
-            self.media = arcade.Sound(self.file)
-            #self.media.play(0).delete() # force audio preloading (is it necessary ?)
-            #print(' ...')
-
-    def play(self, volume = VOLUME, pan: float = 0.0, loop: bool = False, speed: float = 1.0):
-        if self.media is None: self.load()
-        now = time.time()
-        if now - self.last_played < Sound.MAX_RATE: return None
-        self.last_played = now
-        return self.media.play(volume, pan, loop, speed)
-
-class Interface:
-    ''' Pure abstract. To distinguish from standard classes. '''
-
-class Tile(arcade.Sprite):
-    ''' A tile in the game's cave. Manages skins, positioning, basic movement, timings, and update. '''
+import time, math, os, argparse, asyncio, sys
+import pyglet, arcade, PIL.Image
+from engine import Sound, Tile, Player, Cave, CaveListener, register_tiles
+from replay import Recorder, Playback
+from profiler import Profiler
+from levels import LevelPack
+from rewind import Rewinder
+from netplay import Host, Client, PORT
+
+class TextureRegistry:
+    ''' Process-wide cache of the tiles textures, keyed by (kind, index, flip_h, flip_v). Loaded once, from the tile sheet
+        of the kind or else of its closest base class having one. Preloadable into a single texture atlas. '''
 
     TILE_SIZE = 64 # choose from 16, 64
-    DEFAULT_SPEED = 10 # squares per second
-    PRIORITY_HIGH = 0
-    PRIORITY_MEDIUM = 1
-    PRIORITY_LOW = 2
     TILESHEET_MARGIN = TILE_SIZE/16
 
-    registered_tiles = {}
-    global_updates = []
-    def __init__(self, cave: 'Cave', x: int, y: int, n: int = 1) -> None:
-        super().__init__(None, Game.TILE_SIZE / Tile.TILE_SIZE)
-        self.nb_skins = 0 ; self.skin = None ;
-        if n > 0: self.add_skins(type(self), range(n))
-        self.cave = cave ; self.back = False ; self.x = x ; self.y = y ; self.dir = (0, 0)
-        self.wait = 0 ; self.speed = Tile.DEFAULT_SPEED
-        self.moved = self.moving = False ; self.priority = Tile.PRIORITY_MEDIUM
-        self.compute()
-
-    def add_skins(self, kind: Union[str, type], rng: Iterable[int], flip_h: bool = False, flip_v: bool = False) -> None:
-        name = kind.__name__ if isinstance(kind, type) else kind
-        file_name = f'res/{name}{Tile.TILE_SIZE}.png'
-        try:
-            offsets = [(i * (Tile.TILE_SIZE + Tile.TILESHEET_MARGIN), 0, Tile.TILE_SIZE, Tile.TILE_SIZE) for i in rng]
-            textures = arcade.load_textures(file_name, offsets, flip_h, flip_v)
-            self.nb_skins += len(textures)
-            for texture in textures: self.append_texture(texture)
-            if self.skin is None and self.nb_skins > 0: self.set_skin(0)
-        except FileNotFoundError as err:
-            if isinstance(kind, type) and len(kind.__bases__) > 0:
-                self.add_skins(kind.__bases__[0], rng, flip_h, flip_v)
-            else: raise err
-    def add_skin(self, kind: Union[str, type], num: int, flip_h: bool = False, flip_v: bool = False) -> None:
-        self.add_skins(kind, [num], flip_h, flip_v)
-    def set_skin(self, i: int) -> None: self.skin = i; self.set_texture(i)
-    def next_skin(self) -> None: self.set_skin( (self.skin+1) % self.nb_skins )
-
-    def compute(self) -> None:
-        self.center_x = Game.TILE_SIZE * (self.x + 0.5)
-        self.center_y = Game.TILE_SIZE * (self.y + 0.5)
-    def focus(self, speed = 1) -> None:
-        self.cave.game.center_on(self.center_x, self.center_y, speed)
-
-    def pos(self, _observer: Optional['Tile'], _ix: int, _iy: int) -> Tuple[int,int]:
-        return (self.x ,self.y)
-    def offset(self, ix: int, iy: int) -> Tuple[int,int]:
-        (x, y) = self.cave.wrap(self.x + ix ,self.y + iy) ; tile = self.cave.at(x, y)
-        return (x, y) if tile is None else tile.pos(self, ix, iy)
-    def neighbor(self, ix: int, iy: int) -> Optional['Tile'] :
-        return self.cave.at(*self.offset(ix,iy))
-
-    def is_kind_of(self, cond: Optional[Union[int, type]]):
-        return cond is None or (isinstance(cond, type) and isinstance(self, cond)) or self.priority == cond
-
-    def can_move(self, ix: int, iy: int)  -> bool:
-        return self.cave.can_move(self, ix, iy)
-
-    def try_move(self, ix: int, iy: int) -> bool:
-        self.dir = (ix, iy)
-        if self.cave.try_move(self, ix, iy):
-            self.compute() ; self.moved = True
-            return self.try_wait()
-        return False
-
-    def try_wait(self) -> bool:
-        self.wait = 1 / self.speed
-        return True
-
-    def on_update(self, delta_time: float = 1/60) -> None:
-        if self.wait > 0:  self.wait -= delta_time
-        else: self.moved = False ; self.tick() ; self.moving = self.moved
-
-    def tick(self): pass
-    def can_be_occupied(self, _by: 'Tile', _ix: int, _iy: int) -> bool: return False
-    def on_moved(self, _into: Optional['Tile']) -> None: pass
-    def can_break(self) -> bool:  return True
-    def on_destroy(self) -> None: pass
-    def on_loaded(self) -> None: pass
-
-class Unknown(Tile):
-    ''' Typically used to represent a tile not yet implemented. '''
-    def __init__(self, cave: 'Cave', x: int, y: int) -> None: super().__init__(cave, x, y)
-
-class Player:
-    ''' A player in the Boulder Dash game. Handles controls, score and lifes. '''
-    SCORE_FOR_LIFE = 100
-    sound = Sound(":resources:sounds/laser1.wav")
+    textures = {}
+    sheets = {} # (file name, index, flip_h, flip_v) -> texture
+    files = {} # kind -> tile sheet file name
+
+    @staticmethod
+    def file(kind: Union[str, type]) -> str:
+        file_name = TextureRegistry.files.get(kind)
+        if file_name is None:
+            name = kind.__name__ if isinstance(kind, type) else kind
+            file_name = f'res/{name}{TextureRegistry.TILE_SIZE}.png'
+            if not os.path.exists(file_name):
+                if not isinstance(kind, type) or len(kind.__bases__) == 0: raise FileNotFoundError(file_name)
+                file_name = TextureRegistry.file(kind.__bases__[0])
+            TextureRegistry.files[kind] = file_name
+        return file_name
+
+    @staticmethod
+    def get(kind: Union[str, type], i: int, flip_h: bool = False, flip_v: bool = False) -> arcade.Texture:
+        key = (kind, i, flip_h, flip_v) ; texture = TextureRegistry.textures.get(key)
+        if texture is None:
+            texture = TextureRegistry.load(TextureRegistry.file(kind), i, flip_h, flip_v)
+            TextureRegistry.textures[key] = texture
+        return texture
+
+    @staticmethod
+    def load(file_name: str, i: int, flip_h: bool, flip_v: bool) -> arcade.Texture:
+        key = (file_name, i, flip_h, flip_v) ; texture = TextureRegistry.sheets.get(key)
+        if texture is None:
+            (size, margin) = (TextureRegistry.TILE_SIZE, TextureRegistry.TILESHEET_MARGIN)
+            texture = arcade.load_texture(file_name, i * (size + margin), 0, size, size,
+                flipped_horizontally = flip_h, flipped_vertically = flip_v)
+            TextureRegistry.sheets[key] = texture
+        return texture
+
+    @staticmethod
+    def preload(atlas: arcade.TextureAtlas) -> None:
+        (size, margin) = (TextureRegistry.TILE_SIZE, TextureRegistry.TILESHEET_MARGIN)
+        for kind in Tile.kinds[1:]:
+            file_name = TextureRegistry.file(kind)
+            with PIL.Image.open(file_name) as image: nb_skins = int((image.width + margin) // (size + margin))
+            for i in range(nb_skins):
+                for (flip_h, flip_v) in [(False, False), (True, False), (False, True), (True, True)]:
+                    atlas.add(TextureRegistry.get(kind, i, flip_h, flip_v))
+
+class Voices:
+    ''' A bounded pool of audio players, shared by the sounds of the game. A player is reused once its sound is over,
+        or else the least recently started one is taken over, so that sound bursts never pile up voices. '''
+
+    SIZE = 8
+
+    def __init__(self, size: int = SIZE) -> None:
+        self.size = size ; self.players = [] # least recently started first
+
+    def play(self, source, volume: float, pan: float, speed: float) -> pyglet.media.Player:
+        player = next((player for player in self.players if not player.playing), None)
+        if player is None and len(self.players) < self.size: player = pyglet.media.Player()
+        elif player is None: player = self.players[0]
+        if player in self.players: self.players.remove(player)
+        self.players.append(player)
+        player.queue(source)
+        if player.playing: player.next_source() # cuts the sound being played
+        player.volume = volume ; player.pitch = speed
+        player.position = (pan, 0.0, math.sqrt(1 - pan ** 2))
+        player.play()
+        return player
+
+class PooledSound(arcade.Sound):
+    ''' A sound played by the voices of the pool, unless looping (e.g. the music). '''
+
+    voices = None
+
+    def play(self, volume: float = 1.0, pan: float = 0.0, loop: bool = False, speed: float = 1.0) -> pyglet.media.Player:
+        if loop or PooledSound.voices is None: return super().play(volume, pan, loop, speed)
+        return PooledSound.voices.play(self.source, volume, pan, speed)
+
+class TileSprite(arcade.Sprite):
+    ''' The visual representation of a tile. Follows the position and skin of the tile, within the chunk of its sprite list. '''
+
+    atlas = None
+
+    def __init__(self, tile: Tile) -> None:
+        super().__init__(None, Game.TILE_SIZE / TextureRegistry.TILE_SIZE)
+        self.attach(tile)
+
+    def attach(self, tile: Tile) -> None:
+        self.tile = tile ; self.back = tile.back ; self.chunk = CaveView.chunk_of(tile)
+        self.textures = [] ; self.nb_skins = 0 ; self.skin = None
+        self.sync()
+
+    def sync(self) -> None:
+        tile = self.tile
+        for skin in tile.skins[self.nb_skins:]: self.append_texture(TextureRegistry.get(*skin))
+        self.nb_skins = len(tile.skins)
+        if self.skin != tile.skin and tile.skin is not None:
+            self.skin = tile.skin ; self.set_texture(tile.skin)
+        self.center_x = Game.TILE_SIZE * (tile.x + 0.5)
+        self.center_y = Game.TILE_SIZE * (tile.y + 0.5)
+
+class KeyboardPlayer(Player):
+    ''' A player controlled with the keyboard or a game controller. '''
 
     ControlKeys = namedtuple('ControlKeys', 'up left down right')
 
     def __init__(self, game: 'Game', num: int = 0) -> None:
-        self.game = game ; self.num = num; self._score = 0 ; self.life = 3
+        super().__init__(game, num)
         self.control_keys = \
-            Player.ControlKeys(arcade.key.UP, arcade.key.LEFT, arcade.key.DOWN, arcade.key.RIGHT) if num == 0 else \
-            Player.ControlKeys(arcade.key.Z, arcade.key.Q, arcade.key.S, arcade.key.D) if num == 1 else \
-            Player.ControlKeys(arcade.key.I, arcade.key.J, arcade.key.K, arcade.key.L) if num == 2 else \
-            Player.ControlKeys(arcade.key.NUM_8, arcade.key.NUM_4, arcade.key.NUM_2, arcade.key.NUM_6)
+            KeyboardPlayer.ControlKeys(arcade.key.UP, arcade.key.LEFT, arcade.key.DOWN, arcade.key.RIGHT) if num == 0 else \
+            KeyboardPlayer.ControlKeys(arcade.key.Z, arcade.key.Q, arcade.key.S, arcade.key.D) if num == 1 else \
+            KeyboardPlayer.ControlKeys(arcade.key.I, arcade.key.J, arcade.key.K, arcade.key.L) if num == 2 else \
+            KeyboardPlayer.ControlKeys(arcade.key.NUM_8, arcade.key.NUM_4, arcade.key.NUM_2, arcade.key.NUM_6)
         self.controller = game.controllers[num] if num < len(game.controllers) else None
 
     def list_directions(self) -> List[Tuple[int,int]]:
@@ -158,189 +155,101 @@ class Player:
             self.controller.x > +.5 and (ix,iy) == (+1,0)
         )
 
-    @property
-    def score(self) -> int: return self._score
-    @score.setter
-    def score(self, value : int) -> None:
-        n = self._score // Player.SCORE_FOR_LIFE
-        self._score = value
-        if self._score // Player.SCORE_FOR_LIFE > n and self.life < 9:
-            self.life += 1
-            Player.sound.play()
-
-    def kill(self) -> None:
-        self.life -= 1
-        if any(p.life > 0 for p in self.game.players):
-            self.game.cave.set_status(Cave.FAILED)
-        else:
-            self.game.cave.set_status(Cave.GAME_OVER)
-            self.game.over()
-
-class Geometry:
-    ''' Defines how the space wraps around. By default, it doesn't. '''
-    def wrap(self, x: int, y: int, _w:int, _h: int) -> Tuple[int,int] : return (x, y)
-
-class Torus(Geometry):
-    ''' On a torus, opposite sides are identified. '''
-    def wrap(self, x: int, y: int, w:int, h: int) -> Tuple[int,int] : return (x%w, y%h)
-
-class Cave:
-    ''' The grid of tiles in which the game is played. Manages map loading and tiles updates. '''
-
-    WIDTH_MAX = 40
-    WIDTH_MIN = 20
-    HEIGHT_MAX = 22
-    HEIGHT_MIN = 12
-
-    STARTING = 0
-    IN_PROGRESS = 1
-    PAUSED = 2
-    SUCCEEDED = 3
-    NOT_LOADED = -1
-    FAILED = -2
-    GAME_OVER = -3
-
-    WAIT_STATUS = 0.75 # seconds
-    DEFAULT_MAXTIME = 120 # seconds
+class NetworkPlay:
+    ''' Plays over the network, as a client stepping the cave of the game with the input frames of a host (run here
+        too when hosting), the keys of the first player sent as its inputs. The cave only steps by these frames : the
+        networking runs for a slice of each frame, in the thread of the window. '''
+
+    SLICE = 0.004 # seconds of networking per frame
+
+    def __init__(self, game: 'Game', address: str = 'localhost', port: int = PORT, nb_players: Optional[int] = None) -> None:
+        self.loop = asyncio.new_event_loop() ; self.tasks = []
+        self.host = Host(nb_players, port = port) if nb_players is not None else None
+        if self.host is not None:
+            self.loop.run_until_complete(self.host.listen()) ; self.tasks.append(self.loop.create_task(self.host.serve()))
+        keyboard = KeyboardPlayer(game, 0)
+        self.client = Client(address, port, lambda _game, _tick: keyboard.list_directions(), game)
+        self.tasks.append(self.loop.create_task(self.client.run()))
+
+    def pump(self) -> None:
+        self.loop.run_until_complete(asyncio.sleep(NetworkPlay.SLICE))
+        for task in self.tasks:
+            if task.done() and not task.cancelled(): task.result() # raises any error, e.g. no host to join
+
+    def close(self) -> None:
+        for task in self.tasks: task.cancel()
+        self.loop.run_until_complete(asyncio.gather(*self.tasks, return_exceptions = True)) ; self.loop.close()
+        if self.host is not None: print(f'host : {self.host.report()}', file = sys.stderr)
+        print(f'client : {self.client.report()}', file = sys.stderr)
+
+class Hud:
+    ''' The head-up display above a cave : level, life, time, goal and score, plus a notice of the cave status.
+        Made of persistent texts in a single batch, each one updated only when its value changes. '''
+
+    NOTICES = {
+        Cave.NOT_LOADED: ('LOADING', arcade.color.GRULLO), Cave.PAUSED: ('PAUSED', arcade.color.GRULLO),
+        Cave.STARTING: ('GET READY', arcade.color.BANANA_YELLOW), Cave.SUCCEEDED: ('WELL DONE', arcade.color.DARK_PASTEL_GREEN),
+        Cave.FAILED: ('TRY AGAIN', arcade.color.CADMIUM_ORANGE), Cave.GAME_OVER: ('GAME OVER', arcade.color.FERRARI_RED) }
 
     def __init__(self, game: 'Game') -> None:
-        self.game = game
-        self.to_collect = 0 ; self.collected = 0
-        self.status = Cave.NOT_LOADED ; self.wait = 0
-        self.front_tiles = [] ; self.back_tiles = []
-        self.miner_type = None ; self.geometry = None
-        self.height = self.width = 0 ; self.map = None
-        self.time_remaining = 0
-        self.next_level(1)
-
-    def load(self) -> None:
-        types = { ' ': None, '_': None, **Tile.registered_tiles }
-        self.to_collect = 0 ; self.collected = 0
-        if self.status != Cave.GAME_OVER: self.status = Cave.STARTING
-        self.wait = 0
-        self.front_tiles = [] ; self.back_tiles = []
-        self.map = CAVE_MAPS[self.level - 1]
-        type_name = self.map['miner'] if 'miner' in self.map else 'Miner'
-        self.miner_type = next(value for (_, value) in types.items() if value is not None and value.__name__ == type_name)
-        self.height = len(self.map['map'])
-        self.width = len(self.map['map'][0])
-        self.to_collect = self.map['goal']
-        self.geometry = globals()[self.map['geometry']]() if 'geometry' in self.map else Geometry()
-        self.time_remaining = self.map['time'] if 'time' in self.map else Cave.DEFAULT_MAXTIME
-        self.front_tiles = [[None] * self.width for _ in range(self.height)]
-        self.back_tiles = [[None] * self.width for _ in range(self.height)]
-        for y in reversed(range(self.height)):
-            for x in range(self.width):
-                key = self.map['map'][self.height -1 - y][x]
-                tile_type = types[key] if key in types else Unknown
-                if tile_type is not None: self.front_tiles[y][x] = tile_type(self, x, y)
-        for tile in self.tiles(): tile.on_loaded()
-        self.game.on_loaded()
-
-    def next_level(self, level : Optional[int] = None) -> None:
-        self.level = self.level + 1 if level is None else level
-        nb_levels = len(CAVE_MAPS)
-        if self.level < 1 : self.level += nb_levels
-        elif self.level > nb_levels : self.level -= nb_levels
-        self.load()
-
-    def restart_level(self) -> None: self.next_level(self.level)
-
-    def is_complete(self) -> bool:
-        return self.collected >= self.to_collect
-
-    def pause(self) -> None:
-        if self.status == Cave.IN_PROGRESS: self.status = Cave.PAUSED
-        elif self.status == Cave.PAUSED: self.status = Cave.IN_PROGRESS
-
-    def set_status(self, status) -> None:
-        self.status = status
-        self.wait = Cave.WAIT_STATUS
-
-    def wrap(self, x:int, y:int) -> Tuple[int,int]:
-        return self.geometry.wrap(x, y, self.width, self.height)
-
-    def within_bounds(self, x: int ,y: int) -> bool:
-        return 0 <= x < self.width and 0 <= y < self.height
-
-    def at(self, x: int , y: int, back: bool = False) -> Optional['Tile']:
-        (x,y) = self.wrap(x,y)
-        tiles_array = self.front_tiles if not back else self.back_tiles
-        return tiles_array[y][x] if self.within_bounds(x,y) else None
-
-    def set(self, x: int , y: int, tile: Optional['Tile'], back: bool = False) -> Optional['Tile']:
-        (x,y) = self.wrap(x,y)
-        current = self.at(x, y, back)
-        if self.within_bounds(x,y):
-            tiles_array = self.front_tiles if not back else self.back_tiles
-            tiles_array[y][x] = tile
-        return current
-
-    def replace(self, tile : 'Tile', by : Union['Tile', type, None]) -> None:
-        if self.at(tile.x, tile.y) is tile: # still there ?
-            self.set(tile.x, tile.y, by(self, tile.x, tile.y) if isinstance(by, type) else by)
-            tile.on_destroy()
-
-    def replace_all(self, cond: Optional[Union[int,type]], by: Union['Tile', type, None]) -> None:
-        for tile in self.tiles(cond): self.replace(tile, by)
-
-    def can_move(self, actor: 'Tile', ix: int , iy: int) -> bool:
-        (x, y) = actor.offset(ix, iy)
-        if not self.within_bounds(x, y): return False
-        current = self.at(x,y)
-        return current is None or current.can_be_occupied(actor, ix, iy)
-
-    def try_move(self, actor: 'Tile', ix: int , iy: int) -> bool:
-        if not actor.can_move(ix, iy): return False
-        current = self.at(actor.x, actor.y)
-        if (ix, iy) == (0, 0) and current is actor: return True
-        if current is actor: self.set(actor.x, actor.y, None)
-        (actor.x, actor.y) = actor.offset(ix, iy)
-        previous = self.set(actor.x, actor.y, actor)
-        actor.on_moved(previous)
-        if previous is not None and self.at(actor.x, actor.y) != previous: previous.on_destroy()
-        return True
-
-    def tiles(self, cond: Optional[Union[int,type]] = None, back: bool = False) -> Iterable['Tile']:
-        tiles_array = self.front_tiles if not back else self.back_tiles
-        for row in tiles_array:
-            for tile in row:
-                if tile is not None and tile.is_kind_of(cond): yield tile
-
-    def on_update(self, delta_time) -> None:
-        if self.status == Cave.PAUSED: return
-        if self.status == Cave.IN_PROGRESS:
-            self.time_remaining -= delta_time
-            if self.time_remaining <= 0:
-                self.time_remaining = 0 ; self.set_status(Cave.FAILED)
-        if self.wait > 0:
-            self.wait -= delta_time
-            if self.wait <= 0:
-                if self.status == Cave.SUCCEEDED: self.next_level()
-                elif self.status == Cave.FAILED: self.restart_level()
-        for priority in [Tile.PRIORITY_HIGH, Tile.PRIORITY_MEDIUM, Tile.PRIORITY_LOW]:
-            for tile in self.tiles(priority): tile.on_update(delta_time)
-        for update in Tile.global_updates: update(self)
-
-    def explode(self, cx: int, cy: int, tile_type: type) -> None:
-        tile_type.sound_explosion.play()
-        for x in range(cx - 1, cx + 2):
-            for y in range(cy - 1, cy + 2):
-                (x,y) = self.wrap(x,y)
-                if self.within_bounds(x, y):
-                    tile = self.at(x, y)
-                    if tile is None or (not isinstance(tile, tile_type) and tile.can_break()):
-                        self.set(x, y, tile_type(self, x, y))
-                        if not tile is None: tile.on_destroy()
-                    back = self.at(x, y, True)
-                    if back is not None and back.can_break():
-                        self.set(x, y, None, True)
-                        back.on_destroy()
-
-class CaveView(arcade.View):
-    ''' The main view of the game when in play. Renders the current cave. Manages cameras. '''
+        self.game = game ; self.batch = None
+        self.texts = {} ; self.values = {} # by name
+        self.bar = None ; self.box = None # background shapes
+
+    def layout(self, width: int, height: int) -> None:
+        self.batch = pyglet.graphics.Batch() ; self.texts.clear() ; self.values.clear()
+        y = height - Game.TILE_SIZE * 17/16
+        self.add('level', 0, y, 3, 'LVL')
+        self.add('life', 3.5, y, 2.5, 'LIFE')
+        self.add('time', 6.5, y, 3.5, 'TIME')
+        self.add('goal', 10.5, y, 3.5, 'GOAL')
+        self.add('score', 14.5, y, 5.5, 'SCR')
+        self.texts['notice'] = arcade.Text('', 0, height/2 + Game.TILE_SIZE/16, arcade.color.GRULLO, Game.TILE_SIZE, Game.WIDTH, 'center', Game.FONT,
+            anchor_y = 'center', batch = self.batch)
+        self.bar = arcade.ShapeElementList()
+        self.bar.append(arcade.create_rectangle_filled(width/2, height - Game.TILE_SIZE/2, width, Game.TILE_SIZE, (0,0,0,192)))
+        (center, box_width, box_height) = ((Game.WIDTH/2, height/2), Game.WIDTH/3, 2 * Game.TILE_SIZE)
+        self.box = arcade.ShapeElementList()
+        self.box.append(arcade.create_rectangle_filled(*center, box_width, box_height, (0,0,0,128)))
+        self.box.append(arcade.create_rectangle_outline(*center, box_width, box_height, arcade.color.GRULLO, Game.TILE_SIZE/16))
+
+    def add(self, name: str, x: float, y: float, w: float, label: str) -> None:
+        # a label on the left, and its value on the right
+        self.texts[name + '/label'] = arcade.Text(label, x*Game.TILE_SIZE, y, arcade.color.GRULLO, Game.TILE_SIZE, w * Game.TILE_SIZE, 'left', Game.FONT,
+            anchor_y = 'bottom', batch = self.batch)
+        self.texts[name] = arcade.Text('', x*Game.TILE_SIZE, y, arcade.color.DARK_PASTEL_GREEN, Game.TILE_SIZE, w * Game.TILE_SIZE, 'right', Game.FONT,
+            anchor_y = 'bottom', batch = self.batch)
+
+    def set(self, name: str, value: str) -> None:
+        if self.values.get(name) != value: self.values[name] = self.texts[name].text = value
+
+    def update(self) -> None:
+        cave = self.game.cave ; player = self.game.players[0]
+        self.set('level', f'{cave.level:02}')
+        self.set('life', f'{player.life:01}')
+        self.set('time', f'{math.ceil(cave.time_remaining):03}')
+        self.set('goal/label', 'GOAL' if cave.collected <= cave.to_collect else 'PLUS')
+        self.set('goal', f'{abs(cave.to_collect - cave.collected):02}')
+        self.set('score', f'{player.score:07}')
+        (text, color) = Hud.NOTICES.get(cave.status, ('', None))
+        self.set('notice', text)
+        if color is not None and self.values.get('notice/color') != color: self.values['notice/color'] = self.texts['notice'].color = color
+
+    def draw(self) -> None:
+        self.bar.draw()
+        if self.values['notice']: self.box.draw()
+        with self.game.ctx.pyglet_rendering(): self.batch.draw()
+
+class CaveView(arcade.View, CaveListener):
+    ''' The main view of the game when in play. Renders the current cave, following its changes. Manages cameras.
+        Sprites are split into square chunks of the cave, each with its own sprite lists, only drawn when in view.
+        The sprites of a chunk are created when it first comes into view. '''
 
     COLOR_OUT_OF_TIME = (32,0,0)
+    PROFILE_FONT_SIZE = 10
+    PROFILE_TILES = 8 # most updated tile types shown
+    CHUNK_SIZE = 8 # tiles
+    SOUND_RANGE = 0.5 # screens out of view, beyond which sounds are not heard
 
     def __init__(self, game: 'Game') -> None:
         super().__init__(game)
@@ -348,12 +257,26 @@ class CaveView(arcade.View):
         self.camera = None
         self.camera_gui = None
         self.center = None
-        self.sprite_list = arcade.SpriteList()
+        self.sprite_lists = {} ; self.free_sprites = {} # (chunk, back) -> sprite list, and its hidden sprites to recycle
+        self.sprites = {} ; self.populated = set() # chunks whose tiles have sprites
+        self.changes = {} # tile -> whether it is in the cave
+        self.hud = Hud(game)
 
     def on_show_view(self)  -> None:
+        self.game.cave.listeners.append(self) ; Sound.locate = self.locate
         self.on_resize(self.window.width, self.window.height)
         self.on_loaded()
 
+    def on_hide_view(self) -> None:
+        self.game.cave.listeners.remove(self) ; Sound.locate = None
+
+    def locate(self, x: int, y: int) -> Tuple[float,float]:
+        # sounds are panned by their position on screen, and fade out with their distance out of it
+        (left, bottom) = self.camera.position ; (width, height) = (self.window.width, self.window.height)
+        (sx, sy) = ((x + 0.5) * Game.TILE_SIZE - left, (y + 0.5) * Game.TILE_SIZE - bottom)
+        out = max(-sx / width, sx / width - 1, -sy / height, sy / height - 1, 0)
+        return (max(1 - out / CaveView.SOUND_RANGE, 0), min(max(2 * sx / width - 1, -1), 1))
+
     def on_resize(self, width: int, height: int) -> None:
         if self.camera is None or self.camera.viewport_width != width or self.camera.viewport_height != height:
             self.camera = arcade.Camera(width, height)
@@ -361,6 +284,7 @@ class CaveView(arcade.View):
             if not self.center is None: self.center_on(*self.center)
             gui_offset = Game.TILE_SIZE / 2 if height > (Cave.HEIGHT_MAX + 1) * Game.TILE_SIZE else 0
             self.camera_gui.move_to( ((Game.WIDTH - width)/2, gui_offset))
+            self.hud.layout(width, height)
 
     def center_on(self, x, y, speed = 1) -> None:
         self.center = (x, y) ; cave = self.game.cave
@@ -375,53 +299,103 @@ class CaveView(arcade.View):
             cy = min(max(y - height / 2, 0), (cave.height + 1) * Game.TILE_SIZE - height)
         self.camera.move_to((cx, cy) , speed)
 
-    def print(self, x: int, w: int, text: str) -> None:
-        (color, align, w) = (arcade.color.GRULLO, 'left', w) if w >= 0 else (arcade.color.DARK_PASTEL_GREEN, 'right', -w)
-        y = self.window.height - Game.TILE_SIZE * 17/16
-        arcade.draw_text(text, x*Game.TILE_SIZE, y, color, Game.TILE_SIZE, w * Game.TILE_SIZE, align, Game.FONT, anchor_y = 'bottom')
-
-    def notify(self, text: str, color) -> None:
-        arcade.draw_lrtb_rectangle_filled(Game.WIDTH/3, 2/3*Game.WIDTH, self.window.height/2 + Game.TILE_SIZE, self.window.height/2 - Game.TILE_SIZE, (0,0,0,128))
-        arcade.draw_lrtb_rectangle_outline(Game.WIDTH/3, 2/3*Game.WIDTH, self.window.height/2 + Game.TILE_SIZE, self.window.height/2 - Game.TILE_SIZE, arcade.color.GRULLO, Game.TILE_SIZE/16)
-        arcade.draw_text(text, 0, self.window.height/2 +Game.TILE_SIZE/16, color, Game.TILE_SIZE, Game.WIDTH, 'center', Game.FONT, anchor_y = 'center')
-
     def on_draw(self) -> None:
-        #start_time = time.time()
+        profiler = self.game.cave.profiler
         self.camera.use()
         arcade.set_background_color(CaveView.COLOR_OUT_OF_TIME if self.game.cave.time_remaining <= 5 else arcade.color.BLACK)
         self.clear()
-        self.sprite_list.draw()
+        if profiler is not None: start_time = time.perf_counter()
+        chunks = self.visible_chunks()
+        for chunk in chunks:
+            if chunk not in self.populated: self.populate(chunk)
+        for back in (True, False):
+            for chunk in chunks:
+                sprites = self.sprite_lists.get((chunk, back))
+                if sprites is not None: sprites.draw()
+        if profiler is not None: profiler.add('draw/sprites', time.perf_counter() - start_time) ; start_time = time.perf_counter()
         self.camera_gui.use()
-        arcade.draw_lrtb_rectangle_filled(0, self.window.width, self.window.height, self.window.height - Game.TILE_SIZE, (0,0,0,192))
-        self.print( 0, 3, 'LVL')   ; self.print( 0, -3, f'{self.game.cave.level:02}')
-        self.print( 3.5, 2.5, 'LIFE')  ; self.print( 3.5, -2.5, f'{self.game.players[0].life:01}')
-        self.print( 6.5, 3.5, 'TIME')    ; self.print( 6.5, -3.5, f'{math.ceil(self.game.cave.time_remaining):03}')
-        if self.game.cave.collected <= self.game.cave.to_collect:
-            self.print(10.5, 3.5, 'GOAL')    ; self.print(10.5, -3.5, f'{self.game.cave.to_collect-self.game.cave.collected:02}')
-        else:
-            self.print(10.5, 3.5, 'PLUS')    ; self.print(10.5, -3.5, f'{self.game.cave.collected-self.game.cave.to_collect:02}')
-        self.print(14.5, 5.5, 'SCR')   ; self.print(14.5, -5.5, f'{self.game.players[0].score:07}')
-        if self.game.cave.status == Cave.NOT_LOADED: self.notify("LOADING", arcade.color.GRULLO)
-        elif self.game.cave.status == Cave.PAUSED: self.notify("PAUSED", arcade.color.GRULLO)
-        elif self.game.cave.status == Cave.STARTING: self.notify("GET READY", arcade.color.BANANA_YELLOW)
-        elif self.game.cave.status == Cave.SUCCEEDED: self.notify("WELL DONE", arcade.color.DARK_PASTEL_GREEN)
-        elif self.game.cave.status == Cave.FAILED: self.notify("TRY AGAIN", arcade.color.CADMIUM_ORANGE)
-        elif self.game.cave.status == Cave.GAME_OVER: self.notify("GAME OVER", arcade.color.FERRARI_RED)
-        #print(f'on_draw : {(time.time() - start_time) * 1000} ms')
+        self.hud.update() ; self.hud.draw()
+        if profiler is not None: profiler.add('draw/hud', time.perf_counter() - start_time) ; self.draw_profile(profiler)
+
+    def draw_profile(self, profiler: Profiler) -> None:
+        lines = [ f'{"phase":<14}' + ''.join(f'{"p" + str(p):>8}' for p in Profiler.PERCENTILES) ]
+        lines += [ f'{phase:<14}' + ''.join(f'{value:>8.2f}' for value in values) for (phase, values) in profiler.summary() ]
+        rewinder = self.game.rewinder
+        lines += [ '', f'{"rewind":<14}{len(rewinder) * Cave.STEP:>7.1f}s{rewinder.memory() / 1024:>6.0f}KB' ]
+        lines += [ '', f'{"tile":<14}{"ticks":>8}' ]
+        lines += [ f'{name:<14}{ticks:>8.1f}' for (name, ticks) in [*profiler.ticks_per_frame().items()][:CaveView.PROFILE_TILES] ]
+        (size, top) = (CaveView.PROFILE_FONT_SIZE, self.window.height - Game.TILE_SIZE * 1.5)
+        arcade.draw_lrtb_rectangle_filled(0, size * 24, top, top - size * 1.5 * (len(lines) + 1), (0,0,0,192))
+        for (i, line) in enumerate(lines):
+            arcade.draw_text(line, size, top - size * 1.5 * (i + 1), arcade.color.WHITE, size, font_name = 'Courier New', anchor_y = 'center')
+
+    @staticmethod
+    def chunk_of(tile: Tile) -> Tuple[int,int]:
+        return (tile.x // CaveView.CHUNK_SIZE, tile.y // CaveView.CHUNK_SIZE)
+
+    def visible_chunks(self) -> List[Tuple[int,int]]:
+        cave = self.game.cave ; size = Game.TILE_SIZE * CaveView.CHUNK_SIZE
+        (left, bottom) = self.camera.position
+        columns = range(max(int(left // size), 0), min(int((left + self.window.width) // size), (cave.width - 1) // CaveView.CHUNK_SIZE) + 1)
+        rows = range(max(int(bottom // size), 0), min(int((bottom + self.window.height) // size), (cave.height - 1) // CaveView.CHUNK_SIZE) + 1)
+        return [ (cx, cy) for cy in rows for cx in columns ]
+
+    def populate(self, chunk: Tuple[int,int]) -> None:
+        cave = self.game.cave ; (cx, cy) = chunk ; size = CaveView.CHUNK_SIZE
+        self.populated.add(chunk)
+        for back in (True, False):
+            for y in range(cy * size, min((cy + 1) * size, cave.height)):
+                for x in range(cx * size, min((cx + 1) * size, cave.width)):
+                    tile = cave.at(x, y, back)
+                    if tile is not None and tile not in self.sprites: self.add_sprite(tile)
 
     def on_loaded(self) -> None:
-        self.sprite_list.clear()
+        self.sprite_lists.clear() ; self.free_sprites.clear()
+        self.sprites.clear() ; self.populated.clear() ; self.changes.clear()
+
+    def on_added(self, tile: Tile, _back: bool) -> None: self.changes[tile] = True
+    def on_removed(self, tile: Tile, _back: bool) -> None: self.changes[tile] = False
+    def on_changed(self, tile: Tile) -> None:
+        if tile in self.sprites and tile not in self.changes: self.changes[tile] = True
+
+    def add_sprite(self, tile: Tile) -> None:
+        key = (CaveView.chunk_of(tile), tile.back) ; free = self.free_sprites.get(key)
+        if free:
+            sprite = free.pop() ; sprite.attach(tile) ; sprite.visible = True
+        else:
+            sprite = TileSprite(tile) ; sprites = self.sprite_lists.get(key)
+            if sprites is None: sprites = self.sprite_lists[key] = arcade.SpriteList(atlas = TileSprite.atlas)
+            sprites.append(sprite)
+        self.sprites[tile] = sprite
+
+    def remove_sprite(self, tile: Tile) -> None:
+        # recycled rather than removed from its sprite list, which is costly
+        sprite = self.sprites.pop(tile) ; sprite.visible = False ; sprite.tile = None
+        self.free_sprites.setdefault((sprite.chunk, sprite.back), []).append(sprite)
+
+    def sync_sprites(self) -> None:
+        for (tile, present) in self.changes.items():
+            sprite = self.sprites.get(tile) ; chunk = CaveView.chunk_of(tile)
+            if sprite is not None and (not present or sprite.back != tile.back or sprite.chunk != chunk): self.remove_sprite(tile) ; sprite = None
+            if not present or chunk not in self.populated: continue # otherwise created once in view
+            if sprite is None: self.add_sprite(tile)
+            else: sprite.sync()
+        self.changes.clear()
 
     def on_update(self, delta_time):
-        #start_time = time.time()
-        self.game.cave.on_update(delta_time)
-        cave_tiles = { *self.game.cave.tiles(None, True), *self.game.cave.tiles() }
-        for s in self.sprite_list:
-            if not s in cave_tiles: self.sprite_list.remove(s)
-        for s in cave_tiles:
-            if len(s.sprite_lists) == 0: self.sprite_list.append(s)
-        self.sprite_list.sort(key = lambda s: not s.back)
-        #print(f'on_update : {(time.time() - start_time) * 1000} ms')
+        profiler = self.game.cave.profiler
+        if profiler is not None: profiler.next_frame() ; start_time = time.perf_counter()
+        speed = self.game.playback.speed if self.game.playback is not None else 1
+        if self.game.network is not None: self.game.network.pump()
+        elif arcade.key.BACKSPACE in self.game.keys and self.game.playback is None:
+            self.game.stop_recording()
+            self.game.rewinder.rewind(Game.REWIND_SPEED * (4 if arcade.key.LSHIFT in self.game.keys else 1))
+        else: self.game.cave.on_update(delta_time * speed, Cave.MAX_STEPS * speed)
+        if profiler is not None: profiler.add('cave', time.perf_counter() - start_time) ; start_time = time.perf_counter()
+        self.sync_sprites()
+        if profiler is not None: profiler.add('sync', time.perf_counter() - start_time) ; start_time = time.perf_counter()
+        Sound.flush()
+        if profiler is not None: profiler.add('sounds', time.perf_counter() - start_time)
 
 class Game(arcade.Window):
     ''' The main Boulder Dash game. Holds the game model. Manages views. Buffers keys and controllers. '''
@@ -433,29 +407,45 @@ class Game(arcade.Window):
     HEIGHT = TILE_SIZE * (HEIGHT_TILES + 1)
     TITLE = 'Boulder Dash'
     FONT = 'Kenney High Square'
+    LEVEL_KEYS = (arcade.key.NUM_ADD, arcade.key.NUM_SUBTRACT, arcade.key.NUM_MULTIPLY, arcade.key.F5, arcade.key.NUM_DIVIDE, arcade.key.F3)
+    REPLAY_SPEEDS = [1, 4, 16]
+    REWIND_SECONDS = 10
+    REWIND_SPEED = 2 # steps per frame, 4 times more with shift
 
     music = Sound(':resources:music/funkyrobot.mp3')
     sound_over = Sound(':resources:sounds/gameover3.wav')
 
     def __init__(self):
         super().__init__(Game.WIDTH, Game.HEIGHT, Game.TITLE, vsync = True)
+        Sound.backend = PooledSound ; PooledSound.voices = Voices()
         self.set_icon(pyglet.image.load('res/Boulder64.png'))
         self.keys = []
         self.controllers = []
         self.players = []
         self.cave = None
         self.music_player = None
+        self.recorder = None
+        self.playback = None
+        self.rewinder = None
+        self.network = None
 
     def create_players(self, nb_players: Optional[int] = None) -> None :
         if nb_players is None: nb_players = len(self.players)
         nb_players = min(max(nb_players, 1), 4)
-        self.players = [ Player(self, i) for i in range(nb_players) ]
+        self.players = [ KeyboardPlayer(self, i) for i in range(nb_players) ]
 
-    def setup(self) -> None:
+    def setup(self, record: Optional[str] = None, replay: Optional[str] = None, join: Optional[str] = None, host: Optional[int] = None, port: int = PORT) -> None:
+        Sound.preload()
         self.controllers = arcade.get_game_controllers()
         for ctrl in self.controllers: ctrl.open()
+        TileSprite.atlas = arcade.TextureAtlas((2048, 2048))
+        TextureRegistry.preload(TileSprite.atlas)
         self.create_players() ; self.cave = Cave(self)
+        self.rewinder = Rewinder(self.cave, Game.REWIND_SECONDS)
         self.show_view(CaveView(self))
+        if replay is not None: self.playback = Playback(self, replay)
+        if record is not None: self.start_recording(record)
+        if join is not None or host is not None: self.network = NetworkPlay(self, join or 'localhost', port, host)
         #self.toggle_music()
 
     def toggle_music(self) -> None:
@@ -470,14 +460,27 @@ class Game(arcade.Window):
             if self.cave.status == Cave.PAUSED: self.music_player.pause()
             else: self.music_player.play()
 
+    def start_recording(self, file_name: str) -> None:
+        self.stop_recording()
+        self.cave.status = Cave.NOT_LOADED ; self.cave.restart_level()
+        self.recorder = Recorder(self.cave, file_name)
+
+    def stop_recording(self) -> None:
+        if self.recorder is not None: self.recorder.close() ; self.recorder = None
+
     def center_on(self, x, y, speed = 1) -> None:
-        if self.current_view is not None: self.current_view.center_on(x, y, speed)
+        if self.current_view is not None: self.current_view.center_on(x * Game.TILE_SIZE, y * Game.TILE_SIZE, speed)
 
     def on_loaded(self) -> None:
         if self.current_view is not None: self.current_view.on_loaded()
 
     def on_key_press(self, symbol, modifiers):
         if not symbol in self.keys: self.keys.append(symbol)
+        if self.playback is not None and symbol in Game.LEVEL_KEYS:
+            if symbol in (arcade.key.NUM_MULTIPLY, arcade.key.F5): self.playback.restart()
+            return
+        if self.network is not None and (symbol in Game.LEVEL_KEYS or symbol == arcade.key.SPACE): return # the host leads
+        if symbol in Game.LEVEL_KEYS: self.stop_recording()
         if symbol == arcade.key.NUM_ADD : self.cave.next_level()
         elif symbol == arcade.key.NUM_SUBTRACT : self.cave.next_level(self.cave.level - 1)
         elif symbol in (arcade.key.NUM_MULTIPLY, arcade.key.F5):
@@ -488,6 +491,16 @@ class Game(arcade.Window):
             self.set_fullscreen(not self.fullscreen)
         elif symbol == arcade.key.F9: self.toggle_music()
         elif symbol == arcade.key.SPACE: self.pause()
+        elif symbol == arcade.key.F8: self.cave.profiler = Profiler() if self.cave.profiler is None else None
+        elif symbol == arcade.key.F7 and self.cave.profiler is not None:
+            self.cave.profiler.dump('profile.json') ; self.cave.profiler.dump('profile.csv')
+        elif symbol == arcade.key.F6 and self.playback is not None:
+            self.playback.speed = Game.REPLAY_SPEEDS[(Game.REPLAY_SPEEDS.index(self.playback.speed) + 1) % len(Game.REPLAY_SPEEDS)]
+
+    def on_close(self):
+        self.stop_recording()
+        if self.network is not None: self.network.close() ; self.network = None
+        super().on_close()
 
     def on_key_release(self, symbol, modifiers):
         if symbol in self.keys: self.keys.remove(symbol)
@@ -496,8 +509,18 @@ class Game(arcade.Window):
         Game.sound_over.play()
 
 if __name__ == '__main__':
-    import tiles, custom_tiles
-    tiles.register(Tile)
-    custom_tiles.register(Tile)
-    Game().setup()
+    parser = argparse.ArgumentParser(description = Game.TITLE)
+    parser.add_argument('--record', metavar = 'FILE', help = 'record the players inputs to a replay file')
+    parser.add_argument('--replay', metavar = 'FILE', help = 'play a replay file back (F6 to fast forward)')
+    parser.add_argument('--pack', metavar = 'FILE', help = 'play the levels of a pack compiled by levels.py')
+    network = parser.add_mutually_exclusive_group()
+    network.add_argument('--host', type = int, metavar = 'PLAYERS', help = 'host a network game for the given number of players, one playing here')
+    network.add_argument('--join', metavar = 'ADDRESS', help = 'join the network game of a host')
+    parser.add_argument('--port', type = int, default = PORT, help = f'of the network game (default : {PORT})')
+    args = parser.parse_args()
+    if (args.host is not None or args.join is not None) and (args.record is not None or args.replay is not None):
+        parser.error('replays are neither recorded nor played back over the network')
+    if args.pack is not None: Cave.pack = LevelPack.open(args.pack)
+    register_tiles()
+    Game().setup(args.record, args.replay, args.join, args.host, args.port)
     arcade.run()
@@ -0,0 +1,99 @@
+﻿''' Levels of the game, compiled from maps definitions into a binary pack, then loaded by memory mapping.
+    Usage : python levels.py [-o PACK] [SOURCE...] where sources are Python modules defining CAVE_MAPS (default : maps.py),
+    or JSON files holding a list of maps. '''
+
+from typing import Optional, List, Dict
+import argparse, json, mmap, os, runpy, struct, sys
+
+# A pack holds a header, the palette of the map characters (the empty one first), a table of the levels,
+# then for each level its cells, as indices in the palette, bottom row first, and its metadata as JSON.
+
+MAGIC = b'BDL1'
+HEADER = struct.Struct('<4sHH') # magic, number of levels, palette size in bytes
+ENTRY = struct.Struct('<IHHII') # cells offset, width, height, metadata offset, metadata size
+EMPTY = ' '
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+PACK_FILE = os.path.join(DIRECTORY, 'levels.bdl')
+MAPS_FILE = os.path.join(DIRECTORY, 'maps.py')
+
+class Level:
+    ''' A level in a pack. Its cells are a read-only view on the pack data, indexed by y * width + x. '''
+
+    def __init__(self, pack: 'LevelPack', num: int, width: int, height: int, cells: memoryview, meta: Dict) -> None:
+        self.pack = pack ; self.num = num
+        self.width = width ; self.height = height
+        self.cells = cells ; self.meta = meta
+
+class LevelPack:
+    ''' A compiled set of levels. Decoded once, the levels being views on the memory mapped (or in memory) data. '''
+
+    def __init__(self, data) -> None:
+        self.data = data ; view = memoryview(data)
+        (magic, count, size) = HEADER.unpack_from(view, 0)
+        if magic != MAGIC: raise ValueError('not a level pack')
+        self.palette = bytes(view[HEADER.size : HEADER.size + size]).decode('utf-8')
+        self.types = None ; self.named_types = None # tile types by palette index and by name, set by the game model
+        self.levels = []
+        for num in range(count):
+            (offset, width, height, meta_offset, meta_size) = ENTRY.unpack_from(view, HEADER.size + size + num * ENTRY.size)
+            meta = json.loads(bytes(view[meta_offset : meta_offset + meta_size]).decode('utf-8'))
+            self.levels.append(Level(self, num + 1, width, height, view[offset : offset + width * height], meta))
+
+    def __len__(self) -> int: return len(self.levels)
+    def __getitem__(self, i: int) -> Level: return self.levels[i]
+
+    @staticmethod
+    def open(file_name: str) -> 'LevelPack':
+        with open(file_name, 'rb') as file: return LevelPack(mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ))
+
+    @staticmethod
+    def default() -> 'LevelPack':
+        ''' The pack of the game levels, compiled again first if missing or older than the maps definitions. '''
+        if os.path.exists(PACK_FILE) and not (os.path.exists(MAPS_FILE) and os.path.getmtime(MAPS_FILE) > os.path.getmtime(PACK_FILE)):
+            return LevelPack.open(PACK_FILE)
+        data = compile_maps(read_maps(MAPS_FILE))
+        try:
+            with open(PACK_FILE, 'wb') as file: file.write(data)
+        except OSError: return LevelPack(data)
+        return LevelPack.open(PACK_FILE)
+
+def read_maps(file_name: str) -> List[Dict]:
+    if file_name.lower().endswith('.json'):
+        with open(file_name, encoding = 'utf-8') as file: return json.load(file)
+    return runpy.run_path(file_name)['CAVE_MAPS']
+
+def compile_maps(maps: List[Dict]) -> bytes:
+    palette = [EMPTY] ; indices = { EMPTY: 0 }
+    (tables, blobs) = ([], [])
+    for (num, cave_map) in enumerate(maps):
+        rows = cave_map['map'] ; (width, height) = (len(rows[0]), len(rows))
+        if any(len(row) != width for row in rows): raise ValueError(f'level {num + 1} : rows of different lengths')
+        cells = bytearray(width * height)
+        for y in range(height):
+            for (x, key) in enumerate(rows[height - 1 - y]):
+                if key not in indices:
+                    if len(palette) == 256: raise ValueError('too many different map characters')
+                    indices[key] = len(palette) ; palette.append(key)
+                cells[y * width + x] = indices[key]
+        meta = json.dumps({ key: value for (key, value) in cave_map.items() if key != 'map' }, ensure_ascii = False).encode('utf-8')
+        tables.append((width, height, len(meta))) ; blobs += [bytes(cells), meta]
+    palette = ''.join(palette).encode('utf-8')
+    offset = HEADER.size + len(palette) + len(maps) * ENTRY.size
+    data = [HEADER.pack(MAGIC, len(maps), len(palette)), palette]
+    for (width, height, meta_size) in tables:
+        data.append(ENTRY.pack(offset, width, height, offset + width * height, meta_size))
+        offset += width * height + meta_size
+    return b''.join(data + blobs)
+
+def main(args: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description = 'Boulder Dash levels compiler')
+    parser.add_argument('sources', nargs = '*', default = [MAPS_FILE], help = 'maps definitions (default : maps.py)')
+    parser.add_argument('-o', '--output', default = PACK_FILE, help = 'level pack to write (default : levels.bdl)')
+    args = parser.parse_args(args)
+    maps = [ cave_map for source in args.sources for cave_map in read_maps(source) ]
+    data = compile_maps(maps)
+    with open(args.output, 'wb') as file: file.write(data)
+    print(f'{args.output} : {len(maps)} levels, {len(data)} bytes')
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
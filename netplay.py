@@ -0,0 +1,220 @@
+﻿''' Networked multiplayer in lockstep, over asyncio streams. Clients send only their inputs, a few bytes per tick, for a
+    tick a little ahead (the input delay). The host gathers them into input frames, steps the simulation with them, and
+    broadcasts the frames for every client to step its own copy of the cave identically. The host adapts the input delay
+    to the latency of the clients, and sends the checksum of the cave periodically for them to detect any desync.
+    Usage : python netplay.py host [--players N] [--level L] [--seed S] [--port P] [--ticks T]
+            python netplay.py join [ADDRESS] [--port P] [--ticks T]
+            python netplay.py test [--players N] ... (host and clients on localhost, in one process)
+    To play rather than run scripted clients : python game.py --host N, or python game.py --join ADDRESS. '''
+
+from typing import Optional, List, Dict, Tuple, Callable
+import argparse, asyncio, random, socket, struct, sys, time
+from engine import Cave, Headless, Player
+from replay import ScriptedPlayer, encode, decode
+
+MAGIC = b'BDN1'
+WELCOME = struct.Struct('<4sHIBBB') # magic, level, seed, number of players, player, input delay
+INPUT = struct.Struct('<IBB') # tick, number of directions, directions
+FRAME = struct.Struct('<IBB') # tick, input delay, flags ; then the directions of each player, and the checksum if flagged
+DIRECTIONS = struct.Struct('<BB')
+CHECKSUM = struct.Struct('<I')
+HAS_CHECKSUM = 1 ; END = 2 # frame flags
+PORT = 7451
+HASH_PERIOD = 60 # ticks between checksums
+MIN_DELAY = 1 ; MAX_DELAY = 12 # ticks of input delay
+ADAPT_PERIOD = 60 # ticks between decreases of the input delay
+MAX_STALL = 0.5 # seconds waiting for a late input, beyond which the previous one is repeated
+
+def frame_size(nb_players: int) -> int: return FRAME.size + nb_players * DIRECTIONS.size
+
+def no_delay(writer: asyncio.StreamWriter) -> None:
+    # inputs are sent at once rather than coalesced
+    sock = writer.get_extra_info('socket')
+    if sock is not None: sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+class Peer:
+    ''' A client, as seen by the host : the inputs it sent, by tick, and how early they arrived. '''
+
+    def __init__(self, num: int, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.num = num ; self.reader = reader ; self.writer = writer
+        self.inputs = {} ; self.last = [] ; self.margin = float('inf') # ticks, the least since the last adaptation
+        self.received = 0 ; self.late = 0
+
+class Host:
+    ''' Runs the simulation of a cave at its fixed time step, in lockstep with the inputs of the clients. '''
+
+    def __init__(self, nb_players: int = 2, level: int = 1, seed: Optional[int] = None, port: int = PORT, ticks: Optional[int] = None) -> None:
+        self.nb_players = nb_players ; self.level = level ; self.port = port ; self.ticks = ticks
+        self.seed = seed if seed is not None else random.randrange(2**32)
+        self.game = Headless(nb_players, level, self.seed)
+        self.peers = [] ; self.joined = asyncio.Event() ; self.received = asyncio.Event()
+        self.tick = 0 ; self.delay = MIN_DELAY ; self.start_time = 0.0
+        self.sent = 0 ; self.stalls = 0 ; self.delays = 0 ; self.server = None
+
+    async def listen(self) -> None:
+        ''' Starts accepting the players, e.g. before one joins from the same process. '''
+        self.server = await asyncio.start_server(self.on_connect, port = self.port)
+
+    async def serve(self) -> None:
+        ''' Waits for all the players to join, then runs the game until the given number of ticks, if any. '''
+        if self.server is None: await self.listen()
+        await self.joined.wait()
+        try: await self.run()
+        finally:
+            for peer in self.peers: peer.writer.close()
+            self.server.close()
+
+    async def on_connect(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        if len(self.peers) == self.nb_players: writer.close() ; return
+        no_delay(writer)
+        peer = Peer(len(self.peers), reader, writer) ; self.peers.append(peer)
+        writer.write(WELCOME.pack(MAGIC, self.level, self.seed, self.nb_players, peer.num, self.delay))
+        for tick in range(self.delay): peer.inputs[tick] = [] # before any input can arrive
+        if len(self.peers) == self.nb_players: self.joined.set()
+        try:
+            while True:
+                (tick, count, code) = INPUT.unpack(await reader.readexactly(INPUT.size))
+                peer.received += INPUT.size
+                if tick < self.tick: peer.late += 1 ; continue # too late, the previous input was repeated
+                peer.inputs[tick] = decode(code, count)
+                peer.margin = min(peer.margin, (self.start_time + tick * Cave.STEP - time.perf_counter()) / Cave.STEP)
+                self.received.set()
+        except (asyncio.IncompleteReadError, ConnectionError): pass
+
+    async def gather(self) -> None:
+        # waits for the inputs of the current tick, at most for a while
+        deadline = time.perf_counter() + MAX_STALL ; stalled = False
+        while any(self.tick not in peer.inputs for peer in self.peers) and time.perf_counter() < deadline:
+            stalled = True ; self.received.clear()
+            try: await asyncio.wait_for(self.received.wait(), deadline - time.perf_counter())
+            except asyncio.TimeoutError: break
+        if stalled: self.stalls += 1 ; self.adapt(+1)
+
+    def adapt(self, change: int) -> None:
+        delay = min(max(self.delay + change, MIN_DELAY), MAX_DELAY)
+        if delay != self.delay: self.delay = delay ; self.delays += 1
+
+    async def run(self) -> None:
+        self.start_time = time.perf_counter() ; cave = self.game.cave
+        while self.ticks is None or self.tick < self.ticks:
+            # paced at the simulation time step, the inputs of the tick being due by then
+            wait = self.start_time + self.tick * Cave.STEP - time.perf_counter()
+            if wait > 0: await asyncio.sleep(wait)
+            await self.gather()
+            frame = [] ; late = self.start_time + self.tick * Cave.STEP < time.perf_counter() - Cave.STEP
+            for (peer, player) in zip(self.peers, self.game.players):
+                player.directions = peer.last = peer.inputs.pop(self.tick, peer.last)
+                frame.append(DIRECTIONS.pack(len(player.directions), encode(player.directions)))
+            if late: self.start_time = time.perf_counter() - self.tick * Cave.STEP # resume pacing from now on
+            self.game.step()
+            last = self.ticks is not None and self.tick + 1 == self.ticks
+            flags = (HAS_CHECKSUM if (self.tick + 1) % HASH_PERIOD == 0 or last else 0) | (END if last else 0)
+            data = FRAME.pack(self.tick, self.delay, flags) + b''.join(frame)
+            if flags & HAS_CHECKSUM: data += CHECKSUM.pack(cave.checksum())
+            for peer in self.peers: peer.writer.write(data)
+            self.sent += len(data) * len(self.peers) ; self.tick += 1
+            if self.tick % ADAPT_PERIOD == 0:
+                # a tick of margin left by every client : the delay can be shorter
+                if all(peer.margin > 1 for peer in self.peers): self.adapt(-1)
+                for peer in self.peers: peer.margin = float('inf')
+            await asyncio.gather(*(peer.writer.drain() for peer in self.peers))
+
+    def report(self) -> Dict:
+        ticks = max(self.tick, 1)
+        return { 'ticks': self.tick, 'delay': self.delay, 'delay_changes': self.delays, 'stalls': self.stalls,
+            'late_inputs': sum(peer.late for peer in self.peers),
+            'bytes_per_tick_up': round(sum(peer.received for peer in self.peers) / ticks / len(self.peers), 2),
+            'bytes_per_tick_down': round(self.sent / ticks / len(self.peers), 2) }
+
+def scripted_controls(seed: int) -> Callable[[Headless, int], List[Tuple[int,int]]]:
+    ''' Directions chosen at random, but reproducibly, every few ticks, as by the scripted player of the benchmarks. '''
+    rng = random.Random(seed) ; state = { 'directions': [] }
+    def controls(_game: Headless, tick: int) -> List[Tuple[int,int]]:
+        if tick % ScriptedPlayer.PERIOD == 0: state['directions'] = rng.choice(ScriptedPlayer.CHOICES)
+        return state['directions']
+    return controls
+
+class Client:
+    ''' Steps a copy of the cave of the host with the input frames it broadcasts, sending the inputs of its player
+        for a tick ahead. Counts the checksums that differ from the host ones, if any. The game stepped is a headless
+        one, or the one given (e.g. windowed), its players and cave set up as the host ones once welcomed. '''
+
+    def __init__(self, address: str = 'localhost', port: int = PORT, controls: Optional[Callable[[Headless, int], List[Tuple[int,int]]]] = None, game = None) -> None:
+        self.address = address ; self.port = port ; self.controls = controls
+        self.game = game ; self.num = None ; self.tick = 0 ; self.next_input = 0
+        self.desyncs = 0 ; self.checks = 0 ; self.sent = 0 ; self.delays = []
+
+    async def run(self) -> None:
+        (reader, writer) = await asyncio.open_connection(self.address, self.port) ; no_delay(writer)
+        try:
+            (magic, level, seed, nb_players, self.num, delay) = WELCOME.unpack(await reader.readexactly(WELCOME.size))
+            if magic != MAGIC: raise ValueError(f'{self.address}:{self.port} is not a game host')
+            self.game = self.setup(nb_players, level, seed) ; cave = self.game.cave
+            if self.controls is None: self.controls = scripted_controls(self.num)
+            self.next_input = delay ; self.send(writer, delay)
+            size = frame_size(nb_players)
+            while True:
+                data = await reader.readexactly(size)
+                (tick, delay, flags) = FRAME.unpack_from(data)
+                for (player, offset) in zip(self.game.players, range(FRAME.size, size, DIRECTIONS.size)):
+                    player.directions = decode(*reversed(DIRECTIONS.unpack_from(data, offset)))
+                cave.step() ; self.tick = tick + 1 ; self.delays.append(delay)
+                if flags & HAS_CHECKSUM:
+                    self.checks += 1
+                    if CHECKSUM.unpack(await reader.readexactly(CHECKSUM.size))[0] != cave.checksum(): self.desyncs += 1
+                if flags & END: break
+                self.send(writer, delay)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError): pass
+        finally: writer.close()
+
+    def setup(self, nb_players: int, level: int, seed: int):
+        # the game to step : as the host one, or the one given, with plain players then, as by a replay
+        if self.game is None: return Headless(nb_players, level, seed)
+        self.game.players = [ Player(self.game, i) for i in range(nb_players) ] ; cave = self.game.cave
+        cave.seed = seed ; cave.status = Cave.NOT_LOADED ; cave.next_level(level)
+        return self.game
+
+    def send(self, writer: asyncio.StreamWriter, delay: int) -> None:
+        # the inputs up to the tick ahead by the current delay (none when it decreased)
+        while self.next_input <= self.tick + delay - 1:
+            directions = list(self.controls(self.game, self.next_input))[:4]
+            writer.write(INPUT.pack(self.next_input, len(directions), encode(directions)))
+            self.sent += INPUT.size ; self.next_input += 1
+
+    def report(self) -> Dict:
+        return { 'player': self.num, 'ticks': self.tick, 'checks': self.checks, 'desyncs': self.desyncs,
+            'mean_delay': round(sum(self.delays) / max(len(self.delays), 1), 2), 'bytes_per_tick_up': round(self.sent / max(self.tick, 1), 2) }
+
+async def test(nb_players: int, level: int, seed: int, port: int, ticks: int) -> int:
+    ''' Runs a host and its clients on localhost. Returns the number of desyncs. '''
+    host = Host(nb_players, level, seed, port, ticks)
+    serving = asyncio.create_task(host.serve()) ; await asyncio.sleep(0.1)
+    clients = [ Client('localhost', port) for _ in range(nb_players) ]
+    await asyncio.gather(*(client.run() for client in clients)) ; await serving
+    print(f'host : {host.report()}', file = sys.stderr)
+    for client in clients: print(f'client : {client.report()}', file = sys.stderr)
+    return sum(client.desyncs for client in clients) + sum(1 for client in clients if client.checks == 0)
+
+def main(args: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description = 'Boulder Dash networked multiplayer')
+    parser.add_argument('mode', choices = ('host', 'join', 'test'))
+    parser.add_argument('address', nargs = '?', default = 'localhost', help = 'of the host to join (default : localhost)')
+    parser.add_argument('--players', type = int, default = 2, help = 'players to wait for (default : 2)')
+    parser.add_argument('--level', type = int, default = 1)
+    parser.add_argument('--seed', type = int, default = None)
+    parser.add_argument('--port', type = int, default = PORT)
+    parser.add_argument('--ticks', type = int, default = None, help = 'ticks to play (default : 10 seconds when testing, endless otherwise)')
+    args = parser.parse_args(args)
+    if args.mode == 'test':
+        return 1 if asyncio.run(test(args.players, args.level, args.seed or 0, args.port, args.ticks or round(10 / Cave.STEP))) > 0 else 0
+    if args.mode == 'host':
+        host = Host(args.players, args.level, args.seed, args.port, args.ticks)
+        asyncio.run(host.serve()) ; print(host.report(), file = sys.stderr)
+        return 0
+    client = Client(args.address, args.port)
+    asyncio.run(client.run()) ; print(client.report(), file = sys.stderr)
+    return 1 if client.desyncs > 0 else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,56 @@
+﻿''' Profiling of the game frames : time spent in each phase, and tiles updates per type. '''
+
+from typing import Dict, List, Tuple
+from collections import deque
+import json, time
+
+class Profiler:
+    ''' Measures the time spent in each phase of the frames, and counts the tiles updates per type.
+        Keeps the durations of the last frames in rolling windows, to get their percentiles.
+        Instrumented code only checks whether a profiler is installed, hence costs next to nothing otherwise. '''
+
+    WINDOW = 300 # frames
+    PERCENTILES = (50, 95, 99)
+
+    def __init__(self, window: int = WINDOW) -> None:
+        self.window = window ; self.frames = 0
+        self.durations = {} # phase -> durations of the last frames (ms)
+        self.current = {} # phase -> duration in the current frame (s)
+        self.ticks = {} # tile type name -> number of updates
+        self.last_frame = time.perf_counter()
+
+    def add(self, phase: str, duration: float) -> None:
+        self.current[phase] = self.current.get(phase, 0) + duration
+
+    def tick(self, kind: type) -> None:
+        name = kind.__name__ ; self.ticks[name] = self.ticks.get(name, 0) + 1
+
+    def next_frame(self) -> None:
+        now = time.perf_counter() ; self.add('frame', now - self.last_frame) ; self.last_frame = now
+        for phase in self.current.keys() - self.durations.keys(): self.durations[phase] = deque(maxlen = self.window)
+        for (phase, durations) in self.durations.items(): durations.append(self.current.get(phase, 0) * 1000)
+        self.current.clear() ; self.frames += 1
+
+    def percentiles(self, phase: str) -> Tuple[float, ...]:
+        durations = sorted(self.durations[phase]) ; n = len(durations)
+        return tuple(durations[min(n - 1, n * p // 100)] for p in Profiler.PERCENTILES)
+
+    def summary(self) -> List[Tuple[str, Tuple[float, ...]]]:
+        return [ (phase, self.percentiles(phase)) for phase in sorted(self.durations) if len(self.durations[phase]) > 0 ]
+
+    def ticks_per_frame(self) -> Dict[str, float]:
+        return { name: count / max(self.frames, 1) for (name, count) in sorted(self.ticks.items(), key = lambda item: -item[1]) }
+
+    def dump(self, file_name: str) -> None:
+        ''' Writes the percentiles of the phases durations and the tiles updates, as CSV or JSON (by file extension). '''
+        with open(file_name, 'w') as file:
+            if file_name.lower().endswith('.csv'):
+                file.write('phase,' + ','.join(f'p{p}_ms' for p in Profiler.PERCENTILES) + '\n')
+                for (phase, values) in self.summary(): file.write(phase + ',' + ','.join(f'{v:.4f}' for v in values) + '\n')
+                file.write('\ntile,ticks_per_frame\n')
+                for (name, ticks) in self.ticks_per_frame().items(): file.write(f'{name},{ticks:.3f}\n')
+            else:
+                json.dump({
+                    'frames': self.frames, 'window': self.window,
+                    'phases': { phase: dict(zip((f'p{p}' for p in Profiler.PERCENTILES), values)) for (phase, values) in self.summary() },
+                    'ticks_per_frame': self.ticks_per_frame() }, file, indent = 2)
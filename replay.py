@@ -0,0 +1,180 @@
+﻿''' Recording of the players inputs, and their playback, in the window or headless at maximum speed.
+    Replays in the replays directory, one per level, are regression fixtures : played back headless, each must end with
+    the checksum recorded. Usage : python replay.py [FILE...] (default : the fixtures) or python replay.py --record-fixtures
+    to record them again, once a change of the game rules is intended. '''
+
+from typing import Optional, Tuple, List, Dict, BinaryIO
+import argparse, glob, os, random, struct, sys, time
+from engine import Cave, CaveListener, Player, Headless
+
+# A replay file holds a header (level, seed and number of players) followed by records of the players directions,
+# written only when they change : the number of steps since the previous record, the player and its directions,
+# ended by the total number of steps and the checksum of the cave at that point.
+
+FIXTURES_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'replays')
+FIXTURE_SEED = 1234
+FIXTURE_STEPS = 900 # 15 seconds of game
+
+MAGIC = b'BDR1'
+HEADER = struct.Struct('<4sHIB')
+DIRECTIONS = [(0,+1), (-1,0), (0,-1), (+1,0)]
+END = 0xFF
+
+def write_varint(stream: BinaryIO, value: int) -> None:
+    while value >= 0x80: stream.write(bytes([value & 0x7F | 0x80])) ; value >>= 7
+    stream.write(bytes([value]))
+
+def read_varint(stream: BinaryIO) -> Optional[int]:
+    (value, shift) = (0, 0)
+    while True:
+        byte = stream.read(1)
+        if len(byte) == 0: return None
+        value |= (byte[0] & 0x7F) << shift ; shift += 7
+        if byte[0] < 0x80: return value
+
+def encode(directions: List[Tuple[int,int]]) -> int:
+    code = 0
+    for (i, direction) in enumerate(directions): code |= DIRECTIONS.index(direction) << (2 * i)
+    return code
+
+def decode(code: int, count: int) -> List[Tuple[int,int]]:
+    return [ DIRECTIONS[(code >> (2 * i)) & 3] for i in range(count) ]
+
+class ScriptedPlayer:
+    ''' Changes the directions of the players of a game at random, but reproducibly, every few steps. '''
+    CHOICES = [[], [(0,+1)], [(0,-1)], [(-1,0)], [(+1,0)], [(+1,0),(0,+1)], [(-1,0),(0,-1)]]
+    PERIOD = 8 # steps
+
+    def __init__(self, game: Headless, seed: int) -> None:
+        self.game = game ; self.random = random.Random(seed) ; self.tick = 0
+
+    def step(self) -> None:
+        if self.tick % ScriptedPlayer.PERIOD == 0:
+            for player in self.game.players: player.directions = self.random.choice(ScriptedPlayer.CHOICES)
+        self.tick += 1 ; self.game.step()
+
+class Recorder(CaveListener):
+    ''' Records the directions of the players at each step of a cave, from the start of its current level. '''
+
+    def __init__(self, cave: Cave, file_name: str) -> None:
+        self.cave = cave ; self.stream = open(file_name, 'wb')
+        self.tick = 0 ; self.last_tick = 0 ; self.last = [ [] for _ in cave.game.players ]
+        self.stream.write(HEADER.pack(MAGIC, cave.level, cave.seed, len(cave.game.players)))
+        cave.listeners.append(self)
+
+    def on_step(self, cave: Cave) -> None:
+        for player in cave.game.players:
+            directions = list(player.list_directions())[:4]
+            if directions != self.last[player.num]:
+                self.last[player.num] = directions
+                write_varint(self.stream, self.tick - self.last_tick) ; self.last_tick = self.tick
+                self.stream.write(bytes([player.num << 4 | len(directions), encode(directions)]))
+        self.tick += 1
+
+    def close(self) -> None:
+        self.cave.listeners.remove(self)
+        write_varint(self.stream, self.tick - self.last_tick)
+        self.stream.write(bytes([END])) ; self.stream.write(struct.pack('<I', self.cave.checksum()))
+        self.stream.close()
+
+class Playback(CaveListener):
+    ''' Plays a replay back in a game (windowed or headless), streaming the file and feeding the recorded directions
+        to the players of the cave, step by step. Can fast forward, and seek to a given step. '''
+
+    def __init__(self, game, file_name: str) -> None:
+        self.game = game ; self.file_name = file_name ; self.stream = None
+        self.tick = 0 ; self.next_tick = 0 ; self.next_record = None
+        self.finished = False ; self.checksum = None ; self.speed = 1
+        self.restart()
+
+    def restart(self) -> None:
+        if self.stream is not None: self.stream.close()
+        self.stream = open(self.file_name, 'rb')
+        (magic, level, seed, nb_players) = HEADER.unpack(self.stream.read(HEADER.size))
+        if magic != MAGIC: raise ValueError(f'{self.file_name} is not a replay file')
+        self.tick = 0 ; self.next_tick = 0 ; self.finished = False ; self.checksum = None
+        self.game.players = [ Player(self.game, i) for i in range(nb_players) ]
+        cave = self.game.cave
+        if self not in cave.listeners: cave.listeners.append(self)
+        cave.seed = seed ; cave.status = Cave.NOT_LOADED ; cave.next_level(level)
+        self.read_record() ; self.check_end()
+
+    def read_record(self) -> None:
+        delta = read_varint(self.stream) ; head = self.stream.read(1)
+        if delta is None or len(head) == 0: self.next_record = (END, 0) ; return
+        self.next_tick += delta
+        if head[0] == END:
+            self.next_record = (END, 0) ; self.checksum = struct.unpack('<I', self.stream.read(4))[0]
+        else: self.next_record = (head[0], self.stream.read(1)[0])
+
+    def on_step(self, _cave: Cave) -> None:
+        if self.finished: return
+        while self.next_record[0] != END and self.next_tick <= self.tick:
+            (head, code) = self.next_record
+            self.game.players[head >> 4].directions = decode(code, head & 0x0F)
+            self.read_record()
+        self.tick += 1 ; self.check_end()
+
+    def check_end(self) -> None:
+        if self.next_record[0] == END and self.next_tick <= self.tick:
+            self.finished = True
+            for player in self.game.players: player.directions = []
+
+    def is_valid(self) -> bool:
+        return self.finished and (self.checksum is None or self.checksum == self.game.cave.checksum())
+
+    def seek(self, tick: int) -> None:
+        if tick < self.tick: self.restart()
+        while self.tick < tick and not self.finished: self.game.cave.step()
+
+    def run(self) -> None:
+        while not self.finished: self.game.cave.step()
+
+    def close(self) -> None:
+        if self in self.game.cave.listeners: self.game.cave.listeners.remove(self)
+        self.stream.close()
+
+def verify(file_name: str) -> Dict:
+    ''' Plays a replay headless at maximum speed, and checks it ends as recorded. '''
+    game = Headless()
+    playback = Playback(game, file_name)
+    start_time = time.perf_counter()
+    playback.run()
+    duration = time.perf_counter() - start_time
+    result = { 'file': file_name, 'valid': playback.is_valid(), 'steps': playback.tick, 'seconds': duration,
+        'level': game.cave.level, 'score': [ player.score for player in game.players ] }
+    playback.close()
+    return result
+
+def play(file_name: str) -> bool:
+    result = verify(file_name) ; (steps, duration) = (result['steps'], result['seconds'])
+    print(f'{file_name} : {steps} steps in {duration:.3f} s ({steps / max(duration, 1e-9):.0f} steps/s), ' +
+        f'level {result["level"]}, score {result["score"]} : {"OK" if result["valid"] else "MISMATCH"}')
+    return result['valid']
+
+def fixtures() -> List[str]:
+    ''' The replays kept as regression fixtures. '''
+    return sorted(glob.glob(os.path.join(FIXTURES_DIRECTORY, '*.bdr')))
+
+def fixture_of(level: int) -> str: return os.path.join(FIXTURES_DIRECTORY, f'level{level:02}.bdr')
+
+def record(file_name: str, level: int, seed: int = FIXTURE_SEED, steps: int = FIXTURE_STEPS) -> None:
+    ''' Records a replay headless, a single player being driven by a ScriptedPlayer. '''
+    game = Headless(1, level, seed)
+    recorder = Recorder(game.cave, file_name) ; player = ScriptedPlayer(game, level)
+    for _ in range(steps): player.step()
+    recorder.close()
+
+def main(args: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description = 'Boulder Dash replays')
+    parser.add_argument('files', nargs = '*', help = 'replays to play back headless (default : the fixtures)')
+    parser.add_argument('--record-fixtures', action = 'store_true', help = 'record the fixtures again, one per level')
+    args = parser.parse_args(args)
+    if args.record_fixtures:
+        os.makedirs(FIXTURES_DIRECTORY, exist_ok = True)
+        for level in range(1, len(Cave.level_pack()) + 1): record(fixture_of(level), level)
+    results = [ play(file_name) for file_name in args.files or fixtures() ]
+    return 0 if all(results) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,177 @@
+﻿''' Rewinding of the game, tick by tick, from a bounded history of the changes of the cave.
+    Usage : python rewind.py LEVEL STEPS [KIND...] prints the changes of the tiles of the given kinds (default : all)
+    while an idle player lets the cave live, e.g. to debug amoebas and magic walls. '''
+
+from typing import Optional, List, Iterator, Tuple
+from collections import deque
+import sys
+from engine import Cave, CaveListener, Tile, Headless
+
+MISSING = object() # marks a tile field that did not exist yet
+
+class Delta:
+    ''' The changes of a cave during one tick, as needed to revert them : the previous tiles at the positions set, the
+        previous values of the tile fields changed, the previous places of the tiles moved in the scheduler, the previous
+        state of the rules notified, and the previous state of the cave and players. It may come with its inverse, the
+        delta redoing the changes once reverted (see Rewinder.delta). '''
+    __slots__ = ('tick', 'front', 'back', 'fields', 'cave', 'players', 'rules', 'random', 'scheduler', 'inverse')
+
+class Rewinder(CaveListener):
+    ''' Logs the changes of a cave at each step, in a ring buffer of the last ones, to revert them on demand. Not
+        listening to the cave, it only takes and reverts the deltas asked for, e.g. over several steps. '''
+
+    SECONDS = 10 # of history, by default
+
+    def __init__(self, cave: Cave, seconds: float = SECONDS, listen: bool = True) -> None:
+        self.cave = cave ; self.size = round(seconds / Cave.STEP)
+        self.deltas = deque(maxlen = self.size) ; self.tick = 0
+        self.snapshot = None ; self.key = None # random generator key, shared by consecutive states
+        if listen: cave.listeners.append(self)
+        self.capture()
+
+    def __len__(self) -> int: return len(self.deltas)
+
+    def capture(self, reverted: Optional[Delta] = None) -> None:
+        # the state of the cave not covered by its journal, as the reference for the next delta : as is, or as before
+        # the delta just reverted, known already
+        self.cave.take_delta() ; self.snapshot = self.cave.snapshot
+        if reverted is None: (self.state, self.players, self.random, self.frame) = self.current()
+        else:
+            (self.state, self.players, self.random, self.frame) = (reverted.cave, reverted.players, reverted.random, reverted.scheduler[0])
+            self.key = reverted.random[1]
+
+    def current(self) -> Tuple[tuple, list, tuple, int]:
+        # the state of the cave and players, of the random generator (its key shared with the previous states if alike),
+        # and the frame of the scheduler
+        cave = self.cave
+        (version, key, gauss) = cave.random.getstate()
+        if self.key is None or key[:-1] != self.key[:-1]: self.key = key
+        return ((cave.status, cave.wait, cave.to_collect, cave.collected, cave.time_remaining),
+            [ (player._score, player.life) for player in cave.game.players ], (version, self.key, key[-1], gauss), cave.scheduler.frame)
+
+    def on_step(self, cave: Cave) -> None:
+        if cave.snapshot is not self.snapshot: self.deltas.clear() # loaded another level : no way back
+        else: self.deltas.append(self.delta())
+        self.tick += 1 ; self.capture()
+
+    def delta(self, inverse: bool = False) -> Delta:
+        ''' The changes since the last capture, to revert them, with the delta to redo them if asked for (as its inverse,
+            instead of taking it after the revert). '''
+        cave = self.cave
+        (front, back, states, places, rules) = cave.take_delta()
+        delta = Delta() ; delta.tick = self.tick
+        delta.front = { i: (tile, cave.front.objects.get(i)) for (i, tile) in front.items() }
+        delta.back = { i: (tile, cave.back.objects.get(i)) for (i, tile) in back.items() }
+        delta.fields = {}
+        for (tile, state) in states.items():
+            current = tile.get_state()
+            fields = { key: value for (key, value) in state.items() if key not in current or (current[key] is not value and current[key] != value) }
+            for key in current.keys() - state.keys(): fields[key] = MISSING
+            if len(fields) > 0: delta.fields[tile] = fields
+        (delta.cave, delta.players, delta.random) = (self.state, self.players, self.random)
+        delta.rules = { rule: state for (rule, state) in rules.items() if rule.__dict__ != state } or None
+        places = { tile: place for (tile, place) in places.items() if cave.scheduler.place(tile) != place }
+        delta.scheduler = (self.frame, places or None) ; delta.inverse = None
+        if inverse:
+            redo = delta.inverse = Delta() ; redo.tick = self.tick ; redo.inverse = None
+            redo.front = { i: (after, before) for (i, (before, after)) in delta.front.items() }
+            redo.back = { i: (after, before) for (i, (before, after)) in delta.back.items() }
+            redo.fields = { tile: { key: getattr(tile, key, MISSING) for key in fields } for (tile, fields) in delta.fields.items() }
+            (redo.cave, redo.players, redo.random, frame) = self.current()
+            redo.rules = { rule: dict(rule.__dict__) for rule in delta.rules } if delta.rules is not None else None
+            redo.scheduler = (frame, { tile: cave.scheduler.place(tile) for tile in places } or None)
+        return delta
+
+    def rewind(self, nb_ticks: int = 1) -> int:
+        ''' Reverts the last steps, at most the given number. Returns the number of steps actually reverted. '''
+        cave = self.cave ; count = 0
+        if cave.snapshot is not self.snapshot: self.deltas.clear()
+        else: self.deltas.append(self.delta()) ; self.tick += 1 # changes since the last step, if any
+        while count < nb_ticks and len(self.deltas) > 0:
+            delta = self.deltas.pop() ; count += 1
+            self.revert(delta, count == nb_ticks or len(self.deltas) == 0) ; self.tick = delta.tick
+        cave.scheduler.rebuild_wheel() ; cave.lag = 0
+        self.capture()
+        return count
+
+    def revert(self, delta: Delta, last: bool = True) -> None:
+        ''' Sets the cave back as before a delta, journaled as any change : the next delta is the one to redo it. The
+            state of the cave and players and the random generator, not journaled, are only set back by the last of
+            several deltas, and the timer wheel of the scheduler is left to rebuild. '''
+        cave = self.cave ; scheduler = cave.scheduler ; states = {}
+        for (tile, fields) in delta.fields.items():
+            state = states[tile] = tile.get_state()
+            for (key, value) in fields.items():
+                if value is MISSING: del state[key]
+                else: state[key] = value
+        cave.revert({ i: before for (i, (before, _)) in delta.front.items() },
+            { i: before for (i, (before, _)) in delta.back.items() }, states)
+        for (rule, state) in (delta.rules or {}).items(): cave.touch_rule(rule) ; rule.__dict__.update(state)
+        if last:
+            (cave.status, cave.wait, cave.to_collect, cave.collected, cave.time_remaining) = delta.cave
+            for (player, (score, life)) in zip(cave.game.players, delta.players): (player._score, player.life) = (score, life)
+            (version, key, index, gauss) = delta.random
+            cave.random.setstate((version, key[:-1] + (index,), gauss))
+        (frame, places) = delta.scheduler
+        if last: scheduler.frame = frame
+        for (tile, place) in (places or {}).items():
+            if scheduler.journal is not None: scheduler.touch(tile)
+            scheduler.put(tile, place)
+
+    @staticmethod
+    def merge(deltas: List[Delta]) -> Delta:
+        ''' The delta reverting several ones at once, as reverting them in turn would : the last one to revert a tile,
+            a field or a place sets it. '''
+        last = deltas[-1] ; merged = Delta() ; merged.front = {} ; merged.back = {} ; merged.fields = {} ; rules = {} ; places = {}
+        for delta in deltas:
+            merged.front.update(delta.front) ; merged.back.update(delta.back)
+            for (tile, fields) in delta.fields.items():
+                if tile in merged.fields: merged.fields[tile].update(fields)
+                else: merged.fields[tile] = dict(fields)
+            if delta.rules is not None: rules.update(delta.rules)
+            if delta.scheduler[1] is not None: places.update(delta.scheduler[1])
+        (merged.tick, merged.cave, merged.players, merged.random, merged.inverse) = (last.tick, last.cave, last.players, last.random, None)
+        (merged.rules, merged.scheduler) = (rules or None, (last.scheduler[0], places or None))
+        return merged
+
+    def memory(self) -> int:
+        ''' Estimates the memory used by the history, in bytes, including the tiles only it keeps alive. '''
+        size = sys.getsizeof(self.deltas) ; keys = set()
+        for delta in self.deltas:
+            size += sys.getsizeof(delta) + sys.getsizeof(delta.front) + sys.getsizeof(delta.back) + sys.getsizeof(delta.fields)
+            size += sum(sys.getsizeof(fields) for fields in delta.fields.values())
+            if delta.scheduler[1] is not None:
+                size += sys.getsizeof(delta.scheduler[1]) + sum(sys.getsizeof(place) for place in delta.scheduler[1].values())
+            if delta.rules is not None: size += sys.getsizeof(delta.rules) + sum(sys.getsizeof(state) for state in delta.rules.values())
+            if id(delta.random[1]) not in keys: keys.add(id(delta.random[1])) ; size += sys.getsizeof(delta.random[1])
+            for (before, _) in [ *delta.front.values(), *delta.back.values() ]:
+                if before is not None and self.cave.at(before.x, before.y, before.back) is not before:
+                    size += sys.getsizeof(before)
+        return size
+
+    def describe(self, kinds: Optional[List[type]] = None) -> Iterator[str]:
+        ''' Lists the changes logged, oldest first, restricted to the tiles of the given kinds if any. '''
+        def wanted(tile: Optional[Tile]) -> bool:
+            return tile is not None and (kinds is None or any(isinstance(tile, kind) for kind in kinds))
+        def name(tile: Optional[Tile]) -> str: return type(tile).__name__ if tile is not None else '_'
+        for delta in self.deltas:
+            for (grid, positions) in [('front', delta.front), ('back', delta.back)]:
+                for (i, (before, after)) in sorted(positions.items()):
+                    if wanted(before) or wanted(after):
+                        yield f'{delta.tick:>6} {grid} ({i % self.cave.width},{i // self.cave.width}) : {name(before)} -> {name(after)}'
+            for (tile, fields) in delta.fields.items():
+                if wanted(tile):
+                    changes = ', '.join(f'{key} {"-" if value is MISSING else value!r}' for (key, value) in sorted(fields.items()))
+                    yield f'{delta.tick:>6} {name(tile)} ({tile.x},{tile.y}) was : {changes}'
+
+    def close(self) -> None:
+        if self in self.cave.listeners: self.cave.listeners.remove(self)
+        self.cave.stop_deltas()
+
+if __name__ == '__main__':
+    game = Headless(1, int(sys.argv[1]))
+    kinds = [ kind for kind in Tile.kinds[1:] if kind.__name__ in sys.argv[3:] ] or None
+    rewinder = Rewinder(game.cave, int(sys.argv[2]) * Cave.STEP)
+    game.run(int(sys.argv[2]))
+    for line in rewinder.describe(kinds): print(line)
+    print(f'{len(rewinder)} steps logged in {rewinder.memory() // 1024} KB')
@@ -0,0 +1,300 @@
+﻿''' Search of solutions to caves, over the headless simulation : breadth first, A* or beam search of the miner moves
+    collecting the diamonds needed then reaching the exit, in time. E.g. to check that levels are solvable, or for
+    reference times. Each state costs the ticks of a move, with the tiles only animated asleep, and the deltas to
+    come back to it : a couple thousand states per second. Usage : python solver.py [--method beam|astar|bfs]
+    [--pack FILE] [LEVEL...] (default : all) '''
+
+from typing import Optional, List, Dict, FrozenSet, Tuple
+import argparse, heapq, itertools, json, operator, sys, time, zlib
+from engine import Cave, Headless, Tile, register_tiles
+from levels import LevelPack
+from rewind import Rewinder
+
+MOVES = { 'U': (0,+1), 'D': (0,-1), 'L': (-1,0), 'R': (+1,0), '.': None } # by name, None to wait
+WAIT_TICKS = 7 # of a wait move, about as long as a step
+UNKEYED = frozenset(('cave', 'back', 'x', 'y', 'skins', 'nb_skins', 'skin')) # tile fields in the codes already, or only drawn
+keyed = {} # tile type -> getter of the other fields
+(FREE, ASK, TARGET) = (1, 2, 4) # entries of the cells, for the distance of the miner to them
+
+class Node:
+    ''' A state in the search, reached by a move from its parent, whose deltas undo and redo it. '''
+    __slots__ = ('parent', 'move', 'depth', 'ticks', 'score', 'status', 'collected', 'key', 'undo', 'redo')
+
+    def __init__(self, parent: Optional['Node'], move: str, ticks: int, cave: Cave) -> None:
+        self.parent = parent ; self.move = move
+        self.depth = parent.depth + 1 if parent is not None else 0 ; self.ticks = ticks ; self.score = 0
+        self.status = cave.status ; self.collected = min(cave.collected, cave.to_collect) ; self.key = self.undo = self.redo = None
+
+    def moves(self) -> str:
+        moves = [] ; node = self
+        while node.parent is not None: moves.append(node.move) ; node = node.parent
+        return ''.join(reversed(moves))
+
+def miner_of(cave: Cave) -> Optional[Tile]:
+    miners = cave.tiles(cave.miner_type)
+    return miners[0] if len(miners) > 0 else None
+
+def tile_key(tile: Tile) -> tuple:
+    # the fields of a tile its next updates depend on (e.g. doors opened, directions, waits)
+    values = keyed.get(type(tile))
+    if values is None: values = keyed[type(tile)] = operator.attrgetter(*(field for field in tile.fields if field not in UNKEYED))
+    return values(tile)
+
+def tile_keys(cave: Cave) -> Dict[int, tuple]:
+    ''' The keys of the tiles not plain of a cave, by cell (those of the back grid after the front ones). '''
+    return { offset + i: tile_key(tile) for (offset, grid) in ((0, cave.front), (cave.size, cave.back))
+        for (i, tile) in grid.objects.items() if not tile.plain }
+
+def packed(cave: Cave) -> int:
+    # the codes of the cells of a cave, front then back, as one number
+    return int.from_bytes(cave.front.codes.tobytes() + cave.back.codes.tobytes(), 'little')
+
+def state_key(cave: Cave, reference: Tuple[int, Dict[int, tuple]], parent: Optional[tuple] = None) -> tuple:
+    ''' The key of the state of a cave, exact : its codes, compressed as they differ from reference ones (see packed),
+        the diamonds collected, and the keys of the tiles not plain that differ from reference ones (see tile_keys), by
+        cell. Given the key of the state the changes since are journaled from (see Cave.take_delta), only the cells they
+        touched are looked at again. Tiles referred to by the fields of others are told apart by identity : states are
+        compared within a game. '''
+    (codes, keys) = reference
+    if parent is None: fields = { cell: key for (cell, key) in tile_keys(cave).items() if keys.get(cell) != key }
+    else:
+        (size, width) = (cave.size, cave.width) ; (front, back, states) = cave.since_delta ; fields = dict(parent[2])
+        cells = { *front, *cave.front.journal, *(size + i for i in itertools.chain(back, cave.back.journal)),
+            *((size if tile.back else 0) + tile.y * width + tile.x for tile in itertools.chain(states, cave.touched)) }
+        for cell in cells:
+            tile = cave.front.objects.get(cell) if cell < size else cave.back.objects.get(cell - size)
+            key = tile_key(tile) if tile is not None and not tile.plain else None
+            if key is not None and keys.get(cell) != key: fields[cell] = key
+            else: fields.pop(cell, None)
+    changes = (packed(cave) ^ codes).to_bytes(2 * cave.size, 'little') # mostly zeros
+    packer = zlib.compressobj(1, zlib.DEFLATED, -9, 2) # raw and small : much quicker to set up, for so few bytes
+    return (packer.compress(changes) + packer.flush(), cave.collected, frozenset(fields.items()))
+
+def advance(game: Headless, move: str) -> int:
+    ''' Plays a move of the miner, until it can move again. Returns the number of ticks. '''
+    cave = game.cave ; direction = MOVES[move]
+    game.players[0].directions = [] if direction is None else [direction]
+    miner = miner_of(cave) ; ticks = 0 ; acted = False
+    while True:
+        ready = miner.wait <= 0 # the miner acts during this step
+        game.step() ; ticks += 1 ; acted = acted or ready
+        if cave.status != Cave.IN_PROGRESS or cave.at(miner.x, miner.y) is not miner: break
+        if acted and miner.wait <= 0 and (direction is not None or ticks >= WAIT_TICKS): break
+    game.players[0].directions = []
+    return ticks
+
+def enter(game: Headless) -> int:
+    ''' Lets the miner enter the cave. Returns the number of ticks. '''
+    cave = game.cave ; ticks = 0
+    while cave.status == Cave.STARTING and ticks < 10 / Cave.STEP: game.step() ; ticks += 1
+    return ticks
+
+def replay(level: int, moves: str, seed: int = 0) -> Headless:
+    ''' Plays the moves of a solution from the start of a level, e.g. to check it. '''
+    game = Headless(1, level, seed) ; game.players[0].life = 1 ; enter(game)
+    for move in moves:
+        if game.cave.status != Cave.IN_PROGRESS: break
+        advance(game, move)
+    return game
+
+class Solver:
+    ''' Searches the moves of the miner that solve a cave. All states live in one headless game, moved from one to the
+        other by the deltas of the moves, through their closest common ancestor, and are deduplicated by key in a
+        transposition table. Dead ones are pruned : miner dead or trapped, time out, or diamonds out of reach.
+        The game is drowsy (see Scheduler.drowsy) : the tiles only animated or drawing rolls that cannot happen
+        sleep, several times as many states per second, but the random draws differ from the game. So a solution found is
+        played again in the game as is, from the start, and rejected unless it solves the cave there too. '''
+
+    METHODS = ('beam', 'astar', 'bfs')
+    MAX_STATES = 200000
+    BEAM_WIDTH = 64
+
+    def __init__(self, level: int, method: str = 'beam', max_states: int = MAX_STATES, beam_width: int = BEAM_WIDTH, seed: int = 0) -> None:
+        register_tiles()
+        import tiles, custom_tiles # for the kinds of tiles the pruning depends on
+        self.targets = (tiles.Diamond, custom_tiles.SmallDiamond)
+        self.sources = (tiles.Butterfly, tiles.Amoeba, tiles.MagicWall, custom_tiles.CrackedBoulder, custom_tiles.Crate)
+        self.exit = tiles.Exit
+        (self.target_codes, self.source_codes) = (frozenset().union(*map(Tile.codes_of, kinds)) for kinds in (self.targets, self.sources))
+        self.level = level ; self.method = method ; self.max_states = max_states ; self.beam_width = beam_width ; self.seed = seed
+        self.game = Headless(1, level, seed) ; self.game.players[0].life = 1 ; self.game.cave.scheduler.drowsy = True
+        self.trail = None ; self.node = None # the deltas taken, and the node the game is at
+        self.reference = (0, {}) # codes and tile keys at the start, the state keys are relative to
+        self.table = {} # state key -> depth first reached
+        self.tables = {} # kinds of tiles -> entries of the cells, for the distance to the nearest
+        self.expanded = self.generated = self.pruned = self.duplicates = self.rejected = 0
+        self.duration = 0.0
+
+    def start(self) -> Optional[Node]:
+        ticks = enter(self.game) ; cave = self.game.cave
+        if cave.status != Cave.IN_PROGRESS: return None
+        self.trail = Rewinder(cave, 0, listen = False) ; self.reference = (packed(cave), tile_keys(cave))
+        self.node = Node(None, '', ticks, cave) ; self.node.key = state_key(cave, self.reference)
+        return self.node
+
+    def goto(self, node: Node) -> None:
+        # moves the game to a node : up to the closest common ancestor, undoing the moves, then down, redoing them
+        (up, down) = (self.node, node) ; (undos, redos) = ([], [])
+        while up is not down:
+            if up.depth >= down.depth: undos.append(up.undo) ; up = up.parent
+            else: redos.append(down.redo) ; down = down.parent
+        path = undos + redos[::-1]
+        if path:
+            delta = Rewinder.merge(path) if len(path) > 1 else path[0]
+            self.trail.revert(delta) ; self.trail.capture(delta) ; self.game.cave.scheduler.rebuild_wheel()
+        self.node = node
+
+    @staticmethod
+    def count(cave: Cave, codes: FrozenSet[int]) -> int:
+        # tiles of the given codes, as Grid.count does by kind
+        return sum(len(cave.front.index[code]) + cave.front.lazy[code] for code in codes)
+
+    def is_dead(self, cave: Cave) -> bool:
+        if cave.status != Cave.IN_PROGRESS: return cave.status != Cave.SUCCEEDED
+        miner = miner_of(cave)
+        if miner is None: return True
+        if not cave.is_complete() and Solver.count(cave, self.source_codes) == 0:
+            if cave.collected + Solver.count(cave, self.target_codes) < cave.to_collect: return True
+        if any(tile.moving for awake in cave.scheduler.awake for tile in awake) or cave.scheduler.parked: return False
+        for direction in MOVES.values():
+            if direction is None: continue
+            neighbor = miner.neighbor(*direction)
+            if neighbor is None or neighbor.acting or miner.can_move(*direction) or not neighbor.plain: return False
+        return True # walled in, with nothing moving around
+
+    def entries(self, cave: Cave, miner: Tile, kinds: Tuple[type, ...]) -> bytes:
+        # by code, whether the miner can enter the cells (FREE, or ASK the tile), and whether they are TARGETs
+        table = self.tables.get(kinds)
+        if table is None:
+            table = bytearray(256) ; table[0] = FREE ; targets = frozenset().union(*(Tile.codes_of(kind) for kind in kinds))
+            for kind in Tile.kinds[1:]:
+                if kind.plain: # alike wherever they are
+                    tile = cave.front.flyweight(kind.code)
+                    entered = { tile.can_be_occupied(miner, ix, iy) for (ix, iy) in Cave.STEPS }
+                    table[kind.code] = ASK if len(entered) > 1 else FREE if True in entered else 0
+                else: table[kind.code] = ASK
+                if kind.code in targets: table[kind.code] |= TARGET
+            table = self.tables[kinds] = bytes(table)
+        return table
+
+    def distance(self, cave: Cave, miner: Tile, kinds: Tuple[type, ...]) -> int:
+        # moves of the miner to the nearest tile of the given kinds, through the cells it can enter as they are now,
+        # by the neighbor table (the moves looked up the slow way left aside)
+        (links, size, width, front) = (cave.links, cave.size, cave.width, cave.front)
+        cells = front.codes.tobytes().translate(self.entries(cave, miner, kinds))
+        slots = [ (slot * size, ix, iy) for (slot, (ix, iy)) in enumerate(Cave.STEPS) ]
+        start = miner.y * width + miner.x ; seen = bytearray(size) ; seen[start] = 1 ; frontier = [start] ; steps = 0
+        while frontier:
+            steps += 1 ; reached = []
+            for i in frontier:
+                for (offset, ix, iy) in slots:
+                    j = links[offset + i]
+                    if j < 0 or seen[j]: continue
+                    seen[j] = 1 ; entry = cells[j]
+                    if entry & ASK:
+                        tile = front.objects.get(j) or front.flyweight(front.codes[j])
+                        if not tile.can_be_occupied(miner, ix, iy): continue
+                    elif not entry & FREE: continue
+                    if entry & TARGET: return steps
+                    reached.append(j)
+            frontier = reached
+        return cave.width * cave.height # out of reach, for now
+
+    def estimate(self, cave: Cave) -> int:
+        # moves still needed, at least : to the nearest diamond (then one per diamond), or to the exit
+        if cave.status == Cave.SUCCEEDED: return 0
+        miner = miner_of(cave)
+        if cave.is_complete(): return self.distance(cave, miner, (self.exit,))
+        return self.distance(cave, miner, self.targets) + max(cave.to_collect - cave.collected - 1, 0)
+
+    def expand(self, node: Node) -> List[Node]:
+        # the moves play from the node, each reverted by its delta, kept with its inverse by the child if the state is new
+        self.goto(node) ; self.expanded += 1 ; children = [] ; cave = self.game.cave
+        for move in MOVES:
+            ticks = advance(self.game, move) ; self.generated += 1 ; child = None
+            if self.is_dead(cave): self.pruned += 1
+            else:
+                key = state_key(cave, self.reference, node.key) ; depth = node.depth + 1
+                if self.table.get(key, depth + 1) <= depth: self.duplicates += 1
+                else:
+                    self.table[key] = depth
+                    child = Node(node, move, node.ticks + ticks, cave) ; (child.key, child.score) = (key, self.estimate(cave))
+                    children.append(child)
+            undo = self.trail.delta(child is not None)
+            if child is not None: (child.undo, child.redo) = (undo, undo.inverse) ; undo.inverse = None
+            self.trail.revert(undo) ; self.trail.capture(undo) ; cave.scheduler.rebuild_wheel()
+        return children
+
+    def verify(self, node: Node) -> bool:
+        # whether the moves found also solve the cave in the game as is
+        if replay(self.level, node.moves(), self.seed).cave.status == Cave.SUCCEEDED: return True
+        self.rejected += 1
+        return False
+
+    def solve(self) -> Optional[Node]:
+        ''' The node of the solution found, if any, within the maximum number of states. '''
+        start_time = time.perf_counter()
+        try:
+            root = self.start()
+            if root is None: return None
+            self.table[root.key] = 0
+            return self.search_beam(root) if self.method == 'beam' else self.search(root)
+        finally: self.duration = time.perf_counter() - start_time
+
+    def search(self, root: Node) -> Optional[Node]:
+        # best first : by depth (breadth first), or by depth plus the estimate of the moves left (A*)
+        seq = itertools.count() ; queue = [(0, next(seq), root)]
+        while queue and self.generated < self.max_states:
+            node = heapq.heappop(queue)[2]
+            for child in self.expand(node):
+                if child.status == Cave.SUCCEEDED:
+                    if self.verify(child): return child
+                    continue
+                priority = child.depth + (child.score if self.method == 'astar' else 0)
+                heapq.heappush(queue, (priority, next(seq), child))
+        return None
+
+    def search_beam(self, root: Node) -> Optional[Node]:
+        # breadth first, keeping only the most promising states at each depth : most diamonds collected, then nearest.
+        # The states are expanded in the order of their moves, for the game to go the shortest way from one to the next
+        def promise(node: Node) -> Tuple[int, int, int]: return (-node.collected, node.score, node.ticks)
+        beam = [root]
+        while beam and self.generated < self.max_states:
+            children = []
+            for node in sorted(beam, key = Node.moves):
+                for child in self.expand(node):
+                    if child.status != Cave.SUCCEEDED: children.append(child)
+                    elif self.verify(child): return child
+            beam = sorted(children, key = promise)[:self.beam_width]
+        return None
+
+    def report(self, solution: Optional[Node]) -> Dict:
+        result = { 'level': self.level, 'method': self.method, 'solved': solution is not None,
+            'states': self.generated, 'expanded': self.expanded, 'pruned': self.pruned, 'duplicates': self.duplicates, 'rejected': self.rejected,
+            'seconds': round(self.duration, 3), 'states_per_second': round(self.generated / max(self.duration, 1e-9)) }
+        if solution is not None:
+            result.update({ 'moves': solution.moves(), 'ticks': solution.ticks, 'time': round(solution.ticks * Cave.STEP, 2) })
+        return result
+
+def main(args: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description = 'Boulder Dash caves solver')
+    parser.add_argument('levels', type = int, nargs = '*', help = 'levels to solve (default : all)')
+    parser.add_argument('--method', choices = Solver.METHODS, default = 'beam', help = 'search method (default : beam)')
+    parser.add_argument('--max-states', type = int, default = Solver.MAX_STATES, help = 'states generated at most, per level')
+    parser.add_argument('--width', type = int, default = Solver.BEAM_WIDTH, help = 'states kept per depth by the beam search')
+    parser.add_argument('--pack', metavar = 'FILE', help = 'solve the levels of a pack compiled by levels.py')
+    parser.add_argument('--output', metavar = 'FILE', help = 'write the results as JSON')
+    args = parser.parse_args(args)
+    if args.pack is not None: Cave.pack = LevelPack.open(args.pack)
+    results = []
+    for level in args.levels or range(1, len(Cave.level_pack()) + 1):
+        solver = Solver(level, args.method, args.max_states, args.width)
+        result = solver.report(solver.solve()) ; results.append(result)
+        print(f'level {level:02} : ' + (f'solved in {result["time"]}s ({len(result["moves"])} moves) {result["moves"]}' if result['solved'] else 'not solved') +
+            f', {result["states"]} states, {result["states_per_second"]} states/s', file = sys.stderr)
+    if args.output is not None:
+        with open(args.output, 'w') as file: json.dump(results, file, indent = 2)
+    return 0 if all(result['solved'] for result in results) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
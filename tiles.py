@@ -1,35 +1,45 @@
 ﻿''' Standard tiles. '''
 
 from typing import Optional
-import math, random
-from game import Cave, Player, Sound, Tile, Interface
+import math
+from engine import Cave, Player, Sound, Tile, Interface, Rule
 
 class ICollectable(Interface):
     ''' Interface. Something that can be collected. '''
+    __slots__ = ()
     def collect(self) -> int : return 0
 
 class Soil(Tile, ICollectable):
     ''' A soil or dirt tile that miners can dig through. '''
+    __slots__ = ()
+    plain = True
     sound = Sound(":resources:sounds/rockHit2.wav")
     def __init__(self, cave: Cave, x: int, y: int) -> None: super().__init__(cave, x, y)
     def can_be_occupied(self, by: Tile, _ix: int, _iy: int) -> bool: return isinstance(by, Miner)
-    def collect(self) -> int : Soil.sound.play() ; return super().collect()
+    def collect(self) -> int : Soil.sound.play(at = (self.x, self.y)) ; return super().collect()
 
 class IRounded(Interface):
     ''' Interface. Something on top of which things can roll. '''
+    __slots__ = ()
 
 class Wall(Tile):
     ''' An abstract wall tile. Blocks movement but breakable by explosions. '''
+    __slots__ = ()
 
 class BrickWall(Wall, IRounded):
     ''' A brick wall tile. '''
+    __slots__ = ()
+    plain = True
 
 class MetalWall(Wall):
     ''' A metal wall tile. Unbreakable. '''
+    __slots__ = ()
+    plain = True
     def can_break(self) -> bool:  return False
 
 class ExpandingWall(Wall):
     ''' An expanding brick wall that "grows" sideways whenever possible. '''
+    __slots__ = ('horizontal',)
     def __init__(self, cave: Cave, x: int, y: int) -> None:
         super().__init__(cave, x, y, 2)
         self.add_skin(ExpandingWall, 1, True)
@@ -42,27 +52,40 @@ class ExpandingWall(Wall):
             if self.can_move(ix, iy):
                 tile = ExpandingWall(self.cave, self.x, self.y)
                 tile.set_skin(2 if ix < 0 or iy < 0 else 1)
-                Boulder.sound_fall.play()
+                Boulder.sound_fall.play(at = (self.x, self.y))
                 tile.try_move(ix, iy)
 
 class IActivable(Interface):
     ''' Interface. Something that may ba activated or used. '''
+    __slots__ = ()
     def try_activate(self, _by: Tile, _ix: int, _iy: int) -> bool : return False
 
 class Pushable(Tile, IActivable):
     ''' An abstract tile that can be pushed by miners. '''
+    __slots__ = ()
     sound = Sound(":resources:sounds/hurt1.wav")
     def try_activate(self, _by: Tile, ix:int, iy:int) -> bool :
-        if self.try_move(ix, iy): Pushable.sound.play() ; return True
+        self.cave.wake(self)
+        if self.try_move(ix, iy): Pushable.sound.play(at = (self.x, self.y)) ; return True
         return False
 
 class IFragile(Interface):
     ''' Interface. Something that may crack (on react in some other way) when fallen upon. '''
+    __slots__ = ()
     sound = Sound(":resources:sounds/hit4.wav")
-    def crack(self, _by: Tile) -> None: IFragile.sound.play()
+    def crack(self, _by: Tile) -> None: IFragile.sound.play(at = (self.x, self.y))
 
 class Weighted(Pushable):
-    ''' An abstract tile subject to gravity. It falls down and rolls off rounded objects. '''
+    ''' An abstract tile subject to gravity. It falls down and rolls off rounded objects.
+        Falls and rolls are resolved from the codes of the grid, unless next to a door or portal, or landing. '''
+    __slots__ = ('gravity',)
+    GRID_PATH = True # otherwise, always through the neighbor tiles (same results, slower)
+    on_grid = True # whether the moves of the type are those resolved from the grid
+
+    def __init_subclass__(cls, **kwargs) -> None:
+        super().__init_subclass__(**kwargs)
+        cls.on_grid = cls.can_move is Weighted.can_move and cls.try_roll is Weighted.try_roll and cls.try_move is Tile.try_move
+
     def __init__(self, cave: Cave, x: int, y: int, n: int = 1) -> None:
         super().__init__(cave, x, y, n)
         self.gravity = -1
@@ -72,15 +95,71 @@ class Weighted(Pushable):
 
     def tick(self) -> None:
         if self.gravity == 0 : return
+        if Weighted.GRID_PATH and self.on_grid and self.tick_on_grid(): return
         if self.try_move(0, self.gravity): return
         if self.moving: self.end_fall(self.neighbor(0, self.gravity))
-        ix = random.choice([-1, +1])
+        # no roll direction drawn when there is nothing to roll off, as when idle : sleeping must not change the draws
+        if not isinstance(self.cave.peek(*self.offset(0, self.gravity)), IRounded): return
+        ix = self.cave.random.choice([-1, +1])
         _ = self.try_roll(ix) or self.try_roll(-ix)
 
+    def can_enter(self, i: int, ix: int, iy: int) -> Optional[bool]:
+        # whether the tile can move into a cell, None if the tile there redirects moves
+        if i < 0: return False
+        grid = self.cave.front ; code = grid.codes[i]
+        if code == 0: return True
+        if Tile.kinds[code].redirecting: return None
+        tile = grid.objects.get(i)
+        return (tile if tile is not None else grid.flyweight(code)).can_be_occupied(self, ix, iy)
+
+    def tick_on_grid(self) -> bool:
+        # as the object path, deciding before any change : gives up (returns False) when it could not decide
+        (x, y, g) = (self.x, self.y, self.gravity)
+        below = self.cave.cell(x, y + g) ; fall = self.can_enter(below, 0, g)
+        if fall is None or (not fall and self.moving): return False
+        if fall: return self.try_move(0, g)
+        if below < 0 or not issubclass(Tile.kinds[self.cave.front.codes[below]], IRounded):
+            self.dir = (0, g) ; return True # as the failed fall, nothing to roll off
+        rolls = [False, False, False] # by direction -1, +1 (and 0 unused)
+        for ix in (-1, +1):
+            side = self.cave.cell(x + ix, y) ; roll = self.can_enter(side, ix, 0)
+            if roll:
+                # pretend we already moved, as try_roll does
+                (self.x, self.y) = (side % self.cave.width, side // self.cave.width)
+                roll = self.can_enter(self.cave.cell(self.x, self.y + g), 0, g)
+                (self.x, self.y) = (x, y)
+            if roll is None: return False
+            rolls[ix] = roll
+        self.dir = (0, g) # as the failed fall
+        ix = self.cave.random.choice([-1, +1])
+        if rolls[ix]: self.try_move(ix, 0)
+        elif rolls[-ix]: self.try_move(-ix, 0)
+        return True
+
     def end_fall(self, onto: Tile) -> None: pass
 
+    def is_idle(self) -> bool:
+        # resting on something it can neither fall into nor roll off, and not reached through a door or portal
+        if self.gravity == 0: return True
+        if self.moving: return False
+        below = self.cave.peek(self.x, self.y + self.gravity)
+        return below is not None and not isinstance(below, IRounded) and not below.redirecting \
+            and not self.can_move(0, self.gravity)
+
+    def is_steady(self) -> bool:
+        # idle but for the roll direction drawn : resting on a rounded tile, with no side to roll off to (as tick_on_grid)
+        if Weighted.is_idle(self): return True
+        if self.moving or not self.on_grid: return False
+        (x, y, g) = (self.x, self.y, self.gravity) ; cave = self.cave
+        below = cave.cell(x, y + g)
+        if below < 0 or not issubclass(Tile.kinds[cave.front.codes[below]], IRounded) or self.can_enter(below, 0, g) is not False: return False
+        for ix in (-1, +1):
+            roll = self.can_enter(cave.cell(x + ix, y), ix, 0)
+            if roll is None or roll and self.can_enter(cave.cell(x + ix, y + g), 0, g) is not False: return False
+        return True
+
     def try_roll(self, ix: int) -> bool:
-        below = self.neighbor(0, self.gravity)
+        below = self.cave.peek(*self.offset(0, self.gravity))
         if isinstance(below, IRounded) and self.can_move(ix, 0):
             # pretend we already moved (doors, portals don't like diagonal moves)
             (x,y) = (self.x, self.y)
@@ -92,24 +171,28 @@ class Weighted(Pushable):
 
 class Massive(Weighted, IRounded):
     ''' A tile so massive it can crush creatures. '''
+    __slots__ = ()
     sound_fall = Sound(":resources:sounds/hurt2.wav")
 
     def end_fall(self, onto: Tile) -> None:
         super().end_fall(onto)
-        type(self).sound_fall.play()
+        type(self).sound_fall.play(at = (self.x, self.y))
         if isinstance(onto, IFragile): onto.crack(self)
 
 class IMutable(Interface):
     ''' Interface. Can be transformed into something else. '''
+    __slots__ = ()
     def mutate(self) -> Tile: return self
 
 class Boulder(Massive, IMutable):
     ''' A rock or boulder tile. '''
+    __slots__ = ()
     def __init__(self, cave: Cave, x: int, y: int) -> None: super().__init__(cave, x, y)
     def mutate(self) -> Tile: return Diamond(self.cave, self.x, self.y)
 
 class Diamond(Massive, ICollectable, IMutable):
     ''' A diamond tile. Unbreakable. Animated. The goal of the game is to collect them. '''
+    __slots__ = ()
     sound = Sound(":resources:sounds/coin5.wav")
     sound_fall = Sound(":resources:sounds/coin4.wav")
     sound_explosion = Sound(":resources:sounds/secret4.wav")
@@ -117,24 +200,26 @@ class Diamond(Massive, ICollectable, IMutable):
     def __init__(self, cave: Cave, x: int, y: int, n: int = 4) -> None:
         super().__init__(cave, x, y, n)
     def mutate(self) -> Tile: return Boulder(self.cave, self.x, self.y)
+    def is_idle(self) -> bool: return False # keeps shining
 
     def can_be_occupied(self, by: Tile, _ix: int, _iy: int) -> bool: return isinstance(by, Miner)
     def can_break(self) -> bool:  return False
 
     def collect(self) -> int:
-        Diamond.sound.play()
+        Diamond.sound.play(at = (self.x, self.y))
         self.cave.collected += 1
         return 5 if self.cave.is_complete() else 2
 
     def tick(self) -> None:
-        if random.randint(0,3) == 1:
-            shine = random.randint(1, 10*self.nb_skins)
+        if self.cave.random.randint(0,3) == 1:
+            shine = self.cave.random.randint(1, 10*self.nb_skins)
             if shine >= self.nb_skins: shine = 0
             self.set_skin(shine)
         super().tick()
 
 class Explosion(Tile):
     ''' An explosition tile. Instant visual effect only, essentially behaves as an empty tile. '''
+    __slots__ = ()
     WAIT_CLEAR = .25 # seconds
     sound_explosion = Sound(":resources:sounds/explosion2.wav")
     def __init__(self, cave: Cave, x: int, y: int) -> None:
@@ -149,7 +234,9 @@ class Explosion(Tile):
 
 class Entry(Tile):
     ''' A door by which miners are entering the cave. '''
+    __slots__ = ('once',)
     WAIT_OPEN = 0.75 # seconds
+    awakens = 2 # chunks
     sound = Sound(":resources:sounds/jump4.wav")
     def __init__(self, cave: Cave, x: int, y: int) -> None:
         super().__init__(cave, x, y, 0)
@@ -169,16 +256,17 @@ class Entry(Tile):
                 miner = self.cave.miner_type(self.cave, self.x, self.y, player)
                 for direction in [(0,0),(-1,0),(+1,0),(0,+1),(0,-1),(-1,+1),(+1,+1),(-1,-1),(+1,-1)]:
                     if miner.try_move(*direction):
-                        Entry.sound.play()
+                        Entry.sound.play(at = (self.x, self.y))
                         self.cave.set_status(Cave.IN_PROGRESS)
                         break
         if self.neighbor(0,0) is self:
-            IFragile.sound.play()
+            IFragile.sound.play(at = (self.x, self.y))
             self.cave.replace(self, Explosion)
         self.cave.replace_all(Entry, Explosion)
 
 class Exit(Tile):
     ''' A door that miners must use the exit the cave when completed. '''
+    __slots__ = ('opened',)
     sound = Sound(":resources:sounds/upgrade1.wav")
     def __init__(self, cave: Cave, x: int, y: int) -> None:
         super().__init__(cave, x, y, 2)
@@ -188,17 +276,19 @@ class Exit(Tile):
         if not self.opened and self.cave.is_complete() :
             Entry.sound.play()
             self.opened = True ; self.set_skin(1)
+    def is_idle(self) -> bool: return self.opened
 
     def can_be_occupied(self, by: Tile, _ix: int, _iy: int) -> bool:
         return isinstance(by, Miner) and self.opened
     def can_break(self) -> bool:  return False
 
     def on_destroy(self) -> None:
-        Exit.sound.play()
+        Exit.sound.play(at = (self.x, self.y))
         self.cave.set_status(Cave.SUCCEEDED)
 
 class Creature(Tile):
     ''' A creature in the cave, either miner or insect. Crushed by falling massive tiles. Explodes when dying. '''
+    __slots__ = ()
     def can_be_occupied(self, by: Tile, _ix: int, _iy: int) -> bool:
         return isinstance(by, Massive) and by.moving
 
@@ -206,7 +296,9 @@ class Creature(Tile):
 
 class Miner(Creature):
     ''' Main protagonist in the cave. Controled by a player. Can use tiles. '''
+    __slots__ = ('player',)
     CAMERA_SPEED = 0.02
+    awakens = 2 # chunks
 
     def __init__(self, cave: Cave, x: int, y: int, player: Player) -> None:
         super().__init__(cave, x, y, 4)
@@ -248,6 +340,7 @@ class Miner(Creature):
 
 class Insect(Creature, ICollectable):
     ''' An abstract unfriendly creature in the cave. Wanders around. Kills miners. '''
+    __slots__ = ('frightened', 'rotation')
     def __init__(self, cave: Cave, x: int, y: int) -> None:
         super().__init__(cave, x, y, 4)
         self.speed /= 2
@@ -267,7 +360,7 @@ class Insect(Creature, ICollectable):
         return False
 
     def collect(self) -> int :
-        Diamond.sound_explosion.play()
+        Diamond.sound_explosion.play(at = (self.x, self.y))
         return 5 if self.frightened > 0 else 0
 
     def on_update(self, delta_time: float = 1/60) -> None:
@@ -293,12 +386,14 @@ class Insect(Creature, ICollectable):
 
 class Firefly(Insect):
     ''' Simplest kind of insect. Wanders clockwise. '''
+    __slots__ = ()
     def __init__(self, cave: Cave, x: int, y: int) -> None:
         super().__init__(cave, x, y)
         self.dir = (-1, 0) ; self.rotation = -1
 
 class Butterfly(Insect):
     ''' An insect that explodes in diamonds. Wanders counter-clockwise. '''
+    __slots__ = ()
     def __init__(self, cave: Cave, x: int, y: int) -> None:
         super().__init__(cave, x, y)
         self.dir = (0, -1) ; self.rotation = +1
@@ -309,13 +404,15 @@ class Butterfly(Insect):
 
 class MagicWall(BrickWall):
     ''' An enchanted brick wall. A boulder or diamond that hits the wall gets changed into a diamond or boulder respectively, and falls through. '''
+    __slots__ = ()
     def __init__(self, cave: Cave, x: int, y: int) -> None:
         super().__init__(cave, x, y, 3)
         self.add_skin(BrickWall, 0)
 
     def tick(self) -> None:
-        if random.randint(0, 6) == 0: self.set_skin(random.randint(0, self.nb_skins - 1))
+        if self.cave.random.randint(0, 6) == 0: self.set_skin(self.cave.random.randint(0, self.nb_skins - 1))
         super().tick()
+    def is_steady(self) -> bool: return True # only shines
 
     def can_be_occupied(self, by: 'Tile', _ix: int, iy: int) -> bool:
         return isinstance(by, Weighted) and by.moving
@@ -332,25 +429,27 @@ class MagicWall(BrickWall):
 
 class Amoeba(Tile):
     '''  Blob that grows randomly. If it can't, it turns into diamonds. If too large, it turns into boulders. Kills insects. '''
+    __slots__ = ('trapped',)
     DEATH_SIZE = 200
     def __init__(self, cave: Cave, x: int, y: int) -> None:
         super().__init__(cave, x, y)
         self.add_skin(Amoeba, 0, True, False) ; self.add_skin(Amoeba, 0, False, True) ; self.add_skin(Amoeba, 0, True, True)
-        self.set_skin(random.randint(0, self.nb_skins - 1))
+        self.set_skin(self.cave.random.randint(0, self.nb_skins - 1))
         self.try_wait()
         self.trapped = False
 
     def tick(self) -> None:
-        if random.randint(0, 4) == 0: self.set_skin(random.randint(0, self.nb_skins - 1))
-        self.trapped = True
+        if self.cave.random.randint(0, 4) == 0: self.set_skin(self.cave.random.randint(0, self.nb_skins - 1))
+        trapped = True
         for look in [(-1,0),(+1,0),(0,-1),(0,+1)]:
             neighbor = self.neighbor(*look)
             if neighbor is None or isinstance(neighbor, Soil):
-                self.trapped = False
+                trapped = False
                 proba = 20 if neighbor is None else 80
-                if random.randint(0, proba) == 0:
+                if self.cave.random.randint(0, proba) == 0:
                     (ix,iy) = look ; (x,y) = (self.x+ix, self.y+iy)
                     self.cave.set(x, y, Amoeba(self.cave, x, y))
+        if trapped != self.trapped: self.trapped = trapped ; self.cave.notify(self)
         self.try_wait()
 
     def can_be_occupied(self, by: Tile, _ix:int, _iy:int) -> bool: return isinstance(by, Insect)
@@ -359,19 +458,30 @@ class Amoeba(Tile):
         insect = self.neighbor(0, 0)
         if isinstance(insect, Insect): self.cave.replace(insect, Amoeba)
 
-    @staticmethod
-    def on_global_update(cave: Cave) -> bool:
-        amoebas = [*cave.tiles(Amoeba)]
-        if len(amoebas) > 0 and all(amoeba.trapped for amoeba in amoebas):
-            cave.replace_all(Amoeba, Diamond)
+class AmoebaRule(Rule):
+    ''' Turns all amoebas into diamonds when none can grow anymore, or into boulders when they are too many. '''
+    kinds = (Amoeba,)
+    def __init__(self, cave: Cave) -> None:
+        super().__init__(cave)
+        self.untrapped = 0
+    def on_added(self, tile: Tile, _back: bool) -> None:
+        if not tile.trapped: self.untrapped += 1
+    def on_removed(self, tile: Tile, _back: bool) -> None:
+        if not tile.trapped: self.untrapped -= 1
+    def on_changed(self, tile: Tile) -> None:
+        self.untrapped += -1 if tile.trapped else +1
+    def update(self) -> None:
+        count = self.cave.count(Amoeba)
+        if count > 0 and self.untrapped == 0:
+            self.cave.replace_all(Amoeba, Diamond)
             Diamond.sound_explosion.play()
-        elif len(amoebas) >= Amoeba.DEATH_SIZE:
-            cave.replace_all(Amoeba, Boulder)
+        elif count >= Amoeba.DEATH_SIZE:
+            self.cave.replace_all(Amoeba, Boulder)
             Boulder.sound_fall.play()
 
 # Registrations
 def register(registry):
-    registry.global_updates.append(Amoeba.on_global_update)
+    registry.global_rules.append(AmoebaRule)
     registry.registered_tiles = {
         **registry.registered_tiles,
         '♂': Miner, '.': Soil, 'w': BrickWall, 'W': MetalWall, 'r': Boulder, 'd': Diamond, 'E': Entry, 'X': Exit,
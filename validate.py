@@ -0,0 +1,176 @@
+﻿''' Batch validation of levels, headless, across a pool of processes : every level of the given packs is played under
+    several seeds and input policies, and the outcomes are aggregated into a JSON report. The workers memory map the
+    compiled packs, read-only, so that tasks only carry the level, seed and policy to play. With the game levels, the
+    replay fixtures are played back too, and must end as recorded.
+    Usage : python validate.py [--seeds N] [--policies idle,random,solution] [--jobs N] [--output FILE] [SOURCE...]
+    where sources are level packs, or maps definitions compiled first (default : the game levels), or python validate.py
+    --self-check to check that edge case maps load and play without errors. '''
+
+from typing import Optional, List, Dict, Tuple
+import argparse, collections, concurrent.futures, json, os, sys, tempfile, time
+from engine import Cave, Headless, Unknown
+from levels import LevelPack, compile_maps, read_maps, PACK_FILE
+from replay import ScriptedPlayer, fixtures, verify
+
+POLICIES = ('idle', 'random', 'solution')
+STATUSES = { Cave.SUCCEEDED: 'SUCCEEDED', Cave.FAILED: 'FAILED', Cave.GAME_OVER: 'GAME_OVER' } # final ones
+MAX_SECONDS = 200 # of game time per run, beyond the time limit of the standard levels
+SELF_CHECK_MAPS = [ # edge cases that must load and play without errors, with the issues expected
+    ({ 'goal': 1, 'map': ["WWWWWWWWWW", "WE..r...XW", "W...p...dW", "W........W", "WWWWWWWWWW"] }, ['portal without pair']),
+    ({ 'goal': 1, 'map': ["WWWWWWWWWW", "WE..r...XW", "W..pp...dW", "W........W", "WWWWWWWWWW"] }, []), # side by side
+]
+
+packs = [] # of the worker, by index in the sources
+solutions = {} # of the worker, level -> moves found by solver.py
+
+def init_worker(files: List[str], moves: Dict[int, str]) -> None:
+    packs.extend(LevelPack.open(file_name) for file_name in files)
+    solutions.update(moves)
+
+def check_level(cave: Cave) -> List[str]:
+    ''' Lists the issues of a cave as loaded, that would not necessarily make it fail. '''
+    from custom_tiles import Portal
+    issues = []
+    if cave.count(Unknown) > 0: issues.append(f'{cave.count(Unknown)} unknown tiles')
+    if cave.count(Portal) % 2 != 0: issues.append('portal without pair')
+    return issues
+
+def run_task(task: Tuple[int, int, int, str, int]) -> Dict:
+    ''' Plays a level until it ends or time is up, and returns the outcome. '''
+    from custom_tiles import Portal
+    (pack, level, seed, policy, max_ticks) = task
+    outcome = { 'pack': pack, 'level': level, 'seed': seed, 'policy': policy, 'status': 'ERROR', 'ticks': 0 }
+    start_time = time.process_time() # of the worker only, whatever the other processes sharing the cores
+    try:
+        Cave.pack = packs[pack] ; Portal.next_link = None # no pairing with a portal left over by another level
+        game = Headless(1, level, seed) ; cave = game.cave
+        outcome['issues'] = check_level(cave)
+        outcome['ticks'] = play(game, policy, seed, solutions.get(level, '') if pack == 0 else '', max_ticks)
+        outcome['status'] = STATUSES.get(cave.status, 'TIMEOUT')
+        if cave.status == Cave.SUCCEEDED: outcome['time'] = round(outcome['ticks'] * Cave.STEP, 2)
+    except Exception as error: outcome['error'] = f'{type(error).__name__}: {error}'
+    outcome['cpu'] = round(time.process_time() - start_time, 4)
+    return outcome
+
+def run_replay(task: Tuple[int, str]) -> Dict:
+    ''' Plays a replay fixture back, and returns whether it ends as recorded. '''
+    from custom_tiles import Portal
+    (pack, file_name) = task
+    outcome = { 'replay': os.path.basename(file_name), 'status': 'ERROR' }
+    try:
+        Cave.pack = packs[pack] ; Portal.next_link = None
+        result = verify(file_name)
+        outcome.update({ 'status': 'OK' if result['valid'] else 'MISMATCH', 'ticks': result['steps'] })
+    except Exception as error: outcome['error'] = f'{type(error).__name__}: {error}'
+    return outcome
+
+def play(game: Headless, policy: str, seed: int, moves: str, max_ticks: int) -> int:
+    # steps the game as the policy says, until the level ends : returns the number of ticks
+    cave = game.cave ; ticks = 0
+    if policy == 'solution':
+        from solver import enter, advance
+        ticks = enter(game)
+        for move in moves:
+            if cave.status != Cave.IN_PROGRESS: break
+            ticks += advance(game, move)
+    player = ScriptedPlayer(game, seed)
+    while cave.status not in STATUSES and ticks < max_ticks:
+        if policy == 'random': player.step()
+        else: game.step()
+        ticks += 1
+    return ticks
+
+def summarize(outcomes: List[Dict], duration: float, jobs: int) -> Dict:
+    ''' Aggregates the outcomes, overall and by level. '''
+    def stats(group: List[Dict]) -> Dict:
+        statuses = collections.Counter(outcome['status'] for outcome in group)
+        times = [ outcome['time'] for outcome in group if 'time' in outcome ]
+        (ticks, cpu) = (sum(outcome['ticks'] for outcome in group), sum(outcome['cpu'] for outcome in group))
+        return { 'runs': len(group), 'rates': { status: round(count / len(group), 3) for (status, count) in sorted(statuses.items()) },
+            'time': { 'min': min(times), 'mean': round(sum(times) / len(times), 2), 'max': max(times) } if times else None,
+            'ticks_per_second': round(ticks / max(cpu, 1e-9)) }
+    levels = collections.defaultdict(list)
+    for outcome in outcomes: levels[(outcome['pack'], outcome['level'])].append(outcome)
+    report = stats(outcomes)
+    busy = sum(outcome['cpu'] for outcome in outcomes)
+    report.update({ 'jobs': jobs, 'seconds': round(duration, 2), 'speedup': round(busy / max(duration, 1e-9), 2) })
+    report['levels'] = []
+    for ((pack, level), group) in sorted(levels.items()):
+        entry = { 'pack': pack, 'level': level, **stats(group) }
+        entry['errors'] = sorted({ outcome['error'] for outcome in group if 'error' in outcome })
+        entry['issues'] = sorted({ issue for outcome in group for issue in outcome.get('issues', []) })
+        report['levels'].append(entry)
+    report['errors'] = sum(1 for outcome in outcomes if 'error' in outcome)
+    return report
+
+def self_check() -> List[str]:
+    ''' Loads and plays the edge case maps, and lists the failures. '''
+    from custom_tiles import Portal
+    (failures, pack) = ([], Cave.pack)
+    Cave.pack = LevelPack(compile_maps([ cave_map for (cave_map, _) in SELF_CHECK_MAPS ]))
+    try:
+        for (level, (_, expected)) in enumerate(SELF_CHECK_MAPS, 1):
+            Portal.next_link = None
+            try:
+                game = Headless(1, level, 0) ; issues = check_level(game.cave)
+                if issues != expected: failures.append(f'level {level} : issues {issues} instead of {expected}')
+                play(game, 'random', level, '', round(20 / Cave.STEP))
+            except Exception as error: failures.append(f'level {level} : {type(error).__name__}: {error}')
+    finally: Cave.pack = pack
+    return failures
+
+def main(args: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description = 'Boulder Dash levels batch validation')
+    parser.add_argument('sources', nargs = '*', help = 'level packs, or maps definitions (default : the game levels)')
+    parser.add_argument('--seeds', type = int, default = 4, help = 'seeds per level and policy')
+    parser.add_argument('--policies', type = lambda text: text.split(','), default = ['idle', 'random'],
+        help = f'comma separated input policies among {", ".join(POLICIES)} (default : idle,random)')
+    parser.add_argument('--solutions', metavar = 'FILE', help = 'moves to play by the solution policy in the levels of the first source, as written by solver.py')
+    parser.add_argument('--max-seconds', type = float, default = MAX_SECONDS, help = 'game time per run at most')
+    parser.add_argument('--jobs', type = int, default = os.cpu_count(), help = 'worker processes (default : one per core)')
+    parser.add_argument('--output', metavar = 'FILE', help = 'write the report as JSON (default : standard output)')
+    parser.add_argument('--self-check', action = 'store_true', help = 'only check that edge case maps, e.g. with a portal without pair, load and play')
+    args = parser.parse_args(args)
+    if args.self_check:
+        failures = self_check()
+        for failure in failures: print(f'FAILED {failure}', file = sys.stderr)
+        print(f'{len(SELF_CHECK_MAPS)} edge case maps, {len(failures)} failed', file = sys.stderr)
+        return 1 if len(failures) > 0 else 0
+    if any(policy not in POLICIES for policy in args.policies): parser.error(f'policies are among {", ".join(POLICIES)}')
+    moves = {}
+    if args.solutions is not None:
+        with open(args.solutions) as file: moves = { result['level']: result['moves'] for result in json.load(file) if result['solved'] }
+    with tempfile.TemporaryDirectory() as directory:
+        # maps definitions are compiled once, for the workers to map the packs rather than receive the maps
+        files = []
+        for source in args.sources or [PACK_FILE]:
+            if source == PACK_FILE: LevelPack.default()
+            elif not source.lower().endswith('.bdl'):
+                files.append(os.path.join(directory, f'{len(files)}.bdl'))
+                with open(files[-1], 'wb') as file: file.write(compile_maps(read_maps(source)))
+                continue
+            files.append(source)
+        ticks = round(args.max_seconds / Cave.STEP)
+        tasks = [ (pack, level, seed, policy, ticks) for (pack, file_name) in enumerate(files)
+            for level in range(1, len(LevelPack.open(file_name)) + 1) for policy in args.policies for seed in range(args.seeds) ]
+        game_packs = [ pack for (pack, file_name) in enumerate(files) if os.path.abspath(file_name) == os.path.abspath(PACK_FILE) ]
+        replays = [ (game_packs[0], file_name) for file_name in fixtures() ] if game_packs else [] # recorded in the game levels
+        start_time = time.perf_counter()
+        with concurrent.futures.ProcessPoolExecutor(args.jobs, initializer = init_worker, initargs = (files, moves)) as executor:
+            outcomes = list(executor.map(run_task, tasks, chunksize = max(1, len(tasks) // (8 * args.jobs))))
+            duration = time.perf_counter() - start_time
+            replayed = list(executor.map(run_replay, replays))
+        report = summarize(outcomes, duration, args.jobs)
+        report['replays'] = { 'runs': len(replayed), 'failed': [ outcome for outcome in replayed if outcome['status'] != 'OK' ] }
+    report['sources'] = args.sources or [PACK_FILE]
+    output = json.dumps(report, indent = 2)
+    if args.output is None: print(output)
+    else:
+        with open(args.output, 'w') as file: file.write(output + '\n')
+    print(f'{report["runs"]} runs in {report["seconds"]}s on {args.jobs} processes (speedup {report["speedup"]}), '
+        f'{report["errors"]} errors, rates {report["rates"]}, {report["replays"]["runs"]} replays, '
+        f'{len(report["replays"]["failed"])} failed', file = sys.stderr)
+    return 1 if report['errors'] > 0 or len(report['replays']['failed']) > 0 else 0
+
+if __name__ == '__main__':
+    sys.exit(main())